@@ -6,10 +6,25 @@ from prebid_optimizer import runOptimizer
 
 DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
 
+# TODO - eventually we will load this externally
+CONFIGS_TO_OPTIMIZE = {
+  "default": {
+    "bidderTimeout": [1000, 1500, 2000], 
+  },
+}
+
+
+def get_configs_to_optimize(config_id):
+  return CONFIGS_TO_OPTIMIZE.get(config_id) or CONFIGS_TO_OPTIMIZE.get('default')
+
 
 def run_optimizer(env, config_ids, bucket_size, source_table, hour_window, 
                   data_delay_hour, model_type, run_timestamp_str=None, 
-                  is_dev=False):
+                  aggregate_table=None, max_bytes_scanned=None,
+                  export_manifest_path=None, pipeline=False, checkpoint_dir=None,
+                  shard_index=None, num_shards=None, cost_history_path=None,
+                  config_timeout_seconds=None, timeout_fallback="last_good", read_shards=1,
+                  stats_workers=None, serve_trigger_file=None, is_dev=False):
   """
   Runs the prebid optimizer on each of the provided config_ids, using the current time as the starting point for data.
   Writes the result to a GCS bucket.
@@ -23,27 +38,684 @@ def run_optimizer(env, config_ids, bucket_size, source_table, hour_window,
       source_table (string): The source table to use for BigQuery (fully qualified table name).
       is_dev (bool, optional): If true, turns on additional debugging and local mode testing functionality. Defaults to False.
       run_timestamp_str (str, optional): If not null, optimizer will be "run" at given timestamp.
+      aggregate_table (str, optional): If set, hourly statistics are read from this table (see `aggregate`) instead of source_table.
+      max_bytes_scanned (int, optional): If set, queries are dry run first and a config whose query would scan more bytes
+          publishes the default distribution (status "query_over_budget") instead.
+      export_manifest_path (str, optional): If set, the hashes of the published distributions are kept in this local file
+          and unchanged distributions are not exported again.
+      pipeline (bool, optional): If true, reading, optimizing and exporting of different configs overlap. Defaults to False.
+      checkpoint_dir (str, optional): Local directory or gs://bucket/prefix where the completed configs of each run are
+          recorded. A rerun within the same hour skips the configs that already completed.
+      shard_index (int, optional): If set, only the configs of this shard (0 <= shard_index < num_shards) are run and
+          their BQ rows are staged in the GCS bucket until `merge` loads the rows of all shards in one job.
+      num_shards (int, optional): Number of shards the config_ids are split into. Every shard must get the same
+          config_ids, num_shards and cost_history_path.
+      cost_history_path (str, optional): Local or gs:// JSON file with the runtime and row count history of every config.
+          If set, the configs predicted to take longest are run first (and sharded runs split the configs so that the
+          shards have similar predicted runtimes instead of by a hash of the config id). Unsharded runs update the
+          history, sharded runs leave it to `merge`.
+      config_timeout_seconds (float, optional): If set, a config that is still reading or fitting after this many
+          seconds stops and publishes a fallback distribution (status "timeout"), so one slow config cannot stall the run.
+      timeout_fallback (str, optional): "last_good" keeps the distributions already published for a timed out config
+          (or publishes the default one if there are none), "default" always publishes the default one.
+          Defaults to "last_good".
+      read_shards (int, optional): Number of concurrent queries the hour window of a config is split into (by hour
+          ranges). Reading a long window of a large config then takes about as long as reading one range. Defaults to 1.
+      stats_workers (int, optional): If set, the rows of a config are published once to shared memory and aggregated
+          into hourly statistics by this many worker processes, which attach to them instead of each receiving a copy.
+          Not used with aggregate_table.
+      serve_trigger_file (str, optional): If set, this file is created once the run has published its distributions,
+          so that a `serve --trigger_file` watching it swaps them in immediately.
+  """
+
+  if run_timestamp_str:
+    run_timestamp = datetime.strptime(run_timestamp_str, DATETIME_FORMAT)
+  else:
+    run_timestamp = None
+
+  _run_optimizer(env, config_ids, bucket_size, source_table, hour_window,
+                 data_delay_hour, model_type, run_timestamp=run_timestamp,
+                 aggregate_table=aggregate_table,
+                 max_bytes_scanned=max_bytes_scanned,
+                 export_manifest_path=export_manifest_path, pipeline=pipeline,
+                 checkpoint_dir=checkpoint_dir, shard_index=shard_index,
+                 num_shards=num_shards, cost_history_path=cost_history_path,
+                 config_timeout_seconds=config_timeout_seconds,
+                 timeout_fallback=timeout_fallback, read_shards=read_shards,
+                 stats_workers=stats_workers, serve_trigger_file=serve_trigger_file, is_dev=is_dev)
+
+
+def run_merge(env, num_shards, run_timestamp_str=None, cost_history_path=None):
+  """
+  Loads the BQ rows staged by all shards of a sharded `optimizer` run into the output table with a single load job.
+  Fails if a shard has not finished yet.
+
+  Args:
+      env (string): The environment the shards ran in (devint|qa|prod).
+      num_shards (int): Number of shards of the run.
+      run_timestamp_str (str, optional): Run timestamp of the shards (only the hour matters). Defaults to now.
+      cost_history_path (str, optional): If set, the runtimes of the run's configs are added to this history (see
+          `optimizer`). Must be run before the shards of the next run start, so they all split on the same history.
+  """
+  from prebid_optimizer import get_gcs_bucket
+  from prebid_optimizer.costs import CostHistory
+  from prebid_optimizer import get_output_table_id
+  from prebid_optimizer.sharding import get_run_prefix
+  from prebid_optimizer.sharding import mergeShardedRun
+
+  if run_timestamp_str:
+    run_timestamp = datetime.strptime(run_timestamp_str, DATETIME_FORMAT)
+  else:
+    run_timestamp = datetime.utcnow()
+
+  cost_history = CostHistory(cost_history_path) if cost_history_path else None
+  mergeShardedRun(get_gcs_bucket(env), get_run_prefix(run_timestamp), num_shards,
+                  get_output_table_id(env), cost_history=cost_history)
+
+
+def run_aggregate(source_table, aggregate_table, data_delay_hour,
+                  run_timestamp_str=None, backfill_hours=24 * 7):
+  """
+  Appends the hours that are complete but not yet aggregated to the hourly aggregate table read by
+  `optimizer --aggregate_table`. The table is created (hour-partitioned, clustered by configID) if needed.
+
+  Args:
+      source_table (string): The raw auctions table (fully qualified table name).
+      aggregate_table (string): The aggregate table (fully qualified table name).
+      data_delay_hour (int): How many hours are data upload delayed.
+      run_timestamp_str (str, optional): If not null, the update will be "run" at given timestamp.
+      backfill_hours (int, optional): Number of hours to aggregate when the table is empty. Defaults to a week.
   """
+  from prebid_optimizer.aggregate import updateAggregateTable
+
+  if run_timestamp_str:
+    run_timestamp = datetime.strptime(run_timestamp_str, DATETIME_FORMAT)
+  else:
+    run_timestamp = datetime.utcnow()
+
+  updateAggregateTable(source_table, aggregate_table, run_timestamp,
+                       data_delay_hour, backfill_hours=backfill_hours)
+
+
+def run_daemon(env, config_ids, bucket_size, source_table, hour_window,
+               data_delay_hour, model_type, interval_minutes=60,
+               offset_minutes=0, trigger_file=None, max_runs=None,
+               run_on_start=False, aggregate_table=None,
+               max_bytes_scanned=None, export_manifest_path=None,
+               skip_unchanged=True, pipeline=False, checkpoint_dir=None,
+               cost_history_path=None, config_timeout_seconds=None,
+               timeout_fallback="last_good", read_shards=1, stats_workers=None, watermark_source=None,
+               lateness_minutes=10, watermark_poll_seconds=60, serve_trigger_file=None, is_dev=False):
+  """
+  Keeps the optimizer resident and runs it for all config_ids on an internal schedule, or as soon as new hours of
+  data have fully landed (watermark_source).
+  GCP clients are created once and reused by every run.
+
+  Args:
+      env, config_ids, bucket_size, source_table, hour_window, data_delay_hour, model_type, max_bytes_scanned, export_manifest_path, pipeline, checkpoint_dir, cost_history_path, config_timeout_seconds, timeout_fallback, read_shards, stats_workers, serve_trigger_file: Same as for `optimizer`.
+      interval_minutes (int, optional): Minutes between scheduled runs, aligned to midnight. Defaults to 60.
+      offset_minutes (int, optional): Offset of the schedule from the aligned boundary. Defaults to 0.
+      trigger_file (str, optional): If this file appears, a run is started immediately and the file is removed.
+      max_runs (int, optional): Exit after this many runs. Defaults to running forever.
+      run_on_start (bool, optional): If true, runs once immediately after starting. Defaults to False.
+      aggregate_table (str, optional): If set, the aggregate table is updated before each run and the optimizer reads from it.
+      skip_unchanged (bool, optional): If true, unchanged distributions are not exported again. Defaults to True.
+      watermark_source (str, optional): "bigquery" (a query on the latest rows of config_ids in source_table, held to
+          max_bytes_scanned) or the path of a local JSON stand-in (see prebid_optimizer/watermark.py). If set, replaces the schedule and data_delay_hour: every
+          watermark_poll_seconds the latest complete hour of every config is checked, and the configs with a new
+          complete hour are run on the hour_window hours ending with it. The run timestamp of those runs is the end of
+          their window.
+      lateness_minutes (int, optional): An hour is complete once rows received this many minutes after its end have
+          landed. Defaults to 10.
+      watermark_poll_seconds (int, optional): Seconds between two checks of the watermarks. Defaults to 60.
+      is_dev (bool, optional): If true, turns on additional debugging and local mode testing functionality. Defaults to False.
+
+  Sending SIGUSR1 to the process also triggers an immediate run.
+  """
+  from prebid_optimizer.aggregate import updateAggregateTable
+  from prebid_optimizer.daemon import OptimizerDaemon
+  from prebid_optimizer.exporter import ExportManifest
+  from prebid_optimizer.session import Session
+
+  session = Session()
+  # Kept in memory between runs
+  manifest = ExportManifest(export_manifest_path) if skip_unchanged else None
+
+  watermark_trigger = None
+  if watermark_source:
+    from prebid_optimizer.watermark import BigQueryWatermarkSource
+    from prebid_optimizer.watermark import LocalWatermarkSource
+    from prebid_optimizer.watermark import WatermarkTrigger
+
+    if watermark_source == "bigquery":
+      source = BigQueryWatermarkSource(source_table, session=session, max_bytes_scanned=max_bytes_scanned)
+    else:
+      source = LocalWatermarkSource(watermark_source)
+    watermark_trigger = WatermarkTrigger(source, config_ids, lateness_minutes=lateness_minutes)
+
+  def run_on_watermark(run_timestamp):
+    if not watermark_trigger.watermarks:
+      # Triggered externally before the first poll
+      watermark_trigger.poll(run_timestamp)
+
+    until = None
+    if aggregate_table:
+      # The aggregate table holds the hours that are complete for every config
+      until = watermark_trigger.get_min_watermark()
+      if until:
+        updateAggregateTable(source_table, aggregate_table, until, 0, client=session.bigquery)
+
+    for end_timestamp, ready_config_ids in sorted(watermark_trigger.get_ready(until).items()):
+      print(f"Data of {len(ready_config_ids)} configs complete until {end_timestamp}")
+      _run_optimizer(env, ready_config_ids, bucket_size, source_table, hour_window,
+                     0, model_type, run_timestamp=end_timestamp,
+                     aggregate_table=aggregate_table,
+                     max_bytes_scanned=max_bytes_scanned, manifest=manifest,
+                     pipeline=pipeline, checkpoint_dir=checkpoint_dir,
+                     cost_history_path=cost_history_path,
+                     config_timeout_seconds=config_timeout_seconds,
+                     timeout_fallback=timeout_fallback, read_shards=read_shards,
+                     stats_workers=stats_workers, serve_trigger_file=serve_trigger_file, is_dev=is_dev,
+                     session=session)
+      watermark_trigger.mark_run(ready_config_ids, end_timestamp)
+
+  def run(run_timestamp):
+    if watermark_trigger:
+      run_on_watermark(run_timestamp)
+      return
+
+    if aggregate_table:
+      updateAggregateTable(source_table, aggregate_table, run_timestamp,
+                           data_delay_hour, client=session.bigquery)
 
-  # TODO - eventually we will load this externally
-  CONFIGS_TO_OPTIMIZE = {
-    "default": {
-      "bidderTimeout": [1000, 1500, 2000], 
-    },
-  }
+    _run_optimizer(env, config_ids, bucket_size, source_table, hour_window,
+                   data_delay_hour, model_type, run_timestamp=run_timestamp,
+                   aggregate_table=aggregate_table,
+                   max_bytes_scanned=max_bytes_scanned, manifest=manifest,
+                   pipeline=pipeline, checkpoint_dir=checkpoint_dir,
+                   cost_history_path=cost_history_path,
+                   config_timeout_seconds=config_timeout_seconds,
+                   timeout_fallback=timeout_fallback, read_shards=read_shards,
+                   stats_workers=stats_workers, serve_trigger_file=serve_trigger_file, is_dev=is_dev,
+                   session=session)
 
+  daemon = OptimizerDaemon(run, interval_minutes=interval_minutes,
+                           offset_minutes=offset_minutes,
+                           trigger_file=trigger_file, max_runs=max_runs,
+                           run_on_start=run_on_start, watermark_trigger=watermark_trigger,
+                           watermark_poll_seconds=watermark_poll_seconds)
+  daemon.install_signal_handlers()
+  daemon.run()
+
+
+def run_replay(config_ids, bucket_size, source_table, hour_window,
+               data_delay_hour, model_type, start_run_timestamp_str,
+               end_run_timestamp_str, output_path="replay.jsonl",
+               aggregate_table=None, is_dev=False):
+  """
+  Backtests the optimizer at every hour between the two run timestamps. Each config's data is read once
+  and every hour is fitted once. Writes the prob_to_win time series to a local newline-delimited JSON file
+  and never exports to the production BQ table or GCS bucket.
+
+  Args:
+      config_ids, bucket_size, source_table, hour_window, data_delay_hour, model_type: Same as for `optimizer`.
+      start_run_timestamp_str (str): First run timestamp of the replay.
+      end_run_timestamp_str (str): Last run timestamp of the replay (inclusive).
+      output_path (str, optional): Local file to write the time series to. Defaults to replay.jsonl.
+      aggregate_table (str, optional): If set, hourly statistics are read from this table instead of source_table.
+      is_dev (bool, optional): If true, turns on additional debugging and local mode testing functionality. Defaults to False.
+  """
+  import json
+
+  from prebid_optimizer import MIN_PROBABILITY
+  from prebid_optimizer.optimizer import TSOptimizer
+  from prebid_optimizer.replay import TSReplayer
+  from prebid_optimizer.replay import get_run_timestamps
+
+  run_timestamps = get_run_timestamps(
+    datetime.strptime(start_run_timestamp_str, DATETIME_FORMAT),
+    datetime.strptime(end_run_timestamp_str, DATETIME_FORMAT))
+
+  with open(output_path, "w") as f:
+    for config_id in config_ids:
+      print(f"Replaying Config Id: {config_id}")
+      start_time = time.perf_counter()
+      optimizer = TSOptimizer(config_id, bucket_size, source_table,
+                              get_configs_to_optimize(config_id),
+                              MIN_PROBABILITY, model_type, is_dev=is_dev,
+                              aggregate_table=aggregate_table)
+      replayer = TSReplayer(optimizer, hour_window, data_delay_hour)
+
+      for row in replayer.replay(run_timestamps):
+        row["config_id"] = config_id
+        f.write(json.dumps(row, default=str) + "\n")
+
+      end_time = time.perf_counter()
+      print(f"Replayed {len(run_timestamps)} runs of Config Id: {config_id} "
+            f"({replayer.num_fitted_hours} hours fitted) in {end_time - start_time:0.4f} seconds")
+
+
+def run_horizons(config_ids, bucket_size, source_table, hour_windows, data_delay_hour, model_type,
+                 output_path="horizons.jsonl", run_timestamp_str=None, aggregate_table=None,
+                 max_bytes_scanned=None, read_shards=1, is_dev=False):
+  """
+  Compares the distributions of several hour windows ending at the same hour. Each config's largest window is
+  read once and every hour is fitted once for all the windows. Writes one line per (config, hour window) to a
+  local newline-delimited JSON file and never exports to the production BQ table or GCS bucket.
+
+  Args:
+      config_ids, bucket_size, source_table, data_delay_hour, model_type, aggregate_table, max_bytes_scanned,
+          read_shards: Same as for `optimizer`.
+      hour_windows (list(int)): The hour windows to compare.
+      output_path (str, optional): Local file to write the distributions to. Defaults to horizons.jsonl.
+      run_timestamp_str (str, optional): If not null, optimizer will be "run" at given timestamp.
+      is_dev (bool, optional): If true, turns on additional debugging and local mode testing functionality. Defaults to False.
+  """
+  import json
+
+  from prebid_optimizer import MIN_PROBABILITY
+  from prebid_optimizer import get_time_window
+  from prebid_optimizer.optimizer import TSOptimizer
+
+  if run_timestamp_str:
+    run_timestamp = datetime.strptime(run_timestamp_str, DATETIME_FORMAT)
+  else:
+    run_timestamp = datetime.utcnow()
+  _, end_timestamp = get_time_window(run_timestamp, max(hour_windows), data_delay_hour)
+
+  with open(output_path, "w") as f:
+    for config_id in config_ids:
+      print(f"Comparing hour windows of Config Id: {config_id}")
+      start_time = time.perf_counter()
+      optimizer = TSOptimizer(config_id, bucket_size, source_table,
+                              get_configs_to_optimize(config_id),
+                              MIN_PROBABILITY, model_type, is_dev=is_dev,
+                              aggregate_table=aggregate_table,
+                              max_bytes_scanned=max_bytes_scanned,
+                              read_shards=read_shards)
+      results_by_window = optimizer.generate_multi_horizon_distributions(end_timestamp, hour_windows)
+
+      statuses = {}
+      for hour_window, results in sorted(results_by_window.items()):
+        row = {
+          "config_id": config_id,
+          "hour_window": hour_window,
+          "end_timestamp": end_timestamp,
+          "status": results["status"],
+          "num_rows": results["num_rows"],
+          "actions": results["actions"],
+        }
+        f.write(json.dumps(row, default=str) + "\n")
+        statuses[hour_window] = results["status"]
+
+      end_time = time.perf_counter()
+      print(f"Compared hour windows {sorted(hour_windows)} of Config Id: {config_id} "
+            f"in {end_time - start_time:0.4f} seconds (statuses: {statuses})")
+
+
+def run_segments(config_ids, bucket_size, source_table, hour_window, data_delay_hour, output_path,
+                 model_type="default", run_timestamp_str=None, max_bytes_scanned=None, read_shards=1,
+                 is_dev=False):
+  """
+  Computes prob_to_win for every ad unit (segment) of each config in one vectorized pass over the
+  per-ad-unit statistics. Writes newline-delimited JSON shards (one line per segment) to
+  {output_path}/{config_id}/run-{YYYYMMDDHH}/ and never exports to the production BQ table or GCS bucket.
+
+  Args:
+      config_ids, bucket_size, source_table, hour_window, data_delay_hour, max_bytes_scanned, read_shards: Same as for
+          `optimizer`.
+      output_path (str): Local directory or gs://bucket/prefix to write the shards to.
+      model_type (str, optional): Only the beta_lognormal ("default") model supports segments.
+      run_timestamp_str (str, optional): If not null, optimizer will be "run" at given timestamp.
+      is_dev (bool, optional): If true, turns on additional debugging and local mode testing functionality. Defaults to False.
+  """
+  from prebid_optimizer import MIN_PROBABILITY
+  from prebid_optimizer import get_time_window
+  from prebid_optimizer.segments import SegmentedOptimizer
+
+  if run_timestamp_str:
+    run_timestamp = datetime.strptime(run_timestamp_str, DATETIME_FORMAT)
+  else:
+    run_timestamp = datetime.utcnow()
+  start_timestamp, end_timestamp = get_time_window(run_timestamp, hour_window, data_delay_hour)
+
+  run_statuses = {}
   for config_id in config_ids:
-    configs_to_optimize = CONFIGS_TO_OPTIMIZE.get(config_id) or CONFIGS_TO_OPTIMIZE.get('default')
-    
-    if run_timestamp_str:
-      run_timestamp = datetime.strptime(run_timestamp_str, DATETIME_FORMAT)
+    print(f"Processing segments of Config Id: {config_id}")
+    start_time = time.perf_counter()
+    optimizer = SegmentedOptimizer(config_id, bucket_size, source_table,
+                                   get_configs_to_optimize(config_id),
+                                   MIN_PROBABILITY, model_type, is_dev=is_dev,
+                                   max_bytes_scanned=max_bytes_scanned,
+                                   read_shards=read_shards)
+    output_dir = f"{output_path}/{config_id}/run-{run_timestamp.strftime('%Y%m%d%H')}"
+    # An over budget or timed out config is skipped, the others still run
+    summary = optimizer.generate_segment_distributions(start_timestamp, end_timestamp, output_dir)
+    run_statuses[summary["status"]] = run_statuses.get(summary["status"], 0) + 1
+
+    end_time = time.perf_counter()
+    print(f"Wrote {summary['num_segments']} segments of Config Id: {config_id} to {summary['num_shards']} shards "
+          f"in {output_dir} in {end_time - start_time:0.4f} seconds (status: {summary['status']}, "
+          f"statuses: {summary['statuses']})")
+
+  print(f"Config statuses: {run_statuses}")
+
+
+def run_simulate(model_types=("default",), hour_windows=(6,), min_probabilities=(0.025,), bucket_size=10000,
+                 data_delay_hour=2, num_replications=1000, num_hours=48, num_actions=3, delta=0.01,
+                 amplitude=0.02, auctions_per_hour=10000, num_workers=None, seed=0, output_path=None):
+  """
+  Compares optimizer settings on simulated non-stationary traffic: every combination of model_types, hour_windows
+  and min_probabilities is simulated num_replications times and its regret (expected pubrev per auction lost
+  against always playing the best action) and runtime are printed.
+
+  Args:
+      model_types (list, optional): Models to compare.
+      hour_windows (list, optional): Hour windows to compare.
+      min_probabilities (list, optional): Minimum probabilities to compare.
+      bucket_size, data_delay_hour: Same as for `optimizer`.
+      num_replications (int, optional): Replications of every setting.
+      num_hours, num_actions, delta, amplitude, auctions_per_hour: Scenario, see simulate.make_scenario.
+      num_workers (int, optional): Processes to run the replications on. Defaults to one per CPU.
+      seed (int, optional): Seed of the simulations.
+      output_path (str, optional): If set, the summaries are written to this file, one JSON line per setting.
+  """
+  import itertools
+  import json
+  from prebid_optimizer import simulate
+
+  scenario = simulate.make_scenario(num_hours=num_hours, num_actions=num_actions, delta=delta,
+                                    amplitude=amplitude, auctions_per_hour=auctions_per_hour)
+  summaries = []
+  for model_type, hour_window, min_probability in itertools.product(model_types, hour_windows, min_probabilities):
+    summary = simulate.simulate(scenario, model_type=model_type, min_probability=min_probability,
+                                bucket_size=bucket_size, hour_window=hour_window,
+                                data_delay_hour=data_delay_hour, num_replications=num_replications,
+                                num_workers=num_workers, seed=seed)
+    print(f"model_type={model_type} hour_window={hour_window} min_probability={min_probability}: "
+          f"relative regret {summary['relative_regret']:0.4%}, cumulative regret "
+          f"{summary['mean_cumulative_regret']:0.1f} "
+          f"(std error {summary['cumulative_regret_std_error']}), "
+          f"{summary['replications_per_second']:0.1f} replications/s")
+    summaries.append(summary)
+
+  if output_path:
+    with open(output_path, "w") as f:
+      f.writelines(json.dumps(summary) + "\n" for summary in summaries)
+
+
+def run_serve(env=None, gcs_bucket=None, local_root=None, host="0.0.0.0", port=8080, refresh_seconds=60,
+              trigger_file=None):
+  """
+  Serves the published distributions of all configs from memory over HTTP (see prebid_optimizer/server.py),
+  refreshing them as soon as a run has published (trigger_file or SIGUSR1), and every refresh_seconds.
+
+  Args:
+      env (str, optional): Serves the bucket of this environment.
+      gcs_bucket (str, optional): Bucket to serve, overrides env.
+      local_root (str, optional): If set, the bucket is read from {local_root}/{gcs_bucket}/ instead of GCS.
+      host (str, optional): Address to listen on.
+      port (int, optional): Port to listen on.
+      refresh_seconds (int, optional): Seconds between two periodic refreshes of the distributions.
+      trigger_file (str, optional): If this file appears (see `optimizer --serve_trigger_file`), the distributions are
+          refreshed immediately and the file is removed.
+
+  Sending SIGUSR1 to the process also triggers an immediate refresh.
+  """
+  from prebid_optimizer import get_gcs_bucket
+  from prebid_optimizer.server import DistributionServer
+
+  gcs_bucket = gcs_bucket or get_gcs_bucket(env)
+  storage_client = None
+  if local_root:
+    from prebid_optimizer.local_storage import LocalStorageClient
+    storage_client = LocalStorageClient(local_root)
+
+  import signal
+
+  server = DistributionServer(gcs_bucket, storage_client, refresh_seconds, trigger_file=trigger_file)
+  signal.signal(signal.SIGUSR1, server.trigger)
+  host, port = server.start(host, port)
+  print(f"Serving distributions on http://{host}:{port}")
+  try:
+    while True:
+      time.sleep(3600)
+  except KeyboardInterrupt:
+    server.stop()
+
+
+def run_loadtest(num_configs=100, hour_window=6, rows_per_hour=2000, volume_sigma=1.0, bucket_size=10000,
+                 model_type="default", pipeline=False, read_shards=1, query_latency_seconds=1.0,
+                 query_rows_per_second=None, gcs_latency_seconds=0.05, gcs_bytes_per_second=None,
+                 root=None, output_path=None, seed=0):
+  """
+  Runs the optimizer end to end on synthetic traffic for num_configs configs, against local, file-backed stand-ins of
+  BigQuery and GCS with injected latency (see prebid_optimizer/loadtest.py), and reports the throughput, the latency
+  percentiles of every stage and the peak memory.
+
+  Args:
+      num_configs (int, optional): Number of configs of the run.
+      hour_window (int, optional): How many hours of data every config is run on.
+      rows_per_hour (int, optional): Median number of rows per hour of a config.
+      volume_sigma (float, optional): Spread (lognormal sigma) of the config volumes around rows_per_hour.
+      pipeline (bool, optional): Runs the configs through the pipeline (see `optimizer`).
+      read_shards (int, optional): Number of concurrent queries per config (see `optimizer`).
+      query_latency_seconds (float, optional): Time until the result of a query is ready.
+      query_rows_per_second (int, optional): If set, rate at which the rows of a query result are returned.
+      gcs_latency_seconds (float, optional): Latency of every GCS request.
+      gcs_bytes_per_second (int, optional): If set, transfer rate of GCS uploads and downloads.
+      root (str, optional): Directory of the stand-ins, kept after the run. Defaults to a temporary directory.
+      output_path (str, optional): If set, the report is written to this JSON file.
+  """
+  import json
+  import os
+  import shutil
+  import tempfile
+
+  from prebid_optimizer import get_output_table_id
+  from prebid_optimizer import round_to_hour
+  from prebid_optimizer.local_bigquery import LocalBigQueryClient
+  from prebid_optimizer.local_storage import LocalStorageClient
+  from prebid_optimizer.loadtest import LatencyRecorder
+  from prebid_optimizer.loadtest import generate_traffic
+  from prebid_optimizer.loadtest import get_report
+  from prebid_optimizer.session import Session
+  from prebid_optimizer.session import set_default_session
+
+  env = "loadtest"
+  source_table = "loadtest.prebid.auctions"
+  keep_root = root is not None
+  root = root or tempfile.mkdtemp(prefix="prebid-loadtest-")
+
+  run_timestamp = round_to_hour(datetime.utcnow())
+  config_ids = [f"loadtest-{i:05d}" for i in range(num_configs)]
+  configs = [(config_id, get_configs_to_optimize(config_id)) for config_id in config_ids]
+
+  bigquery_root = os.path.join(root, "bigquery")
+  num_rows = generate_traffic(bigquery_root, source_table, configs,
+                              run_timestamp - timedelta(hours=hour_window), hour_window,
+                              rows_per_hour, volume_sigma=volume_sigma, seed=seed)
+  print(f"Generated {num_rows} rows for {num_configs} configs in {root}")
+
+  recorder = LatencyRecorder()
+  bigquery_client = LocalBigQueryClient(bigquery_root, latency_seconds=query_latency_seconds,
+                                        rows_per_second=query_rows_per_second, recorder=recorder)
+  # Query results are returned by the stand-in itself, not the BigQuery Storage API
+  session = Session(clients={
+    "bigquery": bigquery_client,
+    "bigquery_storage": None,
+    "storage": LocalStorageClient(os.path.join(root, "gcs"), latency_seconds=gcs_latency_seconds,
+                                  bytes_per_second=gcs_bytes_per_second, recorder=recorder),
+  })
+  # Anything not given the session explicitly uses the stand-ins too
+  previous_session = set_default_session(session)
+  try:
+    start_time = time.perf_counter()
+    run_metrics = _run_optimizer(env, config_ids, bucket_size, source_table, hour_window, 0, model_type,
+                                 run_timestamp=run_timestamp, pipeline=pipeline, read_shards=read_shards,
+                                 session=session)
+    wall_seconds = time.perf_counter() - start_time
+  finally:
+    set_default_session(previous_session)
+
+  report = get_report(run_metrics, recorder, num_rows, wall_seconds)
+  num_exported = len(bigquery_client.read_table(get_output_table_id(env)))
+  if num_exported != report["num_configs"]:
+    print(f"Only {num_exported} of {report['num_configs']} configs were exported")
+
+  if not keep_root:
+    shutil.rmtree(root, ignore_errors=True)
+
+  print(json.dumps(report, indent=2))
+  if output_path:
+    with open(output_path, "w") as f:
+      json.dump(report, f, indent=2)
+
+
+def _add_run_metrics(run_metrics, config_id, results):
+  from prebid_optimizer.costs import get_num_rows
+
+  run_metrics["costs"][config_id] = (results["runtime_seconds"], get_num_rows(results))
+  for metrics in results["query_metrics"]:
+    run_metrics["queries"] += 1
+    run_metrics["bytes_processed"] += metrics.get("total_bytes_processed") or 0
+    run_metrics["cache_hits"] += int(bool(metrics.get("cache_hit")))
+  _add_status(run_metrics, results["status"])
+
+
+def _add_status(run_metrics, status):
+  statuses = run_metrics["statuses"]
+  statuses[status] = statuses.get(status, 0) + 1
+
+
+def _add_stage_seconds(run_metrics, stage, seconds):
+  run_metrics["stage_seconds"].setdefault(stage, []).append(seconds)
+
+
+def _run_optimizer(env, config_ids, bucket_size, source_table, hour_window,
+                   data_delay_hour, model_type, run_timestamp=None,
+                   aggregate_table=None, max_bytes_scanned=None, 
+                   export_manifest_path=None, manifest=None, pipeline=False,
+                   checkpoint_dir=None, shard_index=None, num_shards=None,
+                   cost_history_path=None, config_timeout_seconds=None,
+                   timeout_fallback="last_good", read_shards=1, stats_workers=None, serve_trigger_file=None,
+                   is_dev=False, session=None):
+  import os
+
+  from prebid_optimizer import get_gcs_bucket
+  from prebid_optimizer.checkpoint import RunCheckpoint
+  from prebid_optimizer.costs import CostHistory
+  from prebid_optimizer.exporter import ExportManifest
+  from prebid_optimizer.sharding import get_run_prefix
+  from prebid_optimizer.sharding import markShardDone
+  from prebid_optimizer.sharding import select_shard
+
+  if timeout_fallback not in ("last_good", "default"):
+    raise ValueError(f"{timeout_fallback} is not a valid timeout fallback")
+
+  if run_timestamp is None:
+    # Offset the time by the data upload delay
+    run_timestamp = datetime.utcnow()
+
+  cost_history = None
+  if cost_history_path:
+    cost_history = CostHistory(cost_history_path, storage_client=session.storage if session else None)
+
+  staging_prefix = None
+  if shard_index is not None:
+    costs = cost_history.get_costs(config_ids) if cost_history else None
+    all_config_ids = config_ids
+    config_ids = select_shard(all_config_ids, shard_index, num_shards, costs)
+    print(f"Shard {shard_index} of {num_shards}: {len(config_ids)} of {len(all_config_ids)} configs")
+
+    staging_prefix = get_run_prefix(run_timestamp)
+    if checkpoint_dir:
+      # Shards must not overwrite each other's checkpoint
+      checkpoint_dir = os.path.join(checkpoint_dir, f"shard-{shard_index}-of-{num_shards}")
+
+  checkpoint = None
+  if checkpoint_dir:
+    checkpoint = RunCheckpoint(checkpoint_dir, run_timestamp,
+                               storage_client=session.storage if session else None)
+    remaining_config_ids = checkpoint.get_remaining(config_ids)
+    print(f"Skipping {len(config_ids) - len(remaining_config_ids)} configs completed by a previous attempt")
+    config_ids = remaining_config_ids
+
+  if cost_history:
+    # Start the configs predicted to take longest first
+    config_ids = cost_history.order_longest_first(config_ids)
+
+  if manifest is None and export_manifest_path:
+    manifest = ExportManifest(export_manifest_path)
+  num_skipped_writes = manifest.num_skipped_writes if manifest else 0
+  num_skipped_bq_rows = manifest.num_skipped_bq_rows if manifest else 0
+
+  run_metrics = {"bytes_processed": 0, "cache_hits": 0, "queries": 0,
+                 "statuses": {}, "skipped_writes": 0, "skipped_bq_rows": 0, "costs": {},
+                 "stage_seconds": {}}
+
+  kwargs = dict(aggregate_table=aggregate_table, max_bytes_scanned=max_bytes_scanned,
+                manifest=manifest, checkpoint=checkpoint, staging_prefix=staging_prefix,
+                config_timeout_seconds=config_timeout_seconds,
+                timeout_fallback=timeout_fallback, read_shards=read_shards, stats_workers=stats_workers,
+                is_dev=is_dev, session=session)
+  if pipeline:
+    _run_optimizer_pipeline(env, config_ids, bucket_size, source_table, hour_window,
+                            data_delay_hour, model_type, run_timestamp, run_metrics,
+                            **kwargs)
+  else:
+    _run_optimizer_sequential(env, config_ids, bucket_size, source_table, hour_window,
+                              data_delay_hour, model_type, run_timestamp, run_metrics,
+                              **kwargs)
+
+  if manifest:
+    manifest.save()
+    run_metrics["skipped_writes"] = manifest.num_skipped_writes - num_skipped_writes
+    run_metrics["skipped_bq_rows"] = manifest.num_skipped_bq_rows - num_skipped_bq_rows
+
+  num_configs = sum(run_metrics["statuses"].values())
+  print(f"Run summary: {num_configs} configs, {run_metrics['queries']} queries, "
+        f"{run_metrics['bytes_processed']} bytes processed, {run_metrics['cache_hits']} cache hits, "
+        f"{run_metrics['skipped_writes']} unchanged uploads and {run_metrics['skipped_bq_rows']} unchanged BQ rows "
+        f"skipped, statuses: {run_metrics['statuses']}")
+
+  if cost_history and not staging_prefix:
+    for config_id, (seconds, num_rows) in run_metrics["costs"].items():
+      cost_history.update(config_id, seconds, num_rows)
+    cost_history.save()
+
+  if staging_prefix:
+    if "failed" in run_metrics["statuses"]:
+      # Rerunning the shard (with the checkpoint) retries the failed configs
+      print(f"Shard {shard_index} of {num_shards} has failed configs, not marking it done")
     else:
-      # Offset the time by the data upload delay
-      run_timestamp = datetime.utcnow()
+      markShardDone(get_gcs_bucket(env), staging_prefix, shard_index, num_shards,
+                    storage_client=session.storage if session else None)
+
+  if serve_trigger_file:
+    from prebid_optimizer.server import touch_trigger_file
+
+    # The distributions are published, the server swaps them in now rather than at its next refresh
+    touch_trigger_file(serve_trigger_file)
+
+  return run_metrics
+
+
+def _run_optimizer_sequential(env, config_ids, bucket_size, source_table, hour_window,
+                              data_delay_hour, model_type, run_timestamp, run_metrics,
+                              aggregate_table=None, max_bytes_scanned=None, manifest=None,
+                              checkpoint=None, staging_prefix=None, config_timeout_seconds=None,
+                              timeout_fallback="last_good", read_shards=1, stats_workers=None, is_dev=False,
+                              session=None):
+  from prebid_optimizer.exporter import get_distributions
+  from prebid_optimizer.exporter import hash_distributions
+
+  for config_id in config_ids:
+    configs_to_optimize = get_configs_to_optimize(config_id)
 
     print(f"Processing Config Id: {config_id}")
     start_time = time.perf_counter()
-    runOptimizer(
+    results = runOptimizer(
       env, 
       config_id,
       bucket_size,
@@ -54,13 +726,74 @@ def run_optimizer(env, config_ids, bucket_size, source_table, hour_window,
       data_delay_hour,
       model_type,
       is_dev=is_dev,
+      session=session,
+      aggregate_table=aggregate_table,
+      max_bytes_scanned=max_bytes_scanned,
+      manifest=manifest,
+      staging_prefix=staging_prefix,
+      config_timeout_seconds=config_timeout_seconds,
+      timeout_fallback=timeout_fallback,
+      read_shards=read_shards,
+      stats_workers=stats_workers,
     )
 
     end_time = time.perf_counter()
-    print(f"Finished processing Config Id: {config_id} in {end_time - start_time:0.4f} seconds")
+    print(f"Finished processing Config Id: {config_id} in {end_time - start_time:0.4f} seconds "
+          f"(status: {results['status']}, queries: {results['query_metrics']})")
+    _add_run_metrics(run_metrics, config_id, results)
+    _add_stage_seconds(run_metrics, "read_optimize", results["runtime_seconds"])
+    _add_stage_seconds(run_metrics, "export", end_time - start_time - results["runtime_seconds"])
+
+    if manifest:
+      # Persist after every config, so a crash does not lose the hashes
+      manifest.save()
+
+    if checkpoint:
+      checkpoint.mark_complete(config_id, results["status"],
+                               hash_distributions(get_distributions(results)))
+
+
+def _run_optimizer_pipeline(env, config_ids, bucket_size, source_table, hour_window,
+                            data_delay_hour, model_type, run_timestamp, run_metrics,
+                            **kwargs):
+  from prebid_optimizer.pipeline import runOptimizerPipeline
+
+  configs = [(config_id, get_configs_to_optimize(config_id)) for config_id in config_ids]
+
+  start_time = time.perf_counter()
+  tasks = runOptimizerPipeline(env, configs, bucket_size, source_table, run_timestamp,
+                               hour_window, data_delay_hour, model_type, **kwargs)
+  end_time = time.perf_counter()
+
+  stage_totals = {}
+  for task in tasks:
+    timings = ", ".join(f"{stage}: {seconds:0.4f}s" for stage, seconds in task.timings.items())
+    for stage, seconds in task.timings.items():
+      stage_totals[stage] = stage_totals.get(stage, 0) + seconds
+      _add_stage_seconds(run_metrics, stage, seconds)
+
+    if task.error is not None:
+      print(f"Config Id: {task.config_id} failed in stage {task.failed_stage} ({timings}): {task.error!r}")
+      _add_status(run_metrics, "failed")
+      continue
+
+    print(f"Finished processing Config Id: {task.config_id} ({timings}, status: {task.results['status']})")
+    _add_run_metrics(run_metrics, task.config_id, task.results)
+
+  totals = ", ".join(f"{stage}: {seconds:0.4f}s" for stage, seconds in stage_totals.items())
+  print(f"Pipeline finished in {end_time - start_time:0.4f} seconds (sum of stages: {totals})")
 
 
 if __name__ == '__main__':
   fire.Fire({
-    'optimizer': run_optimizer
+    'optimizer': run_optimizer,
+    'daemon': run_daemon,
+    'replay': run_replay,
+    'horizons': run_horizons,
+    'aggregate': run_aggregate,
+    'merge': run_merge,
+    'segments': run_segments,
+    'simulate': run_simulate,
+    'serve': run_serve,
+    'loadtest': run_loadtest,
   })
@@ -0,0 +1,70 @@
+"""
+Measures start-up (import) time of the package and the CLI with
+`python -X importtime`, so that regressions in import cost are easy to spot.
+
+Usage: python dev/importtime.py [module ...]
+"""
+import subprocess
+import sys
+
+
+DEFAULT_TARGETS = [
+    "prebid_optimizer",
+    "prebid_optimizer.optimizer",
+    "prebid_optimizer.exporter",
+    "cli",
+]
+
+HEAVY_MODULES = [
+    "pandas",
+    "scipy",
+    "google.cloud.bigquery",
+    "google.cloud.bigquery_storage",
+    "google.cloud.storage",
+]
+
+
+def measure_import(module, num_slowest=5):
+    """ Returns the cumulative import time (in microseconds) of `module` and
+    the slowest modules it imported directly """
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, check=True
+    ).stderr
+
+    timings, children = {}, {}
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+
+        _, cumulative_us, name = line[len("import time:"):].split("|")
+        # Nesting is shown by two spaces of indentation per level
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 0:
+            timings[name.strip()] = int(cumulative_us)
+        elif depth == 1:
+            children[name.strip()] = int(cumulative_us)
+
+    total = timings.get(module, sum(timings.values()))
+    slowest = sorted(children.items(), key=lambda x: -x[1])[:num_slowest]
+    return total, slowest
+
+
+def get_loaded_heavy_modules(module):
+    """ Returns the heavy dependencies that are loaded by importing `module` """
+    code = (f"import sys; import {module}; "
+            f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))")
+    output = subprocess.run([sys.executable, "-c", code],
+                            capture_output=True, text=True, check=True).stdout
+    return [m for m in output.strip().split(",") if m]
+
+
+if __name__ == "__main__":
+    targets = sys.argv[1:] or DEFAULT_TARGETS
+    for target in targets:
+        total, slowest = measure_import(target)
+        heavy = get_loaded_heavy_modules(target)
+        print(f"{target}: {total / 1e3:.1f} ms")
+        print(f"    heavy modules loaded: {', '.join(heavy) or 'none'}")
+        for name, cumulative_us in slowest:
+            print(f"    {name:<40} {cumulative_us / 1e3:8.1f} ms")
@@ -1,35 +1,130 @@
 from datetime import datetime, timedelta
-import json
+import time
 
-from prebid_optimizer.optimizer import TSOptimizer
-from prebid_optimizer.exporter import exportBQTable
-from prebid_optimizer.exporter import exportJSON
+# TODO: parameterize min_probability
+MIN_PROBABILITY = 0.025
 
 
 def round_to_hour(dt_obj):
     return dt_obj.replace(microsecond=0, second=0, minute=0)
 
 
-def runOptimizer(env, config_id, bucket_size, source_table, 
-        configs_to_optimize, run_timestamp, hour_window, data_delay_hour,
-        model_type, is_dev=False):
+def get_time_window(run_timestamp, hour_window, data_delay_hour):
+    """ Returns the (start, end) timestamps of the data used by a run """
+    cleaned_run_timestamp = round_to_hour(run_timestamp)
+    end_timestamp = cleaned_run_timestamp - timedelta(hours=data_delay_hour)
+    start_timestamp = end_timestamp - timedelta(hours=hour_window)
+
+    return start_timestamp, end_timestamp
+
+
+def get_output_table_id(env):
+    return f"ox-datascience-{env}.prebid.prebid_output"
+
+
+def get_gcs_bucket(env):
+    return f"ox-{env}-prebid-optimizer-data"
+
+
+def createOptimizer(config_id, bucket_size, source_table, configs_to_optimize,
+        model_type, is_dev=False, session=None, aggregate_table=None,
+        max_bytes_scanned=None, read_shards=1, stats_workers=None):
+    # Imported here so that `import prebid_optimizer` (and the CLI's --help)
+    # does not pay for scipy, pandas and the google-cloud libraries
+    from prebid_optimizer.optimizer import TSOptimizer
 
-    # TODO: parameterize min_probability
-    min_probability = 0.025
     optimizer = TSOptimizer(config_id, bucket_size, source_table,
-                            configs_to_optimize, min_probability, model_type,
-                            is_dev=is_dev)
+                            configs_to_optimize, MIN_PROBABILITY, model_type,
+                            is_dev=is_dev, session=session,
+                            aggregate_table=aggregate_table,
+                            max_bytes_scanned=max_bytes_scanned,
+                            read_shards=read_shards,
+                            stats_workers=stats_workers)
+    return optimizer
+
+
+def exportResults(results, env, config_id, run_timestamp, start_timestamp,
+        end_timestamp, session=None, manifest=None, staging_prefix=None,
+        timeout_fallback="last_good"):
+    """ Appends the results to the BQ output table and publishes the
+    distributions. If staging_prefix is set (sharded runs), the BQ row is
+    staged in the bucket under that prefix instead, to be loaded by the
+    merge step.
+
+    If the config timed out and timeout_fallback is "last_good", the
+    distributions that are already published (if any) are kept instead of
+    the default ones. """
+    from prebid_optimizer.optimizer import STATUS_OK
+    from prebid_optimizer.optimizer import STATUS_TIMEOUT
+    from prebid_optimizer.exporter import exportBQTable
+    from prebid_optimizer.exporter import exportJSON
+    from prebid_optimizer.exporter import get_distributions
+    from prebid_optimizer.exporter import get_published_distributions
+    from prebid_optimizer.exporter import stageBQRow
+    from prebid_optimizer.session import get_default_session
+
+    session = session or get_default_session()
+    table_id = get_output_table_id(env)
+    new_gcs_bucket = get_gcs_bucket(env)
+
+    if results["status"] == STATUS_TIMEOUT and timeout_fallback == "last_good":
+        published = get_published_distributions(
+            new_gcs_bucket, config_id, storage_client=session.storage)
+        if published:
+            print(f"Keeping the last published distributions of {config_id}")
+            results["actions"] = published["actions"]
+
+    # With a manifest, runs that did not change the distributions are not
+    # exported again (unless something went wrong, so that stays visible)
+    changed = manifest is None \
+                or manifest.has_changed(config_id, get_distributions(results))
+    if not changed and results["status"] == STATUS_OK:
+        print(f"Distributions of {config_id} unchanged, skipping BQ export")
+        manifest.num_skipped_bq_rows += 1
+    elif staging_prefix:
+        from prebid_optimizer.sharding import get_rows_path
+
+        stageBQRow(results, config_id, run_timestamp, start_timestamp,
+                   end_timestamp, new_gcs_bucket,
+                   get_rows_path(staging_prefix),
+                   storage_client=session.storage)
+    else:
+        exportBQTable(results, config_id, run_timestamp, start_timestamp,
+                      end_timestamp, table_id, client=session.bigquery)
+
+    exportJSON(results, new_gcs_bucket, config_id,
+               storage_client=session.storage, manifest=manifest)
+
+
+def runOptimizer(env, config_id, bucket_size, source_table, 
+        configs_to_optimize, run_timestamp, hour_window, data_delay_hour,
+        model_type, is_dev=False, session=None, aggregate_table=None,
+        max_bytes_scanned=None, manifest=None, staging_prefix=None,
+        config_timeout_seconds=None, timeout_fallback="last_good",
+        read_shards=1, stats_workers=None):
+    optimizer = createOptimizer(config_id, bucket_size, source_table,
+                                configs_to_optimize, model_type, 
+                                is_dev=is_dev, session=session,
+                                aggregate_table=aggregate_table,
+                                max_bytes_scanned=max_bytes_scanned,
+                                read_shards=read_shards,
+                                stats_workers=stats_workers)
+    if config_timeout_seconds:
+        from prebid_optimizer.deadline import Deadline
+        optimizer.set_deadline(Deadline(config_timeout_seconds))
 
     # Straighten out timestamps
-    cleaned_run_timestamp = round_to_hour(run_timestamp)
-    end_timestamp = cleaned_run_timestamp - timedelta(hours=data_delay_hour)
-    start_timestamp = end_timestamp - timedelta(hours=hour_window)
+    start_timestamp, end_timestamp = get_time_window(
+        run_timestamp, hour_window, data_delay_hour)
 
+    start_time = time.perf_counter()
     results = optimizer.generate_distributions(start_timestamp, end_timestamp)
+    # Time spent reading and fitting, see costs.CostHistory
+    results["runtime_seconds"] = time.perf_counter() - start_time
 
-    table_id = f"ox-datascience-{env}.prebid.prebid_output"
-    exportBQTable(results, config_id, run_timestamp, start_timestamp,
-                  end_timestamp, table_id)
+    exportResults(results, env, config_id, run_timestamp, start_timestamp,
+                  end_timestamp, session=session, manifest=manifest,
+                  staging_prefix=staging_prefix,
+                  timeout_fallback=timeout_fallback)
 
-    new_gcs_bucket = f"ox-{env}-prebid-optimizer-data"
-    exportJSON(results, new_gcs_bucket, config_id)
+    return results
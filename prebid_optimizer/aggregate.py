@@ -0,0 +1,171 @@
+"""
+Maintains an hour-partitioned, configID-clustered table with the hourly
+statistics (see `prebid_optimizer.stats`) of every config. Building it scans
+the raw auctions table once per hour for all configs, after which the reader
+only reads a few hundred pre-aggregated rows per run instead of parsing and
+unnesting the raw auctions for every config, every hour.
+
+Only hours after the last aggregated one are appended, so the update can run
+on the same hourly schedule as the optimizer.
+"""
+
+from datetime import timedelta
+
+from prebid_optimizer import round_to_hour
+from prebid_optimizer.reader import CONFIG_SCHEMA
+from prebid_optimizer.reader import get_hour_window
+from prebid_optimizer.reader import get_parse_optimizerConfig
+from prebid_optimizer.session import get_default_session
+
+
+CREATE_TABLE_TEMPLATE = """
+CREATE TABLE IF NOT EXISTS `{aggregate_table}` (
+    configID STRING,
+    hour TIMESTAMP,
+    {config_columns},
+    num_trials INT64,
+    num_wins INT64,
+    sum_pubrev FLOAT64,
+    sum_log_pubrev FLOAT64,
+    sum_sq_log_pubrev FLOAT64
+)
+PARTITION BY TIMESTAMP_TRUNC(hour, HOUR)
+CLUSTER BY configID
+-- Hourly partitioned tables are limited to 4000 partitions
+OPTIONS (partition_expiration_days = {partition_expiration_days})
+"""
+
+LAST_HOUR_TEMPLATE = """
+SELECT MAX(hour) as last_hour FROM `{aggregate_table}`
+"""
+
+# Same filters and flattening as `reader.SQL_TEMPLATE`, for all configs
+AGGREGATE_TEMPLATE = """
+WITH
+adunit_table AS (
+    SELECT
+        receiptTimeMillis,
+        configID,
+        TIMESTAMP_TRUNC(receiptTimeMillis, HOUR) as hour,
+        {parse_optimizerConfig}
+        adUnits
+    FROM `{source_table}`
+    WHERE
+        receiptTimeMillis >= @start_time
+        AND receiptTimeMillis < @end_time
+        AND optimizerConfig IS NOT NULL
+        AND testCode = "ds_optimizer"
+        -- TODO: remove after page refresh is implemented
+        -- Ignoring sessions that lasted longer then 30 minutes (1800 secs)
+        -- Ignoring sessions without sessionSeconds
+        AND json_extract_scalar(optimizerConfig, "$.sessionSeconds") IS NOT NULL
+        AND IFNULL(cast(json_extract_scalar(optimizerConfig, "$.sessionSeconds") AS INT64), 10000) < 3600
+),
+flattened_table AS (
+    SELECT
+        receiptTimeMillis,
+        configID,
+        hour,
+        {config_fields},
+        adUnits.code as adunit_code,
+        IF(bidResponses.winner = true, microCPMUSD, 0) as cpm,
+    FROM
+        adunit_table adrequest,
+        adrequest.adunits,
+        adUnits.bidRequests
+    LEFT JOIN bidRequests.bidResponses
+),
+win_cpm_table AS (
+    SELECT
+        receiptTimeMillis,
+        configID,
+        hour,
+        adunit_code,
+        SUM(cpm) as pubrev,
+        {config_fields}
+    FROM flattened_table
+    GROUP BY 1,2,3,4, {config_fields}
+)
+SELECT
+    configID,
+    hour,
+    {config_fields},
+    COUNT(*) as num_trials,
+    COUNTIF(pubrev > 0) as num_wins,
+    SUM(pubrev) as sum_pubrev,
+    SUM(LN(pubrev + 1)) as sum_log_pubrev,
+    SUM(POW(LN(pubrev + 1), 2)) as sum_sq_log_pubrev
+FROM win_cpm_table
+GROUP BY configID, hour, {config_fields}
+"""
+
+
+def get_append_window(last_hour, end_timestamp, backfill_hours):
+    """ Returns the (start, end) of the hours that still have to be appended,
+    or None if the table is up to date. If the table is empty, the last
+    `backfill_hours` hours are aggregated. """
+    if last_hour is None:
+        start_timestamp = end_timestamp - timedelta(hours=backfill_hours)
+    else:
+        start_timestamp = last_hour + timedelta(hours=1)
+
+    if start_timestamp >= end_timestamp:
+        return None
+
+    return start_timestamp, end_timestamp
+
+
+def updateAggregateTable(source_table, aggregate_table, run_timestamp,
+                         data_delay_hour, backfill_hours=24 * 7,
+                         partition_expiration_days=90, client=None):
+    """ Appends the complete hours that are not yet in aggregate_table.
+    Hours are considered complete `data_delay_hour` hours after they end. """
+    from google.cloud import bigquery
+
+    client = client or get_default_session().bigquery
+    config_fields = ", ".join(CONFIG_SCHEMA)
+    config_columns = ",\n    ".join(f"{field_name} {field_type}" for
+                                    field_name, field_type in
+                                    CONFIG_SCHEMA.items())
+
+    client.query(CREATE_TABLE_TEMPLATE.format(
+        aggregate_table=aggregate_table,
+        config_columns=config_columns,
+        partition_expiration_days=partition_expiration_days)).result()
+
+    rows = client.query(LAST_HOUR_TEMPLATE.format(
+        aggregate_table=aggregate_table)).result()
+    last_hour = next(iter(rows)).last_hour
+    if last_hour is not None:
+        last_hour = last_hour.replace(tzinfo=None)
+
+    end_timestamp = round_to_hour(run_timestamp) \
+                        - timedelta(hours=data_delay_hour)
+    window = get_append_window(last_hour, end_timestamp, backfill_hours)
+    if window is None:
+        print(f"{aggregate_table} is up to date (last hour: {last_hour})")
+        return 0
+
+    start_timestamp, end_timestamp = window
+    num_hours = get_hour_window(start_timestamp, end_timestamp)
+    print(f"Aggregating {num_hours} hours into {aggregate_table}: "
+          f"{start_timestamp} - {end_timestamp}")
+
+    sql = AGGREGATE_TEMPLATE.format(
+        source_table=source_table,
+        parse_optimizerConfig=get_parse_optimizerConfig(CONFIG_SCHEMA),
+        config_fields=config_fields,
+    )
+    job_config = bigquery.QueryJobConfig(
+        destination=aggregate_table,
+        write_disposition="WRITE_APPEND",
+        query_parameters=[
+            bigquery.ScalarQueryParameter("start_time", "TIMESTAMP", 
+                                          start_timestamp),
+            bigquery.ScalarQueryParameter("end_time", "TIMESTAMP",
+                                          end_timestamp),
+        ],
+    )
+    client.query(sql, job_config=job_config).result()
+
+    return num_hours
@@ -0,0 +1,66 @@
+"""
+Checkpoints of multi-config runs. The checkpoint of a run records the
+configs that completed (with the status and hash of their distributions),
+so that a rerun of the same run after a crash or a pre-emption skips them
+and only processes the remaining configs.
+
+A run is identified by its run timestamp rounded to the hour, so retrying
+within the same hour resumes the run. Checkpoints are small JSON files kept
+in a local directory or under a gs://bucket/prefix (which survives the loss
+of a pre-emptible node).
+"""
+
+from datetime import datetime
+import json
+import os
+
+from prebid_optimizer import round_to_hour
+from prebid_optimizer.session import get_default_session
+from prebid_optimizer.utils import read_text
+from prebid_optimizer.utils import write_text
+
+
+class RunCheckpoint:
+    def __init__(self, checkpoint_dir, run_timestamp, storage_client=None):
+        run_hour = round_to_hour(run_timestamp).strftime("%Y%m%d%H")
+        self.path = os.path.join(checkpoint_dir, f"run-{run_hour}.json")
+        self.run_timestamp = run_timestamp
+        self._storage_client = storage_client
+
+        self.configs = self._load()
+        print(f"Loaded checkpoint {self.path}: "
+              f"{len(self.configs)} configs already completed")
+
+    @property
+    def storage_client(self):
+        """ Only created (once) for gs:// checkpoints """
+        if self._storage_client is None and self.path.startswith("gs://"):
+            self._storage_client = get_default_session().storage
+
+        return self._storage_client
+
+    def _load(self):
+        data = read_text(self.path, self.storage_client)
+        return json.loads(data)["configs"] if data else {}
+
+    def save(self):
+        data = json.dumps({
+            "run_timestamp": str(self.run_timestamp),
+            "configs": self.configs,
+        }, indent=2)
+        write_text(self.path, data, self.storage_client)
+
+    def is_complete(self, config_id):
+        return config_id in self.configs
+
+    def get_remaining(self, config_ids):
+        return [config_id for config_id in config_ids
+                if not self.is_complete(config_id)]
+
+    def mark_complete(self, config_id, status, distributions_hash):
+        self.configs[config_id] = {
+            "status": status,
+            "distributions_hash": distributions_hash,
+            "completed_at": str(datetime.utcnow()),
+        }
+        self.save()
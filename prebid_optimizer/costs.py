@@ -0,0 +1,102 @@
+"""
+History of the runtime and data volume (number of rows read) of every
+config, used to predict the cost of each config in the next run so that the
+most expensive configs are started first (or spread across shards) instead
+of a few large configs starting last and setting the duration of the whole
+run.
+
+The runtime of a config with only a few runs is noisy (cold caches, a slow
+query), so until it has MIN_RUNS runs its cost is predicted from its number
+of rows and the runtime per row of the configs with enough history.
+
+The history is a small JSON file kept in a local directory or in GCS. Each
+entry holds exponentially weighted moving averages, so a config whose data
+volume changes is re-estimated within a few runs.
+"""
+
+import json
+
+from prebid_optimizer.utils import read_text
+from prebid_optimizer.utils import write_text
+
+
+# Weight of the latest run in the moving averages
+SMOOTHING = 0.3
+
+# Runs after which the runtime of a config is trusted over its rows
+MIN_RUNS = 3
+
+
+def get_num_rows(results):
+    """ Number of rows (requests) the config's statistics were read from """
+    return results.get("num_rows") or 0
+
+
+class CostHistory:
+    def __init__(self, path, storage_client=None, smoothing=SMOOTHING):
+        self.path = path
+        self.smoothing = smoothing
+        self._storage_client = storage_client
+
+        data = read_text(path, storage_client)
+        self.entries = json.loads(data) if data else {}
+
+    def update(self, config_id, seconds, num_rows):
+        entry = self.entries.get(config_id)
+        if entry is None:
+            self.entries[config_id] = {
+                "seconds": seconds,
+                "num_rows": num_rows,
+                "num_runs": 1,
+            }
+            return
+
+        alpha = self.smoothing
+        entry["seconds"] = alpha * seconds + (1 - alpha) * entry["seconds"]
+        entry["num_rows"] = alpha * num_rows \
+                            + (1 - alpha) * entry["num_rows"]
+        entry["num_runs"] += 1
+
+    def update_from_results(self, config_id, results):
+        self.update(config_id, results["runtime_seconds"],
+                    get_num_rows(results))
+
+    def get_seconds_per_row(self):
+        """ Runtime per row of the configs with at least MIN_RUNS runs, None
+        if there are none """
+        entries = [entry for entry in self.entries.values()
+                   if entry["num_runs"] >= MIN_RUNS and entry["num_rows"]]
+        if not entries:
+            return None
+
+        return sum(entry["seconds"] for entry in entries) \
+                / sum(entry["num_rows"] for entry in entries)
+
+    def predict_seconds(self, config_id, seconds_per_row=None):
+        entry = self.entries[config_id]
+        if entry["num_runs"] >= MIN_RUNS or seconds_per_row is None \
+                or not entry["num_rows"]:
+            return entry["seconds"]
+
+        return entry["num_rows"] * seconds_per_row
+
+    def get_costs(self, config_ids):
+        """ Returns {config_id: predicted seconds}. Configs without history
+        are predicted to be as expensive as the most expensive known config,
+        so they are started early rather than risk finishing last. """
+        seconds_per_row = self.get_seconds_per_row()
+        known = {config_id: self.predict_seconds(config_id, seconds_per_row)
+                 for config_id in config_ids if config_id in self.entries}
+        default_cost = max(known.values()) if known else 1
+
+        return {config_id: known.get(config_id, default_cost)
+                for config_id in config_ids}
+
+    def order_longest_first(self, config_ids):
+        costs = self.get_costs(config_ids)
+        # sorted is stable, equal costs keep their order
+        return sorted(config_ids, key=lambda c: -costs[c])
+
+    def save(self):
+        write_text(self.path, json.dumps(self.entries, indent=2),
+                   self._storage_client)
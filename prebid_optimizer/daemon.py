@@ -0,0 +1,144 @@
+"""
+Long-running scheduler for the optimizer. Instead of paying interpreter
+start-up, imports and client authentication on every hourly invocation, the
+daemon stays resident and triggers runs:
+- on an internal schedule (every `interval_minutes`, aligned to the hour)
+- when it receives SIGUSR1
+- when `trigger_file` shows up on disk (the file is removed once consumed)
+- or, instead of the schedule, as soon as the watermark of a config moves
+  to a new complete hour (see `prebid_optimizer.watermark`)
+"""
+
+from datetime import datetime, timedelta
+import os
+import signal
+import time
+
+
+def get_next_run_time(now, interval_minutes=60, offset_minutes=0):
+    """ Returns the first schedule boundary strictly after `now`. Boundaries
+    are aligned to midnight, e.g. interval_minutes=60, offset_minutes=5 runs
+    at 00:05, 01:05, 02:05, ... """
+    midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    interval = timedelta(minutes=interval_minutes)
+    next_run = midnight + timedelta(minutes=offset_minutes % interval_minutes)
+    while next_run <= now:
+        next_run += interval
+
+    return next_run
+
+
+class OptimizerDaemon:
+    def __init__(self, run_func, interval_minutes=60, offset_minutes=0,
+                 trigger_file=None, poll_seconds=5, max_runs=None,
+                 run_on_start=False, watermark_trigger=None,
+                 watermark_poll_seconds=60):
+        self.run_func = run_func
+        self.interval_minutes = interval_minutes
+        self.offset_minutes = offset_minutes
+        self.trigger_file = trigger_file
+        self.poll_seconds = poll_seconds
+        self.max_runs = max_runs
+        self.run_on_start = run_on_start
+        # If set (a watermark.WatermarkTrigger), replaces the schedule
+        self.watermark_trigger = watermark_trigger
+        self.watermark_poll_seconds = watermark_poll_seconds
+
+        self.num_runs = 0
+        self._triggered = False
+        self._stopped = False
+
+    def trigger(self, *args):
+        """ Requests a run as soon as possible (also the SIGUSR1 handler) """
+        self._triggered = True
+
+    def stop(self, *args):
+        """ Stops the daemon after the current run (SIGTERM/SIGINT handler) """
+        print("Stopping optimizer daemon..")
+        self._stopped = True
+
+    def install_signal_handlers(self):
+        signal.signal(signal.SIGUSR1, self.trigger)
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+    def _consume_trigger_file(self):
+        if self.trigger_file and os.path.exists(self.trigger_file):
+            os.remove(self.trigger_file)
+            return True
+
+        return False
+
+    def _poll_watermark(self):
+        try:
+            return self.watermark_trigger.poll(datetime.utcnow())
+        except Exception as e:
+            # Keep polling, the source may be temporarily unavailable
+            print(f"Could not read the watermarks: {e!r}")
+            return False
+
+    def wait_for_watermark(self):
+        """ Blocks until a config has a new complete hour or an external
+        trigger. Returns False if the daemon was stopped while waiting. """
+        next_poll = datetime.utcnow()
+        while not self._stopped:
+            if self._triggered or self._consume_trigger_file():
+                print("Run triggered externally")
+                self._triggered = False
+                return True
+
+            if datetime.utcnow() >= next_poll:
+                if self._poll_watermark():
+                    return True
+                next_poll = datetime.utcnow() \
+                    + timedelta(seconds=self.watermark_poll_seconds)
+
+            remaining = (next_poll - datetime.utcnow()).total_seconds()
+            time.sleep(max(min(self.poll_seconds, remaining), 0))
+
+        return False
+
+    def wait_for_trigger(self):
+        """ Blocks until the next scheduled run or an external trigger.
+        Returns False if the daemon was stopped while waiting. """
+        next_run = get_next_run_time(datetime.utcnow(), self.interval_minutes,
+                                     self.offset_minutes)
+        print(f"Next scheduled run at {next_run}")
+
+        while not self._stopped:
+            if self._triggered or self._consume_trigger_file():
+                print("Run triggered externally")
+                self._triggered = False
+                return True
+
+            remaining = (next_run - datetime.utcnow()).total_seconds()
+            if remaining <= 0:
+                return True
+
+            time.sleep(min(self.poll_seconds, remaining))
+
+        return False
+
+    def run(self):
+        if self.run_on_start:
+            self._triggered = True
+
+        while not self._stopped:
+            if self.max_runs is not None and self.num_runs >= self.max_runs:
+                break
+
+            wait = self.wait_for_watermark if self.watermark_trigger \
+                    else self.wait_for_trigger
+            if not wait():
+                break
+
+            run_timestamp = datetime.utcnow()
+            print(f"Starting run #{self.num_runs + 1} at {run_timestamp}")
+            try:
+                self.run_func(run_timestamp)
+            except Exception as e:
+                # Keep the daemon alive, the next run will retry
+                print(f"Run failed: {e!r}")
+            self.num_runs += 1
+
+        print(f"Optimizer daemon exited after {self.num_runs} runs")
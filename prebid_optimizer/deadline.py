@@ -0,0 +1,41 @@
+"""
+Per-config time budget. The reader and the optimizer check the deadline
+between their steps (and bound the wait for BigQuery, the download of the
+rows and every iteration of the Gamma fit by it), and raise
+DeadlineExceeded once it has passed, so a slow query or fit makes the config
+fall back to a default (or its last published) distribution instead of
+stalling the whole run.
+"""
+
+import time
+
+
+class DeadlineExceeded(Exception):
+    def __init__(self, stage, seconds):
+        self.stage = stage
+        self.seconds = seconds
+        super().__init__(f"Deadline of {seconds:0.1f}s exceeded in {stage}")
+
+
+class Deadline:
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self._expires_at = time.monotonic() + seconds
+
+    def pause(self):
+        """ Stops the clock, e.g. while a config waits for the next stage of
+        the pipeline """
+        self._paused_at = time.monotonic()
+
+    def resume(self):
+        self._expires_at += time.monotonic() - self._paused_at
+
+    def remaining(self):
+        return max(self._expires_at - time.monotonic(), 0)
+
+    def expired(self):
+        return self.remaining() == 0
+
+    def check(self, stage):
+        if self.expired():
+            raise DeadlineExceeded(stage, self.seconds)
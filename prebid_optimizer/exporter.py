@@ -1,14 +1,19 @@
-from google.cloud import bigquery
-
+import hashlib
 import json
 import os
 import subprocess
 import tempfile
 
+from prebid_optimizer.sampling import get_sampling
+from prebid_optimizer.sampling import get_version
+from prebid_optimizer.session import get_default_session
 from prebid_optimizer.utils import upload_blob
 
 DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
 
+# Metadata key of the published blobs holding the hash of the distributions
+HASH_METADATA_KEY = "distributions_hash"
+
 
 SCHEMA = [
     {
@@ -31,6 +36,58 @@ SCHEMA = [
         "type": "TIMESTAMP",
         "mode": "NULLABLE"
     },
+    {
+        "name": "status",
+        "type": "STRING",
+        "mode": "NULLABLE"
+    },
+    {
+        "name": "query_metrics",
+        "type": "RECORD",
+        "mode": "REPEATED",
+        "fields": [
+            {
+                "name": "dry_run_bytes",
+                "type": "INT64",
+                "mode": "NULLABLE"
+            },
+            {
+                "name": "total_bytes_processed",
+                "type": "INT64",
+                "mode": "NULLABLE"
+            },
+            {
+                "name": "total_bytes_billed",
+                "type": "INT64",
+                "mode": "NULLABLE"
+            },
+            {
+                "name": "cache_hit",
+                "type": "BOOL",
+                "mode": "NULLABLE"
+            },
+            {
+                "name": "slot_millis",
+                "type": "INT64",
+                "mode": "NULLABLE"
+            },
+            {
+                "name": "elapsed_seconds",
+                "type": "FLOAT",
+                "mode": "NULLABLE"
+            }
+        ]
+    },
+    {
+        "name": "runtime_seconds",
+        "type": "FLOAT",
+        "mode": "NULLABLE"
+    },
+    {
+        "name": "num_rows",
+        "type": "INT64",
+        "mode": "NULLABLE"
+    },
     {
         "name": "actions",
         "type": "RECORD",
@@ -78,7 +135,8 @@ SCHEMA = [
 ]
 
 
-def exportJSON(results, gcs_bucket, config_id):
+def get_distributions(results):
+    """ Returns the part of the results that is published to the clients """
     # FIXME: Have a more systematic way to do this
     distributions = {"actions": []}
     for entry in results["actions"]:
@@ -88,40 +146,192 @@ def exportJSON(results, gcs_bucket, config_id):
 
         distributions["actions"].append(result)
 
+    # Lets clients pick an action in constant time and cache by version
+    distributions["version"] = get_version(distributions["actions"])
+    distributions["sampling"] = get_sampling(
+        [action["prob_to_win"] for action in distributions["actions"]])
+
+    return distributions
+
+
+def get_published_distributions(gcs_bucket, config_id, storage_client=None):
+    """ Returns the distributions currently published for the config, or None
+    if nothing was published yet """
+    if storage_client is None:
+        storage_client = get_default_session().storage
+
+    blob_full_path = os.path.join(config_id, "distributions.json")
+    blob = storage_client.bucket(gcs_bucket).get_blob(blob_full_path)
+    return json.loads(blob.download_as_text()) if blob else None
+
+
+def hash_distributions(distributions):
+    distributions_str = json.dumps(distributions, sort_keys=True)
+    return hashlib.sha256(distributions_str.encode("utf-8")).hexdigest()
+
+
+class ExportManifest:
+    """ Keeps the hash (and GCS generation) of the last distributions
+    published for every config, so unchanged distributions are not
+    uploaded again. The manifest is kept in memory (e.g. by the daemon) and
+    optionally persisted to a local JSON file. """
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = {}
+        # Skipped GCS uploads and BQ rows, each counted once per config
+        self.num_skipped_writes = 0
+        self.num_skipped_bq_rows = 0
+
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def get(self, config_id):
+        return self.entries.get(config_id)
+
+    def has_changed(self, config_id, distributions):
+        entry = self.get(config_id)
+        return entry is None \
+                or entry["hash"] != hash_distributions(distributions)
+
+    def update(self, config_id, distributions_hash, generation):
+        self.entries[config_id] = {
+            "hash": distributions_hash,
+            "generation": generation,
+        }
+
+    def save(self):
+        if not self.path:
+            return
+
+        # Write to a temporary file first so a crash never leaves a 
+        # truncated manifest behind
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.entries, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+def exportJSON(results, gcs_bucket, config_id, storage_client=None,
+               manifest=None):
+    """ Uploads the distributions to gs://{gcs_bucket}/{config_id}/.
+    If a manifest is given, unchanged distributions are not uploaded and
+    uploads are conditional on the generation of the last published blob.
+    Returns False if the upload was skipped. """
+    distributions = get_distributions(results)
+
     print(json.dumps(distributions, indent=2))
 
     distributions_str = json.dumps(distributions)
 
     # use config_id as blob_path
     blob_path = config_id
-    _create_and_upload_file_to_gcs("distributions.json", gcs_bucket, blob_path, distributions_str)
+    if manifest is None:
+        _create_and_upload_file_to_gcs("distributions.json", gcs_bucket, 
+                                       blob_path, distributions_str, 
+                                       storage_client)
+        return True
+
+    return _publish_if_changed("distributions.json", gcs_bucket, blob_path,
+                               distributions_str, 
+                               hash_distributions(distributions), config_id,
+                               manifest, storage_client)
+
+
+def _publish_if_changed(file_name, gcs_bucket, blob_path, data, 
+                        distributions_hash, config_id, manifest,
+                        storage_client=None):
+    from google.api_core.exceptions import PreconditionFailed
 
+    entry = manifest.get(config_id)
+    if entry and entry["hash"] == distributions_hash:
+        print(f"Distributions of {config_id} unchanged, skipping upload")
+        manifest.num_skipped_writes += 1
+        return False
 
-def _create_and_upload_file_to_gcs(file_name, gcs_bucket, blob_path, data):
+    if storage_client is None:
+        storage_client = get_default_session().storage
+
+    bucket = storage_client.bucket(gcs_bucket)
+    blob_full_path = os.path.join(blob_path, file_name)
+
+    # Generation 0 means "only if the blob does not exist yet"
+    generation = entry["generation"] if entry else None
+    for _ in range(2):
+        if generation is None:
+            published = bucket.get_blob(blob_full_path)
+            generation = published.generation if published else 0
+            if published and (published.metadata or {}).get(
+                    HASH_METADATA_KEY) == distributions_hash:
+                # Already published, e.g. by a concurrent run
+                print(f"Distributions of {config_id} already published, "
+                      f"skipping upload")
+                manifest.update(config_id, distributions_hash, generation)
+                manifest.num_skipped_writes += 1
+                return False
+
+        blob = bucket.blob(blob_full_path)
+        blob.metadata = {HASH_METADATA_KEY: distributions_hash}
+        try:
+            blob.upload_from_string(data, content_type="application/json",
+                                    if_generation_match=generation)
+        except PreconditionFailed:
+            # Another run published since we last looked, check again
+            print(f"gs://{gcs_bucket}/{blob_full_path} changed concurrently")
+            generation = None
+            continue
+
+        print(f"Uploaded gs://{gcs_bucket}/{blob_full_path} "
+              f"(generation {blob.generation})")
+        manifest.update(config_id, distributions_hash, blob.generation)
+        return True
+
+    raise RuntimeError(f"Could not publish gs://{gcs_bucket}/"
+                       f"{blob_full_path}, it keeps changing concurrently")
+
+
+def _create_and_upload_file_to_gcs(file_name, gcs_bucket, blob_path, data,
+                                   storage_client=None):
     with tempfile.TemporaryDirectory() as tmpdir:
         filepath = os.path.join(tmpdir, file_name)
         with open(filepath, "w") as js:
             js.write(data)
 
         blob_full_path = os.path.join(blob_path, file_name)
-        upload_blob(gcs_bucket, filepath, blob_full_path)
+        upload_blob(gcs_bucket, filepath, blob_full_path, storage_client)
 
 
-def exportBQTable(results, bundleID, run_timestamp, start_timestamp, 
-                  end_timestamp, bq_table_id):
-    # Add fields
+def _add_bq_fields(results, bundleID, run_timestamp, start_timestamp,
+                   end_timestamp):
     results["bundleID"] = bundleID
     results["run_timestamp"] = run_timestamp.strftime(DATETIME_FORMAT)
     results["start_timestamp"] = start_timestamp.strftime(DATETIME_FORMAT)
     results["end_timestamp"] = end_timestamp.strftime(DATETIME_FORMAT)
 
-    client = bigquery.Client()
-    job_config = bigquery.LoadJobConfig(
+
+def get_load_job_config():
+    from google.cloud import bigquery
+
+    return bigquery.LoadJobConfig(
         schema=SCHEMA,
         source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
-        write_disposition="WRITE_APPEND"
+        write_disposition="WRITE_APPEND",
+        # New (nullable) fields are added to the existing output table
+        schema_update_options=[
+            bigquery.SchemaUpdateOption.ALLOW_FIELD_ADDITION
+        ]
     )
 
+
+def exportBQTable(results, bundleID, run_timestamp, start_timestamp, 
+                  end_timestamp, bq_table_id, client=None):
+    # Add fields
+    _add_bq_fields(results, bundleID, run_timestamp, start_timestamp,
+                   end_timestamp)
+
+    client = client or get_default_session().bigquery
+    job_config = get_load_job_config()
+
     with tempfile.TemporaryDirectory() as tmpdir:
         filepath = os.path.join(tmpdir, "output.json")
         with open(filepath, "w") as f:
@@ -132,3 +342,14 @@ def exportBQTable(results, bundleID, run_timestamp, start_timestamp,
                                                    job_config=job_config)
 
     load_job.result()  # Waits for the job to complete.
+
+
+def stageBQRow(results, bundleID, run_timestamp, start_timestamp,
+               end_timestamp, gcs_bucket, blob_path, storage_client=None):
+    """ Uploads the BQ row to gs://{gcs_bucket}/{blob_path}/{bundleID}.json
+    instead of appending it to the table (see sharding.mergeShardedRun) """
+    _add_bq_fields(results, bundleID, run_timestamp, start_timestamp,
+                   end_timestamp)
+
+    _create_and_upload_file_to_gcs(f"{bundleID}.json", gcs_bucket, blob_path,
+                                   json.dumps(results), storage_client)
@@ -0,0 +1,132 @@
+"""
+End-to-end load test of a run: synthetic auctions for N configs are written
+to the local BigQuery stand-in (local_bigquery.py), the optimizer runs on
+them through the local BigQuery and GCS stand-ins, with injected latency
+and throughput, and the report gives the numbers to size a deployment:
+- throughput in configs per minute
+- latency percentiles of every stage of the run (read/optimize/export per
+  config, and every BigQuery and GCS request)
+- peak memory of the process
+
+Config volumes are drawn from a lognormal distribution, so that, like in
+production, a few large configs dominate the run.
+"""
+
+import resource
+import sys
+import threading
+
+import numpy as np
+
+
+PERCENTILES = [50, 90, 99]
+
+# Win rate range of the synthetic actions
+MIN_WIN_RATE = 0.02
+MAX_WIN_RATE = 0.3
+
+
+def generate_auctions(rng, config_combos, start_timestamp, hour_window,
+                      rows_per_hour, num_adunits=10):
+    """ Raw auctions (one row per ad unit) of a config, every action with its
+    own win rate, in the layout of local_bigquery.write_auctions """
+    import pandas as pd
+
+    num_rows = int(hour_window * rows_per_hour)
+    action = rng.integers(0, len(config_combos), num_rows)
+    win_rates = rng.uniform(MIN_WIN_RATE, MAX_WIN_RATE, len(config_combos))
+    win = rng.random(num_rows) < win_rates[action]
+    offsets = rng.integers(0, hour_window * 3600, num_rows)
+
+    df = pd.DataFrame({
+        "receipt_time": pd.Timestamp(start_timestamp)
+                        + pd.to_timedelta(offsets, unit="s"),
+    })
+    for field in sorted(config_combos[0]):
+        values = np.array([combo[field] for combo in config_combos])
+        df[field] = values[action]
+    df["adunit_code"] = np.char.add(
+        "adunit-", rng.integers(0, num_adunits, num_rows).astype(str))
+    df["pubrev"] = np.where(win, rng.lognormal(11, 1, num_rows), 0)
+
+    return df
+
+
+def generate_traffic(root, source_table, configs, start_timestamp,
+                     hour_window, rows_per_hour, volume_sigma=1.0, seed=0):
+    """ Writes the auctions of every (config_id, configs_to_optimize) in
+    configs. rows_per_hour is the median volume of a config. Returns the
+    number of rows written. """
+    from prebid_optimizer.local_bigquery import write_auctions
+    from prebid_optimizer.optimizer import get_config_combos
+
+    rng = np.random.default_rng(seed)
+    num_rows = 0
+    for config_id, configs_to_optimize in configs:
+        config_rows_per_hour = rows_per_hour \
+                               * rng.lognormal(0, volume_sigma)
+        df = generate_auctions(rng, get_config_combos(configs_to_optimize),
+                               start_timestamp, hour_window,
+                               config_rows_per_hour)
+        write_auctions(root, source_table, config_id, df)
+        num_rows += len(df)
+
+    return num_rows
+
+
+class LatencyRecorder:
+    """ Collects the seconds of every occurrence of each stage, from any
+    thread """
+    def __init__(self):
+        self.seconds = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        with self._lock:
+            self.seconds.setdefault(stage, []).append(seconds)
+
+    def get_summary(self):
+        with self._lock:
+            return {stage: get_percentiles(seconds)
+                    for stage, seconds in sorted(self.seconds.items())}
+
+
+def get_percentiles(values):
+    """ Count, percentiles and max of a list of seconds """
+    values = np.asarray(values, dtype=float)
+    if not len(values):
+        return {"count": 0}
+
+    summary = {"count": len(values)}
+    for percentile in PERCENTILES:
+        summary[f"p{percentile}"] = float(np.percentile(values, percentile))
+    summary["max"] = float(values.max())
+
+    return summary
+
+
+def get_peak_memory_mb():
+    """ Peak resident memory of the process so far """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+def get_report(run_metrics, recorder, num_rows, wall_seconds):
+    """ Summary of a load test run, from the run metrics of
+    cli._run_optimizer and the requests recorded by the stand-ins """
+    num_configs = sum(run_metrics["statuses"].values())
+    stages = {stage: get_percentiles(seconds) for stage, seconds
+              in run_metrics["stage_seconds"].items()}
+    stages.update(recorder.get_summary())
+
+    return {
+        "num_configs": num_configs,
+        "num_rows": num_rows,
+        "wall_seconds": wall_seconds,
+        "configs_per_minute": 60 * num_configs / wall_seconds
+                              if wall_seconds else None,
+        "statuses": run_metrics["statuses"],
+        "stages": stages,
+        "peak_memory_mb": get_peak_memory_mb(),
+    }
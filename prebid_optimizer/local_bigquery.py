@@ -0,0 +1,200 @@
+"""
+Local stand-in for the subset of google.cloud.bigquery used by a run of the
+optimizer, backed by a directory (load tests, local testing):
+- the raw auctions of a config in the source table are the file
+  {root}/{source_table}/{config_id}.parquet, one row per (auction, ad unit)
+  with the columns receipt_time, the config fields, adunit_code and pubrev
+  (see write_auctions)
+- the reader's queries (reader.SQL_TEMPLATE and SEGMENT_SQL_TEMPLATE) are
+  recognized and answered from those files, any other query raises
+- rows loaded into a table are appended to {root}/{table_id}.jsonl
+
+Like on BigQuery, a query starts when it is submitted and its result is
+ready `latency_seconds` later, plus the time to return its rows at
+`rows_per_second`, so concurrent queries overlap. Dry runs return the
+number of bytes of the rows the query would read.
+"""
+
+import concurrent.futures
+import json
+import os
+import re
+import threading
+import time
+
+from prebid_optimizer.local_storage import wait_for_transfer
+from prebid_optimizer.stats import aggregate_stats
+
+
+TABLE_PATTERN = re.compile(r"FROM `([^`]+)`")
+CONFIG_FIELDS_PATTERN = re.compile(r"GROUP BY 1,2,3, (.+)$", re.MULTILINE)
+
+
+def get_auctions_path(root, source_table, config_id):
+    return os.path.join(root, source_table, f"{config_id}.parquet")
+
+
+def write_auctions(root, source_table, config_id, df):
+    """ Stores the raw auctions of a config, replacing the previous ones """
+    path = get_auctions_path(root, source_table, config_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    df.to_parquet(path, index=False)
+
+
+def _to_naive_utc(value):
+    """ The job config returns TIMESTAMP parameters as aware datetimes, the
+    stored receipt times are naive UTC """
+    import pandas as pd
+
+    timestamp = pd.Timestamp(value)
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.tz_convert("UTC").tz_localize(None)
+    return timestamp
+
+
+def get_query_kind(sql_query):
+    if "FROM win_cpm_table" not in sql_query:
+        return None
+    if "adunit_code as segment" in sql_query:
+        return "segments"
+    return "rows"
+
+
+class LocalQueryJob:
+    def __init__(self, df, submitted_at, ready_at, dry_run=False,
+                 recorder=None):
+        self._df = df
+        self._submitted_at = submitted_at
+        self._ready_at = ready_at
+        self._recorder = recorder
+        self._cancelled = False
+
+        num_bytes = int(df.memory_usage(index=False).sum())
+        self.total_bytes_processed = num_bytes
+        self.total_bytes_billed = 0 if dry_run else num_bytes
+        self.cache_hit = False
+        self.slot_millis = None
+
+    def result(self, timeout=None):
+        remaining = self._ready_at - time.perf_counter()
+        if timeout is not None and remaining > timeout:
+            time.sleep(max(timeout, 0))
+            raise concurrent.futures.TimeoutError()
+        if remaining > 0:
+            time.sleep(remaining)
+
+        if self._recorder is not None:
+            self._recorder.record("bq_query",
+                                  time.perf_counter() - self._submitted_at)
+            # Waiting on the job again is not another query
+            self._recorder = None
+        return self
+
+    def cancel(self):
+        self._cancelled = True
+
+    def to_dataframe(self, bqstorage_client=None):
+        return self._df
+
+
+class LocalLoadJob:
+    def result(self):
+        return self
+
+
+class LocalBigQueryClient:
+    def __init__(self, root, latency_seconds=0, rows_per_second=None,
+                 recorder=None):
+        self.root = root
+        self.latency_seconds = latency_seconds
+        self.rows_per_second = rows_per_second
+        # Records the seconds of every query and load (see loadtest.py)
+        self.recorder = recorder
+
+        self._lock = threading.Lock()
+
+    def _read_auctions(self, source_table, config_id, start_time, end_time):
+        import pandas as pd
+
+        path = get_auctions_path(self.root, source_table, config_id)
+        if not os.path.exists(path):
+            return None
+
+        start_time = _to_naive_utc(start_time)
+        end_time = _to_naive_utc(end_time)
+        df = pd.read_parquet(path)
+        df = df[(df["receipt_time"] >= start_time)
+                & (df["receipt_time"] < end_time)]
+        return df.assign(auction_hour=(df["receipt_time"] - start_time)
+                                      // pd.Timedelta(hours=1))
+
+    def _run_query(self, sql_query, parameters):
+        import pandas as pd
+
+        kind = get_query_kind(sql_query)
+        if kind is None:
+            raise ValueError("Query not supported by the local BigQuery "
+                             "stand-in")
+
+        source_table = TABLE_PATTERN.search(sql_query).group(1)
+        config_fields = [field.strip() for field in CONFIG_FIELDS_PATTERN
+                         .search(sql_query).group(1).split(",")]
+        df = self._read_auctions(source_table, parameters["config_id"],
+                                 parameters["start_time"],
+                                 parameters["end_time"])
+
+        columns = ["auction_hour"] + config_fields + ["pubrev"]
+        if df is None:
+            df = pd.DataFrame({column: [] for column in columns})
+        df = df.assign(win=(df["pubrev"] > 0).astype("int64"))
+
+        if kind == "segments":
+            return aggregate_stats(
+                df.rename(columns={"adunit_code": "segment"}),
+                ["auction_hour", "segment"] + config_fields)
+
+        return df[["auction_hour"] + config_fields + ["win", "pubrev"]] \
+                 .reset_index(drop=True)
+
+    def query(self, sql_query, job_config=None):
+        submitted_at = time.perf_counter()
+        parameters = {parameter.name: parameter.value for parameter
+                      in getattr(job_config, "query_parameters", None) or []}
+        dry_run = bool(getattr(job_config, "dry_run", False))
+
+        df = self._run_query(sql_query, parameters)
+        # The rows are only returned by queries that actually run
+        transfer_seconds = 0 if dry_run or not self.rows_per_second \
+                             else len(df) / self.rows_per_second
+        return LocalQueryJob(df, submitted_at,
+                             submitted_at + self.latency_seconds
+                             + transfer_seconds, dry_run,
+                             recorder=None if dry_run else self.recorder)
+
+    def load_table_from_file(self, file_obj, table_id, job_config=None):
+        data = file_obj.read()
+        if isinstance(data, bytes):
+            data = data.decode("utf-8")
+        rows = [json.loads(line) for line in data.splitlines() if line]
+
+        start_time = time.perf_counter()
+        wait_for_transfer(self.latency_seconds)
+
+        path = os.path.join(self.root, f"{table_id}.jsonl")
+        with self._lock:
+            os.makedirs(self.root, exist_ok=True)
+            with open(path, "a") as f:
+                f.writelines(json.dumps(row) + "\n" for row in rows)
+
+        if self.recorder is not None:
+            self.recorder.record("bq_load", time.perf_counter() - start_time)
+        return LocalLoadJob()
+
+    def read_table(self, table_id):
+        """ Returns the rows loaded into a table """
+        path = os.path.join(self.root, f"{table_id}.jsonl")
+        if not os.path.exists(path):
+            return []
+
+        with open(path) as f:
+            return [json.loads(line) for line in f]
@@ -0,0 +1,156 @@
+"""
+Local stand-in for the subset of google.cloud.storage used by the package,
+backed by a directory: blob gs://{bucket}/{name} is the file
+{root}/{bucket}/{name}. It lets the exporter, the sharded merge and the
+server run without GCS (local testing, load tests).
+
+The generation of a blob is a counter incremented by every write, kept in
+the file {name}.generation next to it so that a client in another process
+(e.g. the server) sees it too. Modification times are not used: two writes
+within the timestamp granularity of the filesystem would get the same
+generation. Blob metadata is only kept in memory, by the client.
+
+For load tests, every request can be delayed by `latency_seconds` plus the
+time to transfer its bytes at `bytes_per_second`, and the time spent in
+each kind of request is recorded by `recorder` (see loadtest.py).
+"""
+
+import os
+import threading
+import time
+
+
+GENERATION_SUFFIX = ".generation"
+
+
+def wait_for_transfer(latency_seconds, size=0, rate=None):
+    """ Sleeps for the latency plus the time to transfer `size` units at
+    `rate` units per second. Returns the number of seconds slept. """
+    seconds = latency_seconds + (size / rate if rate else 0)
+    if seconds > 0:
+        time.sleep(seconds)
+
+    return seconds
+
+
+class LocalBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.metadata = bucket.client.metadata.get((bucket.name, name))
+
+    @property
+    def path(self):
+        return os.path.join(self.bucket.path, self.name)
+
+    @property
+    def generation(self):
+        try:
+            with open(self.path + GENERATION_SUFFIX) as f:
+                return int(f.read())
+        except FileNotFoundError:
+            return None
+
+    def _replace(self, path, data):
+        # Readers never see a partially written file, like on GCS
+        tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _write(self, data, if_generation_match=None):
+        client = self.bucket.client
+        client.request("gcs_upload", len(data))
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        # Only atomic within a process
+        with client.lock:
+            generation = self.generation or 0
+            if if_generation_match is not None \
+                    and if_generation_match != generation:
+                from google.api_core.exceptions import PreconditionFailed
+                raise PreconditionFailed(f"{self.name}: generation mismatch")
+
+            self._replace(self.path, data)
+            # Written after the blob: a reader that sees the new generation
+            # also sees the new data
+            self._replace(self.path + GENERATION_SUFFIX,
+                          str(generation + 1).encode("utf-8"))
+            client.metadata[(self.bucket.name, self.name)] = self.metadata
+
+    def upload_from_string(self, data, content_type=None,
+                           if_generation_match=None):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self._write(data, if_generation_match)
+
+    def upload_from_filename(self, filename):
+        with open(filename, "rb") as f:
+            self._write(f.read())
+
+    def download_as_bytes(self):
+        with open(self.path, "rb") as f:
+            data = f.read()
+        self.bucket.client.request("gcs_download", len(data))
+
+        return data
+
+    def download_as_text(self):
+        return self.download_as_bytes().decode("utf-8")
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+
+class LocalBucket:
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self.path = os.path.join(client.root, name)
+
+    def blob(self, name):
+        return LocalBlob(self, name)
+
+    def get_blob(self, name):
+        self.client.request("gcs_get")
+        blob = LocalBlob(self, name)
+        return blob if blob.exists() else None
+
+    def list_blobs(self, prefix=None):
+        self.client.request("gcs_list")
+        blobs = []
+        for dir_path, _, file_names in os.walk(self.path):
+            for file_name in file_names:
+                name = os.path.relpath(os.path.join(dir_path, file_name),
+                                       self.path).replace(os.sep, "/")
+                if ".tmp-" in file_name \
+                        or file_name.endswith(GENERATION_SUFFIX) \
+                        or (prefix and not name.startswith(prefix)):
+                    continue
+                blobs.append(LocalBlob(self, name))
+
+        return sorted(blobs, key=lambda blob: blob.name)
+
+
+class LocalStorageClient:
+    def __init__(self, root, latency_seconds=0, bytes_per_second=None,
+                 recorder=None):
+        self.root = root
+        self.metadata = {}
+        self.lock = threading.Lock()
+        self.latency_seconds = latency_seconds
+        self.bytes_per_second = bytes_per_second
+        self.recorder = recorder
+
+    def request(self, kind, size=0):
+        """ Simulates the latency and transfer time of a request """
+        start_time = time.perf_counter()
+        wait_for_transfer(self.latency_seconds, size, self.bytes_per_second)
+        if self.recorder is not None:
+            self.recorder.record(kind, time.perf_counter() - start_time)
+
+    def bucket(self, name):
+        return LocalBucket(self, name)
+
+    def list_blobs(self, bucket_name, prefix=None):
+        return self.bucket(bucket_name).list_blobs(prefix)
@@ -8,13 +8,12 @@ import os
 import sys
 
 import numpy as np
-from scipy.special import gamma as gamma_func
-from scipy.stats import beta
-from scipy.stats import gamma
-from scipy.stats import norm
 
-import scipy.integrate as integrate
-import scipy.optimize as optimize
+from prebid_optimizer.stats import get_log_pubrev_moments
+from prebid_optimizer.stats import get_sufficient_stats
+
+# scipy is imported inside the methods that need it, so that importing the
+# package stays cheap (see `make bench.import`)
 
 
 def check_num_wins(df, min_num_wins):
@@ -22,6 +21,10 @@ def check_num_wins(df, min_num_wins):
     return num_wins > min_num_wins
 
 
+def check_num_wins_from_stats(stats, min_num_wins):
+    return stats["num_wins"] > min_num_wins
+
+
 class BetaLogNormalModel(object):
     """ Uses Beta distribution and Normal distribution to model
     conjugate priors of the win-rate and log of publisher revenue
@@ -32,31 +35,27 @@ class BetaLogNormalModel(object):
         self.epsilon = 1e-2
         self.min_num_wins = 5
     
-    def _get_beta_posterior_params(self, df):
+    def _get_beta_posterior_params(self, stats):
         a, b = 2, 2
         
-        num_wins = (df["pubrev"] > 0).sum()
-        num_requests = len(df)
+        num_wins = stats["num_wins"]
+        num_requests = stats["num_trials"]
         
         a = a + num_wins
         b = b + (num_requests - num_wins)
 
         return a, b
     
-    def _get_lognormal_posterior_params(self, df):
+    def _get_lognormal_posterior_params(self, stats):
         mu, v, a, b = 0, 0, 0, 0
         
-        wins = df[df["pubrev"] > 0]
-        log_pubrev = np.log(wins["pubrev"] + 1)
-        
         mu0 = np.log(1e5)
         v0 = 2
         a0 = v0 // 2
         b0 = 1
         
-        num_wins = len(wins)
-        log_pubrev_mean = log_pubrev.mean()
-        log_pubrev_std = log_pubrev.std()
+        num_wins = stats["num_wins"]
+        log_pubrev_mean, log_pubrev_std = get_log_pubrev_moments(stats)
         
         mu = (v0 * mu0 + num_wins * log_pubrev_mean) / (v0 + num_wins)
         v = v0 + num_wins
@@ -67,6 +66,8 @@ class BetaLogNormalModel(object):
         return mu, v, a, b
 
     def _get_beta_means(self, hyperparams, N):
+        from scipy.stats import beta
+
         a = hyperparams["beta_a"]
         b = hyperparams["beta_b"]
 
@@ -82,6 +83,9 @@ class BetaLogNormalModel(object):
         return means
     
     def _get_lognormal_means(self, hyperparams, N):
+        from scipy.stats import gamma
+        from scipy.stats import norm
+
         mu = hyperparams["mu"]
         v = hyperparams["v"]
         a = hyperparams["a"]
@@ -99,8 +103,12 @@ class BetaLogNormalModel(object):
         return means, (X, T)
     
     def get_posterior_hyperparams(self, df):
-        beta_a, beta_b = self._get_beta_posterior_params(df)
-        mu, v, a, b = self._get_lognormal_posterior_params(df)
+        return self.get_posterior_hyperparams_from_stats(
+            get_sufficient_stats(df))
+
+    def get_posterior_hyperparams_from_stats(self, stats):
+        beta_a, beta_b = self._get_beta_posterior_params(stats)
+        mu, v, a, b = self._get_lognormal_posterior_params(stats)
     
         hyperparams = {"beta_a": beta_a,  "beta_b": beta_b,  "mu": mu,  "v": v,  "a": a,  "b": b}        
         return hyperparams
@@ -115,14 +123,18 @@ class BetaLogNormalModel(object):
         return beta_means, lognormal_means
     
     def get_reward_distribution(self, df, N, global_mean):
+        return self.get_reward_distribution_from_stats(
+            get_sufficient_stats(df), N, global_mean)
+
+    def get_reward_distribution_from_stats(self, stats, N, global_mean):
         # Check number of wins
-        enough_wins = check_num_wins(df, self.min_num_wins)
+        enough_wins = check_num_wins_from_stats(stats, self.min_num_wins)
         # If not return array of small, positive random numbers
         if not enough_wins:
             print(f"Not enough wins (< {self.min_num_wins}), returning small, random reward array")
             return self.epsilon * np.random.random(N) - global_mean
         # Get hyperparameters
-        hyperparams = self.get_posterior_hyperparams(df)
+        hyperparams = self.get_posterior_hyperparams_from_stats(stats)
         # Get means
         beta_means, lognormal_means = self.get_posterior_means(hyperparams, N)
         # Combine means
@@ -132,12 +144,69 @@ class BetaLogNormalModel(object):
 
         return delta_means
 
+    def get_posterior_hyperparams_from_arrays(self, stats):
+        """ Vectorized get_posterior_hyperparams_from_stats, where stats is a
+        dict of arrays (of any, but the same, shape). Elements without enough
+        wins get placeholder lognormal hyperparameters, see "enough_wins". """
+        num_trials = stats["num_trials"]
+        num_wins = stats["num_wins"]
+        enough_wins = num_wins > self.min_num_wins
+        # Keeps the moments finite where they are not used
+        safe_wins = np.where(enough_wins, num_wins, 2)
+
+        log_pubrev_mean = stats["sum_log_pubrev"] / safe_wins
+        log_pubrev_var = np.maximum(
+            (stats["sum_sq_log_pubrev"] - safe_wins * log_pubrev_mean ** 2)
+            / (safe_wins - 1), 0)
+
+        mu0 = np.log(1e5)
+        v0 = 2
+        a0 = v0 // 2
+        b0 = 1
+
+        return {
+            "enough_wins": enough_wins,
+            "beta_a": 2 + num_wins,
+            "beta_b": 2 + (num_trials - num_wins),
+            "mu": (v0 * mu0 + safe_wins * log_pubrev_mean) / (v0 + safe_wins),
+            "v": v0 + safe_wins,
+            "a": a0 + safe_wins // 2,
+            "b": b0 + 0.5 * safe_wins * log_pubrev_var \
+                    + (safe_wins * v0) / (safe_wins + v0) \
+                    * ((log_pubrev_mean - mu0) ** 2 / 2),
+        }
+
+    def sample_rewards_from_hyperparams(self, hyperparams, global_mean):
+        """ Vectorized get_reward_distribution_from_stats: draws one reward
+        for every element of the hyperparameter arrays """
+        shape = hyperparams["enough_wins"].shape
+
+        beta_means = np.random.beta(hyperparams["beta_a"],
+                                    hyperparams["beta_b"])
+        T = np.random.gamma(hyperparams["a"], 1 / hyperparams["b"])
+        X = np.random.normal(hyperparams["mu"],
+                             np.sqrt(1 / (hyperparams["v"] * T)))
+        # The placeholder hyperparameters can overflow, but those means are
+        # replaced below
+        with np.errstate(over="ignore"):
+            means = beta_means * np.exp(X + 1 / (2 * T))
+
+        small_means = self.epsilon * np.random.random(shape)
+
+        return np.where(hyperparams["enough_wins"], means, small_means) \
+                - global_mean
+
 
 class GammaModel(object):
     """ Use a single model (conjugate prior) to model pubrev per request """
-    def __init__(self, alpha0, verbose=False):
+    def __init__(self, alpha0, verbose=False, max_iter=100):
         self.alpha0 = alpha0
         self.verbose = verbose
+        # Bounds the fixed point iteration of alpha, which does not always
+        # converge
+        self.max_iter = max_iter
+        # If set (a deadline.Deadline), checked at every iteration
+        self.deadline = None
         
         # Number of points to approximate the cdf
         self.cdf_resolution = 5000
@@ -148,15 +217,17 @@ class GammaModel(object):
     def pubrev_to_cpmusd(self, s):
         return (s + 1) / 1e6
 
-    def get_optimal_alpha(self, df, beta):
+    def get_optimal_alpha(self, stats, beta):
+        from scipy.special import gamma as gamma_func
+        import scipy.optimize as optimize
+
         a0 = 1
         b0 = 1
         c0 = 1
 
-        n = len(df)
-        cpm_usd = self.pubrev_to_cpmusd(df["pubrev"])
-        prod_x = cpm_usd.prod()
-        sum_log_x = np.log(cpm_usd).sum()
+        n = stats["num_trials"]
+        # log(cpm_usd) = log(pubrev + 1) - log(1e6)
+        sum_log_x = stats["sum_log_pubrev"] - n * np.log(1e6)
 
         b = b0 + n
         c = c0 + n
@@ -170,15 +241,19 @@ class GammaModel(object):
         return optimize.minimize(exponent, 0.05)["x"][0]            
     
     def get_posterior_hyperparams(self, df):
+        return self.get_posterior_hyperparams_from_stats(
+            get_sufficient_stats(df))
+
+    def get_posterior_hyperparams_from_stats(self, stats):
         a0, b0 = 2, 2
         alpha0 = self.alpha0
         
         if self.verbose:
             print("Starting alpha: ", alpha0)    
 
-        n = len(df)
-        cpm_usd = self.pubrev_to_cpmusd(df["pubrev"])
-        sum_x = cpm_usd.sum()
+        n = stats["num_trials"]
+        # cpm_usd = (pubrev + 1) / 1e6
+        sum_x = (stats["sum_pubrev"] + n) / 1e6
 
         diff = np.inf
         tol = 1e-5
@@ -187,11 +262,18 @@ class GammaModel(object):
 
         curr_alpha = alpha0
         while diff > tol:
+            if num_iteration >= self.max_iter:
+                print(f"alpha did not converge in {self.max_iter} "
+                      f"iterations (diff={diff:.2e})")
+                break
+            if self.deadline is not None:
+                self.deadline.check("fit")
+
             a = curr_alpha * n + a0
             b = b0 / (1 + b0 * sum_x)
 
             optimal_beta = (a-1) * b
-            curr_alpha = self.get_optimal_alpha(df, optimal_beta)
+            curr_alpha = self.get_optimal_alpha(stats, optimal_beta)
             if prev_alpha:
                 diff = np.abs(prev_alpha - curr_alpha)
 
@@ -207,6 +289,8 @@ class GammaModel(object):
         return hyperparams
 
     def get_pdf_func(self, hyperparams):
+        import scipy.optimize as optimize
+
         a, b = hyperparams["a"], hyperparams["b"]
 
         exponent = lambda beta: (a - 1) * np.log(beta * np.e / (a-1)) - beta / b - a * np.log(b)
@@ -220,6 +304,8 @@ class GammaModel(object):
         return pdf_func, beta_min, beta_max
 
     def test_pdf(self, pdf_func, xmin, xmax):
+        import scipy.integrate as integrate
+
         diff = np.abs(integrate.quad(pdf_func, xmin, xmax)[0] - 1)
         if diff > 5e-2:
             print(f"pdf does not integrate to 1: (diff={diff:.3f})")
@@ -250,15 +336,19 @@ class GammaModel(object):
         return random_betas
 
     def get_reward_distribution(self, df, N, global_mean):
+        return self.get_reward_distribution_from_stats(
+            get_sufficient_stats(df), N, global_mean)
+
+    def get_reward_distribution_from_stats(self, stats, N, global_mean):
         # Check number of wins
-        enough_wins = check_num_wins(df, self.min_num_wins)
+        enough_wins = check_num_wins_from_stats(stats, self.min_num_wins)
 
         # If not return array of small, positive random numbers
         if not enough_wins:
             print(f"Not enough wins (< {self.min_num_wins}), returning small, random reward array")
             return self.epsilon * np.random.random(N) - global_mean
 
-        hyperparams = self.get_posterior_hyperparams(df)
+        hyperparams = self.get_posterior_hyperparams_from_stats(stats)
 
         pdf_func, beta_min, beta_max = self.get_pdf_func(hyperparams)
         
@@ -1,14 +1,26 @@
+from datetime import timedelta
 import json
 
 import numpy as np
-import pandas as pd
-from scipy.stats import beta
-from scipy.stats import gamma
-from scipy.stats import norm
 
+from prebid_optimizer.deadline import DeadlineExceeded
+from prebid_optimizer.reader import QueryTooExpensiveError
 from prebid_optimizer.reader import TSReader
 from prebid_optimizer.models import BetaLogNormalModel
 from prebid_optimizer.models import GammaModel
+from prebid_optimizer.stats import get_log_pubrev_moments
+from prebid_optimizer.stats import sum_stats
+
+
+# Status of a run, exported along with the distributions
+STATUS_OK = "ok"
+STATUS_NOT_ENOUGH_DATA = "not_enough_data"
+# The query would have scanned more than the byte budget, the default
+# distribution was published instead
+STATUS_QUERY_OVER_BUDGET = "query_over_budget"
+# The config ran out of time, the default (or last published) distribution
+# was published instead
+STATUS_TIMEOUT = "timeout"
 
 
 def count_occurence(n, arr):
@@ -38,9 +50,13 @@ def get_config_combos(configs_to_optimize):
 class TSOptimizer:
     def __init__(self, config_id, bucket_size, source_table, 
                  configs_to_optimize, min_probability, model_type, 
-                 use_weighted_training=True, is_dev=False):
+                 use_weighted_training=True, is_dev=False, session=None,
+                 aggregate_table=None, max_bytes_scanned=None,
+                 read_shards=1, stats_workers=None):
 
-        self.set_reader(config_id, source_table, configs_to_optimize)
+        self.set_reader(config_id, source_table, configs_to_optimize,
+                        session, aggregate_table, max_bytes_scanned,
+                        read_shards, stats_workers)
         self.config_combos = get_config_combos(configs_to_optimize)
         self._set_model_type(model_type, is_dev)
 
@@ -50,6 +66,9 @@ class TSOptimizer:
         self.use_weighted_training = use_weighted_training
 
         self.not_enough_data = False
+        self.query_over_budget = False
+        self.timed_out = False
+        self.deadline = None
         self.min_wins = 5
 
         self.num_actions = len(self.config_combos)
@@ -57,8 +76,27 @@ class TSOptimizer:
         norm_factor = 1 / (1 - self.num_actions * min_probability)
         self.boost = norm_factor * self.bucket_size * min_probability
 
-    def set_reader(self, config_id, source_table, configs_to_optimize):
-        self.reader = TSReader(config_id, source_table, configs_to_optimize)
+    def set_reader(self, config_id, source_table, configs_to_optimize,
+                   session=None, aggregate_table=None, 
+                   max_bytes_scanned=None, read_shards=1, stats_workers=None):
+        self.reader = TSReader(config_id, source_table, configs_to_optimize,
+                               session=session,
+                               aggregate_table=aggregate_table,
+                               max_bytes_scanned=max_bytes_scanned,
+                               read_shards=read_shards,
+                               stats_workers=stats_workers)
+
+    def set_deadline(self, deadline):
+        """ Bounds the time spent reading and fitting (see deadline.py) """
+        self.deadline = deadline
+        self.reader.deadline = deadline
+        if isinstance(self.model, GammaModel):
+            # Its fit of a single hour is iterative
+            self.model.deadline = deadline
+
+    def _check_deadline(self, stage):
+        if self.deadline is not None:
+            self.deadline.check(stage)
 
     def _set_model_type(self, model_type, is_dev):
         print(f"Setting model type to {model_type}..")
@@ -71,32 +109,32 @@ class TSOptimizer:
         
         self.model = model
 
-    def _check_enough_data(self, df):
-        num_wins = len(df[df["win"] == 1])
-        if len(df) == 0 or num_wins < self.num_actions * self.min_wins:
+    def _check_enough_data(self, stats):
+        totals = sum_stats(stats)
+        if totals["num_trials"] == 0 \
+                or totals["num_wins"] < self.num_actions * self.min_wins:
             return False
         
         return True
 
     def _get_data(self, start_timestamp, end_timestamp):
-        df = self.reader.get_data(start_timestamp, end_timestamp, 
-                                 self.use_weighted_training)
-        enough_data = self._check_enough_data(df)
+        """ Reads the hourly statistics of every config combination """
+        stats = self.reader.get_hourly_stats(start_timestamp, end_timestamp,
+                                             self.use_weighted_training)
+        enough_data = self._check_enough_data(stats)
         if not enough_data:
             self.not_enough_data = True
             return
 
         if self.is_dev:
-            print("Num rows", df.shape[0])
-            print(df.head())
+            print("Num rows", sum_stats(stats)["num_trials"])
+            print(stats.head())
 
-        num_hours = df["auction_hour"].nunique()
-        self.hours = [hr for hr in range(num_hours)]
+        self.hours = sorted(stats["auction_hour"].unique())
         
-        return df
+        return stats
 
     def _filter_dataset(self, raw_df, config_combo):
-        print(config_combo)
         keys = []
         for key, val in config_combo.items():
             df = raw_df[raw_df[key] == val]
@@ -104,15 +142,12 @@ class TSOptimizer:
 
         return df
 
-    def _get_basic_stats(self, df):
-        num_trials = len(df)
-        num_wins = len(df[df["win"] == 1])
+    def _get_basic_stats(self, stats):
+        num_trials = stats["num_trials"]
+        num_wins = stats["num_wins"]
 
-        wins = df[df["win"] == 1]
-        if len(wins) > self.min_wins:
-            log_pubrev = np.log(wins["pubrev"] + 1)
-            log_pubrev_mean = log_pubrev.mean()
-            log_pubrev_std = log_pubrev.std()
+        if num_wins > self.min_wins:
+            log_pubrev_mean, log_pubrev_std = get_log_pubrev_moments(stats)
         else:
             log_pubrev_mean, log_pubrev_std = 0, 0
 
@@ -140,46 +175,47 @@ class TSOptimizer:
 
         return results
 
-    def generate_distributions(self, start_timestamp, end_timestamp):
-        df = self._get_data(start_timestamp, end_timestamp)
-
-        if self.not_enough_data:
-            print("Not enough data")
-            return self._get_default_distributions()
-
+    def _get_hourly_rewards(self, stats, hour):
+        """ Returns the reward distribution of each action for a single hour.
+        The result only depends on that hour's statistics, so it can be reused
+        by every window that contains the hour. """
+        hourly_stats = stats[stats["auction_hour"] == hour]
+        hourly_totals = sum_stats(hourly_stats)
+        num_hourly_data = hourly_totals["num_trials"]
+        global_hourly_mean = hourly_totals["sum_pubrev"] / num_hourly_data
+
+        rewards = []
+        for config_combo in self.config_combos:
+            sub_stats = sum_stats(self._filter_dataset(hourly_stats, 
+                                                       config_combo))
+            rv = self.model.get_reward_distribution_from_stats(
+                sub_stats, num_hourly_data, global_hourly_mean)
+            rewards.append(rv)
+
+        return rewards
+
+    def _get_distributions(self, stats, hours, hourly_rewards):
+        """ Combines the hourly reward distributions of `hours` into the
+        probability to win of each action """
         num_actions = len(self.config_combos)
         rv_arrays = np.zeros((num_actions, self.bucket_size))
         num_trials_arr = []
         num_wins_arr = []
         log_pubrev_mean_arr = []
         log_pubrev_std_arr = []
-            
-        # Calculate global means
-        global_means = []
-        for hour in self.hours:
-            hourly_mean = df[df["auction_hour"] == hour]["pubrev"].mean()
-            global_means.append(hourly_mean)
 
-        # Get reward distribution for each hour
+        latest_hourly_stats = stats[stats["auction_hour"] == hours[-1]]
         for action_idx, config_combo in enumerate(self.config_combos):
-            sub_df = self._filter_dataset(df, config_combo)
-            rvs = []
-            for hour in self.hours:
-                hourly_data = sub_df[sub_df["auction_hour"] == hour]
-                num_hourly_data = len(df[df["auction_hour"] == hour])
-                global_hourly_mean = global_means[hour]
-                rv = self.model.get_reward_distribution(hourly_data, 
-                                                        num_hourly_data,
-                                                        global_hourly_mean)
-                rvs.extend(rv)
-
-            
+            print(config_combo)
+            rvs = np.concatenate([hourly_rewards[hour][action_idx] 
+                                  for hour in hours])
             rv_arrays[action_idx, :] = np.random.choice(rvs, self.bucket_size)
 
             # Store basic summary statistics for latest hourly data
-            latest_hourly_data = sub_df[sub_df["auction_hour"] == self.hours[-1]]
+            latest_stats = sum_stats(self._filter_dataset(latest_hourly_stats,
+                                                          config_combo))
             num_trials, num_wins, log_pubrev_mean, log_pubrev_std \
-                = self._get_basic_stats(latest_hourly_data)
+                = self._get_basic_stats(latest_stats)
             num_trials_arr.append(num_trials)
             num_wins_arr.append(num_wins)
             log_pubrev_mean_arr.append(log_pubrev_mean)
@@ -208,4 +244,128 @@ class TSOptimizer:
             with open(".output/output.json", "w") as f:
                 json.dump(results, f, indent=2)
 
-        return results
\ No newline at end of file
+        return results
+
+    def generate_distributions(self, start_timestamp, end_timestamp):
+        """ Returns the distributions, along with the status of the run and
+        the metrics of the queries it ran """
+        stats = self.read_stats(start_timestamp, end_timestamp)
+        return self.compute_distributions(stats)
+
+    def read_stats(self, start_timestamp, end_timestamp):
+        """ Reads the hourly statistics (the I/O bound part of
+        generate_distributions). Returns None if there is nothing to fit. """
+        try:
+            return self._get_data(start_timestamp, end_timestamp)
+        except QueryTooExpensiveError as e:
+            print(f"Falling back to the default distribution: {e}")
+            self.query_over_budget = True
+        except DeadlineExceeded as e:
+            print(f"Falling back to the default distribution: {e}")
+            self.timed_out = True
+
+    def compute_distributions(self, stats):
+        """ Fits the statistics returned by read_stats (the CPU bound part of
+        generate_distributions) """
+        if self.query_over_budget:
+            results = self._get_default_distributions()
+            status = STATUS_QUERY_OVER_BUDGET
+        elif self.timed_out:
+            results = self._get_default_distributions()
+            status = STATUS_TIMEOUT
+        elif self.not_enough_data:
+            print("Not enough data")
+            results = self._get_default_distributions()
+            status = STATUS_NOT_ENOUGH_DATA
+        else:
+            try:
+                results = self._fit(stats)
+                status = STATUS_OK
+            except DeadlineExceeded as e:
+                print(f"Falling back to the default distribution: {e}")
+                self.timed_out = True
+                results = self._get_default_distributions()
+                status = STATUS_TIMEOUT
+
+        return self._add_run_info(results, status, stats)
+
+    def _add_run_info(self, results, status, stats):
+        """ Adds the status of the run and the metrics of its queries """
+        results["status"] = status
+        results["query_metrics"] = list(self.reader.query_metrics)
+        # Number of requests the statistics were aggregated from, see
+        # costs.CostHistory
+        results["num_rows"] = sum_stats(stats)["num_trials"] \
+                                if stats is not None else 0
+        return results
+
+    def _fit(self, stats):
+        # Get reward distribution for each hour
+        hourly_rewards = {}
+        for hour in self.hours:
+            self._check_deadline("fit")
+            hourly_rewards[hour] = self._get_hourly_rewards(stats, hour)
+        self._check_deadline("fit")
+
+        return self._get_distributions(stats, self.hours, hourly_rewards)
+
+    def generate_multi_horizon_distributions(self, end_timestamp, 
+                                             hour_windows):
+        """ Generates the distributions for several hour windows ending at
+        end_timestamp from a single read of the largest window. Every smaller
+        window is a suffix of the largest one, so the hourly reward
+        distributions are computed once and shared by all windows.
+
+        Returns a dict of {hour_window: results}, every results with the
+        status of its window like generate_distributions
+        """
+        max_hour_window = max(hour_windows)
+        start_timestamp = end_timestamp - timedelta(hours=max_hour_window)
+        stats = self.read_stats(start_timestamp, end_timestamp)
+        if stats is None:
+            # Over budget, timed out, or not enough data in the largest
+            # window (so in none of them)
+            return {hour_window: self.compute_distributions(None)
+                    for hour_window in hour_windows}
+
+        hourly_rewards = {}
+        results_by_window = {}
+        for hour_window in sorted(hour_windows):
+            # auction_hour is relative to the start of the largest window
+            first_hour = max_hour_window - hour_window
+            window_stats = stats[stats["auction_hour"] >= first_hour]
+
+            if self.timed_out:
+                results = self._get_default_distributions()
+                status = STATUS_TIMEOUT
+            elif not self._check_enough_data(window_stats):
+                print(f"Not enough data for hour_window={hour_window}")
+                results = self._get_default_distributions()
+                status = STATUS_NOT_ENOUGH_DATA
+            else:
+                try:
+                    results = self._fit_window(window_stats, hourly_rewards)
+                    status = STATUS_OK
+                except DeadlineExceeded as e:
+                    print(f"Falling back to the default distribution: {e}")
+                    self.timed_out = True
+                    results = self._get_default_distributions()
+                    status = STATUS_TIMEOUT
+
+            results_by_window[hour_window] = self._add_run_info(
+                results, status, window_stats)
+
+        return results_by_window
+
+    def _fit_window(self, window_stats, hourly_rewards):
+        """ Fits a window, reusing (and adding to) the hourly reward
+        distributions of the windows fitted before """
+        hours = sorted(window_stats["auction_hour"].unique())
+        for hour in hours:
+            if hour not in hourly_rewards:
+                self._check_deadline("fit")
+                hourly_rewards[hour] = self._get_hourly_rewards(
+                    window_stats, hour)
+        self._check_deadline("fit")
+
+        return self._get_distributions(window_stats, hours, hourly_rewards)
@@ -0,0 +1,155 @@
+"""
+Runs the configs of a run through three stages connected by bounded queues:
+- read: query the hourly statistics (waits on BigQuery)
+- optimize: fit the models and compute the distributions (CPU)
+- export: append the BQ row and upload distributions.json (waits on BQ/GCS)
+
+Each stage runs in its own thread, so config N+1 is read and fitted while
+config N is being exported and the wall time of a run approaches that of
+its slowest stage instead of the sum of all stages. A config that fails in
+one stage skips the remaining stages without stopping the others.
+"""
+
+import queue
+import threading
+import time
+import traceback
+
+from prebid_optimizer import createOptimizer
+from prebid_optimizer import exportResults
+from prebid_optimizer import get_time_window
+from prebid_optimizer.deadline import Deadline
+from prebid_optimizer.exporter import get_distributions
+from prebid_optimizer.exporter import hash_distributions
+
+
+# Marks the end of the tasks in a queue
+_DONE = object()
+
+
+class ConfigTask:
+    """ State of one config as it moves through the stages """
+    def __init__(self, config_id, configs_to_optimize):
+        self.config_id = config_id
+        self.configs_to_optimize = configs_to_optimize
+
+        self.optimizer = None
+        self.stats = None
+        self.results = None
+
+        # Seconds spent in each stage
+        self.timings = {}
+        self.error = None
+        self.failed_stage = None
+
+
+def _run_stage(name, func, in_queue, out_queue):
+    while True:
+        task = in_queue.get()
+        if task is _DONE:
+            out_queue.put(_DONE)
+            return
+
+        if task.error is None:
+            start_time = time.perf_counter()
+            try:
+                func(task)
+            except Exception as e:
+                print(f"Config Id {task.config_id} failed in stage {name}:")
+                traceback.print_exc()
+                task.error = e
+                task.failed_stage = name
+            task.timings[name] = time.perf_counter() - start_time
+
+        out_queue.put(task)
+
+
+def run_pipeline(tasks, stages, queue_size=1):
+    """ Runs every task through the stages, a list of (name, func) where
+    func(task) updates the task in place. Returns the tasks in the order
+    they finished. """
+    # The output queue is unbounded so the feeding thread never blocks on it
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages] \
+                + [queue.Queue()]
+    threads = [
+        threading.Thread(target=_run_stage, name=f"pipeline-{name}",
+                         args=(name, func, queues[i], queues[i + 1]),
+                         daemon=True)
+        for i, (name, func) in enumerate(stages)
+    ]
+    for thread in threads:
+        thread.start()
+
+    for task in tasks:
+        queues[0].put(task)
+    queues[0].put(_DONE)
+
+    finished = []
+    while True:
+        task = queues[-1].get()
+        if task is _DONE:
+            break
+        finished.append(task)
+
+    for thread in threads:
+        thread.join()
+
+    return finished
+
+
+def runOptimizerPipeline(env, configs, bucket_size, source_table,
+        run_timestamp, hour_window, data_delay_hour, model_type,
+        is_dev=False, session=None, aggregate_table=None,
+        max_bytes_scanned=None, manifest=None, checkpoint=None, 
+        staging_prefix=None, config_timeout_seconds=None,
+        timeout_fallback="last_good", queue_size=1, read_shards=1,
+        stats_workers=None):
+    """ Pipelined equivalent of calling runOptimizer for every
+    (config_id, configs_to_optimize) in configs. If a checkpoint is given,
+    configs are marked complete as soon as they are exported. Returns the
+    ConfigTasks. The per-config timeout covers reading and fitting, but not
+    the time a config waits for the next stage. """
+    start_timestamp, end_timestamp = get_time_window(
+        run_timestamp, hour_window, data_delay_hour)
+
+    def read(task):
+        task.optimizer = createOptimizer(task.config_id, bucket_size,
+                                         source_table,
+                                         task.configs_to_optimize,
+                                         model_type, is_dev=is_dev,
+                                         session=session,
+                                         aggregate_table=aggregate_table,
+                                         max_bytes_scanned=max_bytes_scanned,
+                                         read_shards=read_shards,
+                                         stats_workers=stats_workers)
+        if config_timeout_seconds:
+            task.optimizer.set_deadline(Deadline(config_timeout_seconds))
+        task.stats = task.optimizer.read_stats(start_timestamp,
+                                               end_timestamp)
+        if task.optimizer.deadline is not None:
+            task.optimizer.deadline.pause()
+
+    def optimize(task):
+        if task.optimizer.deadline is not None:
+            task.optimizer.deadline.resume()
+        task.results = task.optimizer.compute_distributions(task.stats)
+        # The statistics are not needed anymore
+        task.stats = None
+
+    def export(task):
+        task.results["runtime_seconds"] = task.timings["read"] \
+                                          + task.timings["optimize"]
+        exportResults(task.results, env, task.config_id, run_timestamp,
+                      start_timestamp, end_timestamp, session=session,
+                      manifest=manifest, staging_prefix=staging_prefix,
+                      timeout_fallback=timeout_fallback)
+        if checkpoint is not None:
+            checkpoint.mark_complete(
+                task.config_id, task.results["status"],
+                hash_distributions(get_distributions(task.results)))
+
+    tasks = [ConfigTask(config_id, configs_to_optimize)
+             for config_id, configs_to_optimize in configs]
+    stages = [("read", read), ("optimize", optimize), ("export", export)]
+
+    return run_pipeline(tasks, stages, queue_size=queue_size)
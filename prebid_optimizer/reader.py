@@ -1,8 +1,11 @@
+import concurrent.futures
 from datetime import timedelta
+import time
 
-from google.cloud import bigquery
-from google.cloud import bigquery_storage
-import pandas as pd
+from prebid_optimizer.deadline import DeadlineExceeded
+from prebid_optimizer.session import Session
+from prebid_optimizer.session import get_default_session
+from prebid_optimizer.stats import aggregate_stats
 
 
 DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
@@ -11,20 +14,44 @@ CONFIG_SCHEMA = {
     "bidderTimeout": "INT64"
 }
 
-SQL_TEMPLATE = """
+# Queries only interpolate table and column names, the values are passed as
+# query parameters (@start_time, @end_time, @config_id) so that identical
+# queries can be served from the BigQuery result cache.
+
+# Reads the hourly statistics of a config from the table maintained by
+# `prebid_optimizer.aggregate`
+AGGREGATE_SQL_TEMPLATE = """
+SELECT
+    -- auction hour, measured from start_time
+    TIMESTAMP_DIFF(hour, @start_time, HOUR) as auction_hour,
+    {config_fields},
+    SUM(num_trials) as num_trials,
+    SUM(num_wins) as num_wins,
+    SUM(sum_pubrev) as sum_pubrev,
+    SUM(sum_log_pubrev) as sum_log_pubrev,
+    SUM(sum_sq_log_pubrev) as sum_sq_log_pubrev
+FROM `{aggregate_table}`
+WHERE
+    hour >= @start_time
+    AND hour < @end_time
+    AND configID = @config_id
+GROUP BY auction_hour, {config_fields}
+"""
+
+AUCTIONS_CTE_TEMPLATE = """
 WITH 
 adunit_table AS (
     SELECT
         receiptTimeMillis,
         -- auction hour, measured from start_time (starts from 1)
-        TIMESTAMP_DIFF(receiptTimeMillis, TIMESTAMP("{start_time}"), HOUR) as auction_hour,
+        TIMESTAMP_DIFF(receiptTimeMillis, @start_time, HOUR) as auction_hour,
         {parse_optimizerConfig}
         adUnits
     FROM `{source_table}`
     WHERE 
-        receiptTimeMillis >= timestamp("{start_time}")
-        AND receiptTimeMillis < timestamp("{end_time}")
-        AND configID = "{configID}"
+        receiptTimeMillis >= @start_time
+        AND receiptTimeMillis < @end_time
+        AND configID = @config_id
         AND optimizerConfig IS NOT NULL
         AND testCode = "ds_optimizer"
         -- TODO: remove after page refresh is implemented
@@ -57,6 +84,9 @@ win_cpm_table AS (
     FROM flattened_table
     GROUP BY 1,2,3, {config_fields}
 )
+"""
+
+SQL_TEMPLATE = AUCTIONS_CTE_TEMPLATE + """
 SELECT
     auction_hour,
     {config_fields},
@@ -65,45 +95,345 @@ SELECT
 FROM win_cpm_table
 """
 
+# Statistics per (auction_hour, ad unit, config), see `prebid_optimizer.stats`.
+# Aggregated by BigQuery, a config can have thousands of ad units.
+SEGMENT_SQL_TEMPLATE = AUCTIONS_CTE_TEMPLATE + """
+SELECT
+    auction_hour,
+    adunit_code as segment,
+    {config_fields},
+    COUNT(*) as num_trials,
+    COUNTIF(pubrev > 0) as num_wins,
+    SUM(pubrev) as sum_pubrev,
+    SUM(LN(pubrev + 1)) as sum_log_pubrev,
+    SUM(POW(LN(pubrev + 1), 2)) as sum_sq_log_pubrev
+FROM win_cpm_table
+GROUP BY auction_hour, segment, {config_fields}
+"""
+
+
+# BigQuery bills at least this many bytes per query, a lower cap on the
+# bytes billed would fail every query
+MIN_BYTES_BILLED = 10 * 2 ** 20
+
+
+class QueryTooExpensiveError(Exception):
+    """ Raised when the dry run of a query exceeds the byte budget, or when
+    BigQuery stops the query at the budget """
+    def __init__(self, estimated_bytes, max_bytes_scanned):
+        self.estimated_bytes = estimated_bytes
+        self.max_bytes_scanned = max_bytes_scanned
+        super().__init__(f"Query would scan {estimated_bytes} bytes, "
+                         f"budget is {max_bytes_scanned} bytes")
+
+
+def is_bytes_billed_error(error):
+    """ Whether a failed job was stopped by maximum_bytes_billed """
+    reasons = [e.get("reason") for e in getattr(error, "errors", None) or []]
+    return "bytesBilledLimitExceeded" in reasons \
+        or "bytes billed" in str(error)
+
+
+def is_job_timeout_error(error):
+    """ Whether a failed job was stopped by job_timeout_ms """
+    reasons = [e.get("reason") for e in getattr(error, "errors", None) or []]
+    return "timeout" in reasons or "jobTimeout" in reasons
+
+
+def get_query_parameters(config_id, start_timestamp, end_timestamp):
+    from google.cloud import bigquery
+
+    return [
+        bigquery.ScalarQueryParameter("config_id", "STRING", config_id),
+        bigquery.ScalarQueryParameter("start_time", "TIMESTAMP",
+                                      start_timestamp),
+        bigquery.ScalarQueryParameter("end_time", "TIMESTAMP", 
+                                      end_timestamp),
+    ]
+
+
+def get_parse_optimizerConfig(configs):
+    """ Returns the SELECT expressions that extract the config fields from
+    the optimizerConfig JSON """
+    parse_optimizerConfig = ""
+    parse_template = 'cast(json_extract_scalar(optimizerConfig, "$.{field_name}.n") as {field_type}) as {field_name}, \n'
+    for field_name in configs:
+        field_type = CONFIG_SCHEMA.get(field_name, "STRING")
+        parse_optimizerConfig += parse_template.format(field_name=field_name, field_type=field_type)
+
+    return parse_optimizerConfig
+
 
 def get_hour_window(start_timestamp, end_timestamp):
     return  (end_timestamp - start_timestamp).seconds // 3600 \
                 + (end_timestamp - start_timestamp).days * 24
 
 
+def split_time_window(start_timestamp, end_timestamp, num_shards):
+    """ Splits the window into at most num_shards consecutive ranges of
+    whole hours, of (nearly) equal lengths """
+    hour_window = get_hour_window(start_timestamp, end_timestamp)
+    num_shards = max(1, min(num_shards, hour_window))
+
+    bounds = [start_timestamp + timedelta(hours=hour_window * i // num_shards)
+              for i in range(num_shards)] + [end_timestamp]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
 class TSReader:
     def __init__(self, config_id, source_table, configs_to_optimize,
-                 gcp_project=None, verbose=False):
-        self.client = bigquery.Client(project=gcp_project)
-        self.storage_client = bigquery_storage.BigQueryReadClient()
+                 gcp_project=None, verbose=False, client=None,
+                 storage_client=None, aggregate_table=None,
+                 max_bytes_scanned=None, read_shards=1, session=None,
+                 stats_workers=None):
+        # Clients passed in are used as is, otherwise they are taken from
+        # the session (on the first query)
+        self._client = client
+        self._storage_client = storage_client
+        if session is None:
+            session = Session(gcp_project) if gcp_project \
+                        else get_default_session()
+        self.session = session
+        self.gcp_project = gcp_project
         self.config_id = config_id
         self.configs_to_optimize = configs_to_optimize
         self.source_table = source_table
+        # If set, hourly statistics are read from this pre-aggregated table
+        # instead of aggregating the raw source_table
+        self.aggregate_table = aggregate_table
+        # If set, every query is dry run first and not run if it would scan
+        # more than this many bytes
+        self.max_bytes_scanned = max_bytes_scanned
+        # The window is read with this many concurrent queries over
+        # consecutive hour ranges (see _read_time_sharded)
+        self.read_shards = read_shards
+        # If set, the raw rows are aggregated by this many worker processes
+        # that share them through shared memory (see _get_shared_stats)
+        self.stats_workers = stats_workers
         self.verbose = verbose
+        # If set (a deadline.Deadline), queries are cancelled when it passes
+        self.deadline = None
+
+        # Bytes scanned, cache hits and slot usage of every query
+        self.query_metrics = []
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = self.session.bigquery
+
+        return self._client
+
+    @property
+    def storage_client(self):
+        if self._storage_client is None:
+            self._storage_client = self.session.bigquery_storage
+
+        return self._storage_client
+
+    def _dry_run(self, sql_query, query_parameters):
+        """ Returns the number of bytes the query would scan """
+        from google.cloud import bigquery
+
+        job_config = bigquery.QueryJobConfig(
+            dry_run=True,
+            use_query_cache=False,
+            query_parameters=query_parameters,
+        )
+        job = self.client.query(sql_query, job_config=job_config)
+        return job.total_bytes_processed
+
+    def _check_budget(self, sql_query, query_parameter_sets):
+        """ Dry runs the query with every set of parameters. Raises
+        QueryTooExpensiveError if they would scan more than
+        max_bytes_scanned together, otherwise returns the estimate of each
+        (None without a budget). """
+        if self.max_bytes_scanned is None:
+            return [None] * len(query_parameter_sets)
+
+        estimates = [self._dry_run(sql_query, query_parameters)
+                     for query_parameters in query_parameter_sets]
+        if sum(estimates) > self.max_bytes_scanned:
+            self.query_metrics.append({"dry_run_bytes": sum(estimates)})
+            raise QueryTooExpensiveError(sum(estimates),
+                                         self.max_bytes_scanned)
+
+        return estimates
+
+    def _get_bytes_billed_cap(self, estimated_bytes, estimates):
+        """ Share of the budget of a query that is estimated to scan
+        estimated_bytes out of sum(estimates), so that the caps of all the
+        queries add up to the budget """
+        total = sum(estimates)
+        share = estimated_bytes / total if total else 1 / len(estimates)
+        return max(int(self.max_bytes_scanned * share), MIN_BYTES_BILLED)
+
+    def _read_from_BigQuery(self, sql_query, query_parameters=None,
+                            dry_run_bytes=None, maximum_bytes_billed=None,
+                            jobs=None):
+        """ Use the sql_query to read data from BigQuery. The query must
+        already have been checked against the budget (see _check_budget).
+        Submitted jobs are appended to `jobs` if given, for the caller to
+        cancel them. """
+        from google.cloud import bigquery
+
+        query_parameters = query_parameters or []
+        metrics = {"dry_run_bytes": dry_run_bytes}
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=query_parameters)
+
+        if maximum_bytes_billed is not None:
+            # Enforced by BigQuery in case the estimate was off
+            job_config.maximum_bytes_billed = maximum_bytes_billed
+
+        if self.deadline is not None:
+            self.deadline.check("read")
+            # Also stops the query server side, on versions of
+            # google-cloud-bigquery that support it (3.x). Otherwise the
+            # job is cancelled by _wait_for_job.
+            if hasattr(bigquery.QueryJobConfig, "job_timeout_ms"):
+                job_config.job_timeout_ms = int(
+                    self.deadline.remaining() * 1000)
+
+        start_time = time.perf_counter()
+        job = self.client.query(sql_query, job_config=job_config)
+        if jobs is not None:
+            jobs.append(job)
+        rows = self._get_rows(job, metrics)
+        df = self._download(rows)
+
+        metrics.update({
+            "total_bytes_processed": job.total_bytes_processed,
+            "total_bytes_billed": job.total_bytes_billed,
+            "cache_hit": job.cache_hit,
+            "slot_millis": job.slot_millis,
+            "elapsed_seconds": time.perf_counter() - start_time,
+        })
+        self.query_metrics.append(metrics)
+        if self.verbose:
+            print(f"Query metrics: {metrics}")
 
-    def _read_from_BigQuery(self, sql_query):
-        """ Use the sql_query to read data from BigQuery """
-        df = (
-            self.client.query(sql_query)
-            .result()
-            .to_dataframe(bqstorage_client=self.storage_client)
-        )        
         return df
 
+    def _get_rows(self, job, metrics):
+        from google.api_core.exceptions import GoogleAPICallError
+
+        try:
+            if self.deadline is None:
+                return job.result()
+            return self._wait_for_job(job)
+        # The library has no exception class for bytesBilledLimitExceeded,
+        # the job fails with an InternalServerError
+        except GoogleAPICallError as e:
+            if self.max_bytes_scanned is None or not is_bytes_billed_error(e):
+                raise
+            # The dry run underestimated the query
+            self.query_metrics.append(metrics)
+            raise QueryTooExpensiveError(metrics["dry_run_bytes"],
+                                         self.max_bytes_scanned) from e
+
+    def _download(self, rows):
+        """ Downloads the rows of a finished query, within the deadline """
+        if self.deadline is None:
+            return rows.to_dataframe(bqstorage_client=self.storage_client)
+
+        executor = concurrent.futures.ThreadPoolExecutor(1)
+        future = executor.submit(rows.to_dataframe,
+                                 bqstorage_client=self.storage_client)
+        # A download can not be interrupted: if the deadline passes, it
+        # finishes in the background and its rows are dropped
+        executor.shutdown(wait=False)
+        try:
+            return future.result(timeout=self.deadline.remaining())
+        except concurrent.futures.TimeoutError:
+            raise DeadlineExceeded("read", self.deadline.seconds)
+
+    def _wait_for_job(self, job):
+        from google.api_core.exceptions import GoogleAPICallError
+
+        try:
+            return job.result(timeout=self.deadline.remaining())
+        except concurrent.futures.TimeoutError:
+            job.cancel()
+            raise DeadlineExceeded("read", self.deadline.seconds)
+        except GoogleAPICallError as e:
+            # BigQuery stopped the job at job_timeout_ms just before the
+            # client gave up waiting
+            if not is_job_timeout_error(e):
+                raise
+            raise DeadlineExceeded("read", self.deadline.seconds) from e
+
+    def _read_time_sharded(self, sql_query, start_timestamp, end_timestamp):
+        """ Runs the query on read_shards hour ranges of the window
+        concurrently and concatenates the results. Every query measures
+        auction_hour from the start of its own range, so the range's offset
+        is added back. All queries group by (or select) auction_hour, so
+        the concatenation is the result of the query on the whole window.
+
+        The budget (max_bytes_scanned) applies to the whole window: all the
+        ranges are dry run before any query is submitted. If a range fails,
+        the queries of the other ranges are cancelled. """
+        ranges = split_time_window(start_timestamp, end_timestamp,
+                                   self.read_shards)
+        parameter_sets = [get_query_parameters(self.config_id, start, end)
+                          for start, end in ranges]
+        estimates = self._check_budget(sql_query, parameter_sets)
+        caps = [None] * len(ranges) if self.max_bytes_scanned is None \
+                else [self._get_bytes_billed_cap(estimate, estimates)
+                      for estimate in estimates]
+
+        if len(ranges) == 1:
+            return self._read_from_BigQuery(sql_query, parameter_sets[0],
+                                            estimates[0], caps[0])
+
+        import pandas as pd
+
+        # Create the clients before the threads share them
+        self.client
+        self.storage_client
+
+        jobs = []
+        executor = concurrent.futures.ThreadPoolExecutor(len(ranges))
+        futures = [executor.submit(self._read_from_BigQuery, sql_query,
+                                   query_parameters, estimate, cap, jobs)
+                   for query_parameters, estimate, cap
+                   in zip(parameter_sets, estimates, caps)]
+        try:
+            # Stop at the first failed range, whichever it is, rather than
+            # after the ranges before it finish
+            done, pending = concurrent.futures.wait(
+                futures, return_when=concurrent.futures.FIRST_EXCEPTION)
+            failed = [future for future in done
+                      if future.exception() is not None]
+            if failed:
+                # Do not wait for (and pay for) the rest of a failed read
+                for future in pending:
+                    future.cancel()
+                for job in list(jobs):
+                    try:
+                        job.cancel()
+                    except Exception as e:
+                        # Best effort, the original error matters more
+                        print(f"Could not cancel a query: {e!r}")
+                # Raises the error of the range that failed, not the
+                # cancellation of the others
+                failed[0].result()
+            dfs = [future.result() for future in futures]
+        finally:
+            executor.shutdown(wait=False)
+
+        for (start, _), df in zip(ranges, dfs):
+            df["auction_hour"] += get_hour_window(start_timestamp, start)
+
+        return pd.concat(dfs, ignore_index=True)
+
     def get_data(self, start_timestamp, end_timestamp, use_weighted_training):
         configs = self.configs_to_optimize.keys()
-        configID = self.config_id
 
-        parse_optimizerConfig = ""
-        parse_template = 'cast(json_extract_scalar(optimizerConfig, "$.{field_name}.n") as {field_type}) as {field_name}, \n'
-        for field_name in configs:
-            field_type = CONFIG_SCHEMA.get(field_name, "STRING")
-            parse_optimizerConfig += parse_template.format(field_name=field_name, field_type=field_type)
-        
+        parse_optimizerConfig = get_parse_optimizerConfig(configs)
         config_fields = ", ".join(configs)
 
         params = {
-            "configID": configID,
             "parse_optimizerConfig": parse_optimizerConfig,
             "config_fields": config_fields,
             "source_table": self.source_table
@@ -119,12 +449,82 @@ class TSReader:
                             if use_weighted_training else "0"
 
         params.update({
-            "start_time": start_time_str,
-            "end_time": end_time_str,
             "random_idx_clause": random_idx_clause,
         })
 
         sql = SQL_TEMPLATE.format(**params)
-        df = self._read_from_BigQuery(sql)
+        df = self._read_time_sharded(sql, start_timestamp, end_timestamp)
+
+        return df
+
+    def get_shared_data(self, start_timestamp, end_timestamp,
+                        use_weighted_training, config_combos):
+        """ Reads the raw rows and publishes them to shared memory, for
+        worker processes to attach to (see `prebid_optimizer.shared`). The
+        caller owns the returned SharedDataset and must close it. """
+        from prebid_optimizer.shared import SharedDataset
+
+        df = self.get_data(start_timestamp, end_timestamp,
+                           use_weighted_training)
+        return SharedDataset.publish(df, config_combos)
+
+    def get_hourly_stats(self, start_timestamp, end_timestamp, 
+                         use_weighted_training):
+        """ Returns the statistics of each (auction_hour, config) pair,
+        see `prebid_optimizer.stats` """
+        if self.aggregate_table:
+            return self._get_aggregated_stats(start_timestamp, end_timestamp)
+        if self.stats_workers:
+            return self._get_shared_stats(start_timestamp, end_timestamp,
+                                          use_weighted_training)
+
+        df = self.get_data(start_timestamp, end_timestamp, 
+                           use_weighted_training)
+        group_fields = ["auction_hour"] + list(self.configs_to_optimize)
+
+        return aggregate_stats(df, group_fields)
+
+    def _get_shared_stats(self, start_timestamp, end_timestamp,
+                          use_weighted_training):
+        """ get_hourly_stats aggregated by stats_workers processes, which
+        attach to the rows instead of receiving a pickled copy each. Only
+        the rows of the optimized configs are kept. """
+        from prebid_optimizer import shared
+        from prebid_optimizer.optimizer import get_config_combos
+
+        config_combos = get_config_combos(self.configs_to_optimize)
+        with self.get_shared_data(start_timestamp, end_timestamp,
+                                  use_weighted_training,
+                                  config_combos) as dataset:
+            return shared.get_hourly_stats(dataset, config_combos,
+                                           num_workers=self.stats_workers)
+
+    def get_segment_stats(self, start_timestamp, end_timestamp):
+        """ Returns the statistics of each (auction_hour, segment, config),
+        where the segments are the ad units of the config """
+        configs = self.configs_to_optimize.keys()
+
+        sql = SEGMENT_SQL_TEMPLATE.format(
+            parse_optimizerConfig=get_parse_optimizerConfig(configs),
+            config_fields=", ".join(configs),
+            source_table=self.source_table,
+        )
+        return self._read_time_sharded(sql, start_timestamp, end_timestamp)
+
+    def _get_aggregated_stats(self, start_timestamp, end_timestamp):
+        configs = list(self.configs_to_optimize)
+        unknown_configs = [c for c in configs if c not in CONFIG_SCHEMA]
+        if unknown_configs:
+            raise ValueError(f"{unknown_configs} are not columns of "
+                             f"{self.aggregate_table}, add them to "
+                             f"CONFIG_SCHEMA and rebuild the table")
+
+        start_time_str = start_timestamp.strftime(DATETIME_FORMAT)
+        end_time_str = end_timestamp.strftime(DATETIME_FORMAT)
+        print(start_time_str, end_time_str, self.aggregate_table)
 
-        return df
\ No newline at end of file
+        sql = AGGREGATE_SQL_TEMPLATE.format(
+            aggregate_table=self.aggregate_table,
+            config_fields=", ".join(configs),
+        )
+        return self._read_time_sharded(sql, start_timestamp, end_timestamp)
@@ -0,0 +1,94 @@
+"""
+Backtests the optimizer over many run timestamps. Instead of running the
+optimizer once per run timestamp (one query and a refit of every hour each
+time), the union of all run windows is read once and the window slides hour
+by hour: the reward distribution of an hour is computed the first time the
+hour enters the window and reused until it leaves it.
+
+Results are only returned, nothing is exported to the BigQuery output table
+or the GCS bucket.
+"""
+
+from datetime import timedelta
+
+from prebid_optimizer import get_time_window
+from prebid_optimizer.reader import get_hour_window
+
+
+def get_run_timestamps(start_run_timestamp, end_run_timestamp, step_hours=1):
+    """ Returns the run timestamps in [start_run_timestamp, end_run_timestamp]
+    spaced by step_hours """
+    run_timestamps = []
+    run_timestamp = start_run_timestamp
+    while run_timestamp <= end_run_timestamp:
+        run_timestamps.append(run_timestamp)
+        run_timestamp += timedelta(hours=step_hours)
+
+    return run_timestamps
+
+
+class TSReplayer:
+    def __init__(self, optimizer, hour_window, data_delay_hour):
+        self.optimizer = optimizer
+        self.hour_window = hour_window
+        self.data_delay_hour = data_delay_hour
+
+        # Number of hours whose reward distribution had to be computed
+        self.num_fitted_hours = 0
+
+    def _get_stats(self, windows):
+        """ Reads the hourly statistics of the union of all windows once """
+        union_start = min(start for start, _ in windows)
+        union_end = max(end for _, end in windows)
+
+        stats = self.optimizer.reader.get_hourly_stats(
+            union_start, union_end, self.optimizer.use_weighted_training)
+
+        return union_start, stats
+
+    def replay(self, run_timestamps):
+        """ Returns one row per (run timestamp, action) with the probability
+        to win the optimizer would have published at that time """
+        run_timestamps = sorted(run_timestamps)
+        windows = [get_time_window(run_timestamp, self.hour_window,
+                                   self.data_delay_hour)
+                   for run_timestamp in run_timestamps]
+        union_start, stats = self._get_stats(windows)
+
+        hourly_rewards = {}
+        rows = []
+        for run_timestamp, (start_timestamp, end_timestamp) \
+                in zip(run_timestamps, windows):
+            # auction_hour is relative to the start of the union
+            first_hour = get_hour_window(union_start, start_timestamp)
+            last_hour = get_hour_window(union_start, end_timestamp)
+            window_stats = stats[(stats["auction_hour"] >= first_hour)
+                                 & (stats["auction_hour"] < last_hour)]
+
+            # Drop the hours that slid out of the window
+            for hour in [hr for hr in hourly_rewards if hr < first_hour]:
+                del hourly_rewards[hour]
+
+            if not self.optimizer._check_enough_data(window_stats):
+                print(f"Not enough data for run at {run_timestamp}")
+                results = self.optimizer._get_default_distributions()
+            else:
+                hours = sorted(window_stats["auction_hour"].unique())
+                for hour in hours:
+                    if hour not in hourly_rewards:
+                        hourly_rewards[hour] = self.optimizer \
+                            ._get_hourly_rewards(window_stats, hour)
+                        self.num_fitted_hours += 1
+
+                results = self.optimizer._get_distributions(
+                    window_stats, hours, hourly_rewards)
+
+            for action in results["actions"]:
+                rows.append({
+                    "run_timestamp": run_timestamp,
+                    "start_timestamp": start_timestamp,
+                    "end_timestamp": end_timestamp,
+                    **action,
+                })
+
+        return rows
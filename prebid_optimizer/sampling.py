@@ -0,0 +1,95 @@
+"""
+Sampling structures published with the distributions, so clients can pick
+an action in constant time from a single random number instead of
+normalizing prob_to_win and scanning the actions on every page view.
+
+The probabilities are quantized to integer weights summing to SCALE, and
+both structures describe exactly that quantized distribution:
+- cumulative: running sums of the weights, the action is the first index
+  whose cumulative weight is > floor(u * SCALE)
+- alias (Walker/Vose alias table): with n actions and x = floor(u * n *
+  SCALE), i = floor(x / SCALE), the action is i if x % SCALE <
+  thresholds[i], else aliases[i]
+"""
+
+import hashlib
+import json
+
+
+SCALE = 2 ** 16
+
+# Length of the version string (hex digits of a sha256)
+VERSION_LENGTH = 16
+
+
+def quantize(probabilities, scale=SCALE):
+    """ Integer weights proportional to the probabilities that sum to
+    scale (largest remainder rounding) """
+    total = sum(probabilities)
+    if total <= 0:
+        probabilities = [1] * len(probabilities)
+        total = len(probabilities)
+
+    exact = [p / total * scale for p in probabilities]
+    weights = [int(w) for w in exact]
+    # Remaining units go to the largest remainders, ties to the first action
+    order = sorted(range(len(exact)), key=lambda i: (weights[i] - exact[i], i))
+    for i in order[:scale - sum(weights)]:
+        weights[i] += 1
+
+    return weights
+
+
+def build_cumulative(weights):
+    cumulative = []
+    total = 0
+    for weight in weights:
+        total += weight
+        cumulative.append(total)
+
+    return cumulative
+
+
+def build_alias_table(weights, scale=SCALE):
+    """ Vose's alias method on integer weights summing to scale. Returns the
+    thresholds (in [0, scale]) and aliases of every column. """
+    n = len(weights)
+    scaled = [weight * n for weight in weights]
+    thresholds = [scale] * n
+    aliases = list(range(n))
+
+    small = [i for i, w in enumerate(scaled) if w < scale]
+    large = [i for i, w in enumerate(scaled) if w >= scale]
+    while small and large:
+        less = small.pop()
+        more = large.pop()
+
+        thresholds[less] = scaled[less]
+        aliases[less] = more
+        scaled[more] -= scale - scaled[less]
+        if scaled[more] < scale:
+            small.append(more)
+        else:
+            large.append(more)
+
+    # What is left is (exactly, the weights being integers) full columns
+    return thresholds, aliases
+
+
+def get_version(actions):
+    """ Content hash of the actions, changes whenever the distributions do
+    and can be used as an ETag """
+    actions_str = json.dumps(actions, sort_keys=True)
+    return hashlib.sha256(actions_str.encode("utf-8")).hexdigest()[
+        :VERSION_LENGTH]
+
+
+def get_sampling(probabilities):
+    weights = quantize(probabilities)
+    thresholds, aliases = build_alias_table(weights)
+
+    return {
+        "scale": SCALE,
+        "cumulative": build_cumulative(weights),
+        "alias": {"thresholds": thresholds, "aliases": aliases},
+    }
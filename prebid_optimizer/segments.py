@@ -0,0 +1,259 @@
+"""
+Segment-level optimization: computes prob_to_win for every (config_id,
+segment) pair, where the segments are the ad units of the config.
+
+Looping TSOptimizer over thousands of segments would multiply the runtime by
+the number of segments, so the Beta-LogNormal model is evaluated on arrays
+of the statistics of all (segment, action, hour) triples instead:
+- the statistics are read once, aggregated per (hour, segment, config) by
+  BigQuery, and laid out as dense (segments, actions, hours) arrays
+- every draw of the bucket picks an hour (with probability proportional to
+  the segment's requests in that hour, like resampling the concatenated
+  hourly reward arrays does) and draws one reward from the posterior of
+  that hour, so the draws of all segments are made at once
+- segments are processed in chunks that bound the number of draws held in
+  memory, and each chunk is written as one newline-delimited JSON shard
+  (segments-00000-of-00042.jsonl, ...) that can be loaded into BQ with a
+  wildcard URI
+
+The GammaModel fit is an iterative optimization per action and hour that
+does not vectorize, so segmented mode only supports the Beta-LogNormal
+model.
+"""
+
+import json
+
+import numpy as np
+import pandas as pd
+
+from prebid_optimizer.deadline import DeadlineExceeded
+from prebid_optimizer.models import BetaLogNormalModel
+from prebid_optimizer.optimizer import STATUS_NOT_ENOUGH_DATA
+from prebid_optimizer.optimizer import STATUS_OK
+from prebid_optimizer.optimizer import STATUS_QUERY_OVER_BUDGET
+from prebid_optimizer.optimizer import STATUS_TIMEOUT
+from prebid_optimizer.optimizer import TSOptimizer
+from prebid_optimizer.reader import QueryTooExpensiveError
+from prebid_optimizer.stats import STAT_FIELDS
+from prebid_optimizer.utils import write_text
+
+
+# Maximum number of reward draws (segments * actions * bucket_size) held in
+# memory at once
+MAX_DRAWS = 2 ** 21
+
+# Segment of the requests whose ad unit code is NULL
+NULL_SEGMENT = ""
+
+
+class SegmentedOptimizer(TSOptimizer):
+    def __init__(self, *args, max_draws=MAX_DRAWS, **kwargs):
+        super().__init__(*args, **kwargs)
+        if not isinstance(self.model, BetaLogNormalModel):
+            raise ValueError("Segmented mode only supports the "
+                             "beta_lognormal model")
+
+        self.max_draws = max_draws
+
+    def get_segment_arrays(self, stats):
+        """ Lays out the statistics of reader.get_segment_stats as arrays
+        of shape (segments, actions, hours). Returns the segments, the
+        arrays and the (segments, hours) totals over all configs. """
+        config_fields = sorted(self.config_combos[0])
+        actions = pd.DataFrame(self.config_combos)
+        actions["action"] = np.arange(len(self.config_combos))
+
+        segment_idx, segments = pd.factorize(
+            stats["segment"].fillna(NULL_SEGMENT), sort=True)
+        hour_idx, hours = pd.factorize(stats["auction_hour"], sort=True)
+        action_idx = stats[config_fields].merge(actions, how="left",
+                                                on=config_fields)["action"]
+
+        num_segments = len(segments)
+        num_actions = len(self.config_combos)
+        num_hours = len(hours)
+
+        hour_totals = {}
+        for field in ["num_trials", "sum_pubrev"]:
+            hour_totals[field] = np.bincount(
+                segment_idx * num_hours + hour_idx,
+                weights=stats[field].astype(float),
+                minlength=num_segments * num_hours,
+            ).reshape(num_segments, num_hours)
+
+        # Rows of configs that are not being optimized only count in the
+        # hourly totals
+        known = action_idx.notna().to_numpy()
+        flat_idx = (segment_idx[known] * num_actions
+                    + action_idx[known].to_numpy().astype(int)) * num_hours \
+                    + hour_idx[known]
+        arrays = {}
+        for field in STAT_FIELDS:
+            arrays[field] = np.bincount(
+                flat_idx,
+                weights=stats[field][known].astype(float),
+                minlength=num_segments * num_actions * num_hours,
+            ).reshape(num_segments, num_actions, num_hours)
+
+        return list(segments), arrays, hour_totals
+
+    def _sample_win_counts(self, arrays, hour_totals):
+        """ Returns how often each action wins among bucket_size draws of
+        every segment, shape (segments, actions) """
+        num_segments, num_actions, num_hours = arrays["num_trials"].shape
+        hyperparams = self.model.get_posterior_hyperparams_from_arrays(arrays)
+
+        num_trials = hour_totals["num_trials"]
+        global_mean = np.divide(hour_totals["sum_pubrev"], num_trials,
+                                out=np.zeros_like(num_trials),
+                                where=num_trials > 0)
+
+        # Hour of every draw, drawn with probability proportional to the
+        # segment's requests in that hour. Offsetting the cumulative
+        # weights of segment s by s lets one searchsorted handle all
+        # segments.
+        segment_trials = num_trials.sum(axis=1, keepdims=True)
+        weights = np.divide(num_trials, segment_trials,
+                            out=np.full_like(num_trials, 1 / num_hours),
+                            where=segment_trials > 0)
+        cum_weights = weights.cumsum(axis=1)
+        cum_weights[:, -1] = 1
+
+        offsets = np.arange(num_segments)
+        draws = np.random.random((num_segments, num_actions,
+                                  self.bucket_size)) \
+                + offsets[:, None, None]
+        hour_idx = np.searchsorted(
+            (cum_weights + offsets[:, None]).ravel(), draws.ravel(),
+            side="right").reshape(draws.shape) \
+            - offsets[:, None, None] * num_hours
+        hour_idx = np.clip(hour_idx, 0, num_hours - 1)
+
+        segment_idx = offsets[:, None, None]
+        action_idx = np.arange(num_actions)[None, :, None]
+        rewards = self.model.sample_rewards_from_hyperparams(
+            {key: values[segment_idx, action_idx, hour_idx]
+             for key, values in hyperparams.items()},
+            global_mean[segment_idx, hour_idx])
+
+        winners = rewards.argmax(axis=1)
+        return (winners[:, None, :] == action_idx).sum(axis=2)
+
+    def _get_latest_basic_stats(self, arrays):
+        """ Vectorized _get_basic_stats of the latest hour """
+        num_trials = arrays["num_trials"][:, :, -1]
+        num_wins = arrays["num_wins"][:, :, -1]
+        enough_wins = num_wins > self.min_wins
+
+        safe_wins = np.where(enough_wins, num_wins, 2)
+        mean = arrays["sum_log_pubrev"][:, :, -1] / safe_wins
+        std = np.sqrt(np.maximum(
+            (arrays["sum_sq_log_pubrev"][:, :, -1] - safe_wins * mean ** 2)
+            / (safe_wins - 1), 0))
+
+        return (num_trials, num_wins, np.where(enough_wins, mean, 0),
+                np.where(enough_wins, std, 0))
+
+    def get_probs_to_win(self, arrays, hour_totals):
+        """ Returns the prob_to_win of every (segment, action) and whether
+        each segment had enough data. Segments without enough data get the
+        default (uniform) probabilities. """
+        num_actions = len(self.config_combos)
+
+        win_counts = self._sample_win_counts(arrays, hour_totals)
+        probs_to_win = np.round((win_counts + self.boost)
+                                / (self.bucket_size
+                                   + num_actions * self.boost), 4)
+
+        total_wins = arrays["num_wins"].sum(axis=(1, 2))
+        enough_data = total_wins >= num_actions * self.min_wins
+        probs_to_win[~enough_data] = 1 / num_actions
+
+        return probs_to_win, enough_data
+
+    def _get_chunk_results(self, segments, arrays, hour_totals):
+        probs_to_win, enough_data = self.get_probs_to_win(arrays, hour_totals)
+
+        num_trials, num_wins, log_pubrev_mean, log_pubrev_std \
+            = self._get_latest_basic_stats(arrays)
+
+        rows = []
+        for i, segment in enumerate(segments):
+            row = {"segment": segment, "actions": []}
+            if enough_data[i]:
+                row["status"] = STATUS_OK
+                for j, config_combo in enumerate(self.config_combos):
+                    row["actions"].append({
+                        "config": config_combo,
+                        "prob_to_win": float(probs_to_win[i, j]),
+                        "num_trials": int(num_trials[i, j]),
+                        "num_wins": int(num_wins[i, j]),
+                        "log_pubrev_mean": float(log_pubrev_mean[i, j]),
+                        "log_pubrev_std": float(log_pubrev_std[i, j]),
+                    })
+            else:
+                row["status"] = STATUS_NOT_ENOUGH_DATA
+                row["actions"] = self._get_default_distributions()["actions"]
+
+            rows.append(row)
+
+        return rows
+
+    def iter_segment_results(self, stats):
+        """ Yields the results of the segments, one list per chunk """
+        segments, arrays, hour_totals = self.get_segment_arrays(stats)
+        chunk_size = self.get_chunk_size()
+
+        for start in range(0, len(segments), chunk_size):
+            end = start + chunk_size
+            yield self._get_chunk_results(
+                segments[start:end],
+                {field: values[start:end] for field, values in arrays.items()},
+                {field: values[start:end]
+                 for field, values in hour_totals.items()})
+
+    def get_chunk_size(self):
+        """ Number of segments whose draws fit in max_draws """
+        return max(1, self.max_draws
+                      // (len(self.config_combos) * self.bucket_size))
+
+    def get_num_chunks(self, num_segments):
+        return -(-num_segments // self.get_chunk_size())
+
+    def generate_segment_distributions(self, start_timestamp, end_timestamp,
+                                       output_dir, storage_client=None):
+        """ Writes the results of every segment to newline-delimited JSON
+        shards in output_dir (local or gs://). Returns a summary, whose
+        status is not ok if the statistics could not be read (nothing is
+        written then). """
+        summary = {"status": STATUS_OK, "num_segments": 0, "num_shards": 0,
+                   "statuses": {}}
+        try:
+            stats = self.reader.get_segment_stats(start_timestamp,
+                                                  end_timestamp)
+        except QueryTooExpensiveError as e:
+            print(f"Skipping the segments: {e}")
+            summary["status"] = STATUS_QUERY_OVER_BUDGET
+        except DeadlineExceeded as e:
+            print(f"Skipping the segments: {e}")
+            summary["status"] = STATUS_TIMEOUT
+        if summary["status"] != STATUS_OK:
+            summary["query_metrics"] = list(self.reader.query_metrics)
+            return summary
+
+        num_segments = stats["segment"].fillna(NULL_SEGMENT).nunique()
+        num_shards = self.get_num_chunks(num_segments)
+        summary.update({"num_segments": num_segments,
+                        "num_shards": num_shards})
+        for shard_index, rows in enumerate(self.iter_segment_results(stats)):
+            path = f"{output_dir}/segments-{shard_index:05d}-of-" \
+                   f"{num_shards:05d}.jsonl"
+            data = "".join(json.dumps(row) + "\n" for row in rows)
+            write_text(path, data, storage_client)
+
+            for row in rows:
+                statuses = summary["statuses"]
+                statuses[row["status"]] = statuses.get(row["status"], 0) + 1
+
+        summary["query_metrics"] = list(self.reader.query_metrics)
+        return summary
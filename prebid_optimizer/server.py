@@ -0,0 +1,303 @@
+"""
+Serves the published distributions of all configs from memory, so the edge
+layer does not fetch one distributions.json blob from GCS per config.
+
+The server refreshes its snapshot as soon as a run has published (it
+receives SIGUSR1, or `trigger_file` shows up on disk, see
+`optimizer --serve_trigger_file`), and every `refresh_seconds` in case a
+trigger was missed. A refresh lists the bucket, downloads the distributions
+whose blob generation changed since the last refresh and swaps the whole
+snapshot at once, so a lookup, even a batch one, never mixes two refreshes.
+Staged rows of sharded runs (under sharding.STAGING_PREFIX) are skipped.
+
+Endpoints:
+- GET /distributions/{config_id}: the config's distributions.json, with an
+  ETag (its version). Answers 304 if If-None-Match matches.
+- GET /distributions?config_ids=a,b,c: {"distributions": {config_id:
+  distributions}, "missing": [config_id, ...]}, with an ETag over all the
+  requested configs.
+- GET /healthz: number of configs and time of the last refresh.
+"""
+
+from datetime import datetime
+import hashlib
+import http.server
+import json
+import os
+import threading
+import time
+import urllib.parse
+
+from prebid_optimizer.session import get_default_session
+from prebid_optimizer.sharding import STAGING_PREFIX
+
+
+DISTRIBUTIONS_FILE = "distributions.json"
+
+
+def get_etag(distributions_str):
+    """ The version of the distributions (see sampling.get_version), or a
+    hash of the blob for distributions published before versions """
+    try:
+        version = json.loads(distributions_str).get("version")
+    except ValueError:
+        version = None
+    if not version:
+        version = hashlib.sha256(
+            distributions_str.encode("utf-8")).hexdigest()[:16]
+
+    return f'"{version}"'
+
+
+def get_config_id(blob_name):
+    """ Config id of a {config_id}/distributions.json blob, None for any
+    other blob """
+    config_id, _, file_name = blob_name.rpartition("/")
+    if file_name != DISTRIBUTIONS_FILE or not config_id or "/" in config_id \
+            or config_id == STAGING_PREFIX:
+        return None
+
+    return config_id
+
+
+def load_distributions(gcs_bucket, storage_client, previous=None):
+    """ Returns {config_id: entry} for all published configs. Entries of
+    `previous` whose blob generation did not change are reused. """
+    previous = previous or {}
+
+    snapshot = {}
+    for blob in storage_client.list_blobs(gcs_bucket):
+        config_id = get_config_id(blob.name)
+        if config_id is None:
+            continue
+
+        # Read once, the blob may be overwritten during the download. An
+        # older generation with a newer body is only downloaded again.
+        generation = blob.generation
+        entry = previous.get(config_id)
+        if entry is None or entry["generation"] != generation:
+            distributions_str = blob.download_as_text()
+            entry = {
+                "body": distributions_str.encode("utf-8"),
+                "etag": get_etag(distributions_str),
+                "generation": generation,
+            }
+        snapshot[config_id] = entry
+
+    return snapshot
+
+
+class DistributionStore:
+    """ In-memory snapshot of the distributions. The snapshot is replaced,
+    never modified, so readers only need a reference to it. """
+    def __init__(self, snapshot=None):
+        self.snapshot = snapshot or {}
+        self.loaded_at = None
+
+    def swap(self, snapshot):
+        self.snapshot = snapshot
+        self.loaded_at = datetime.utcnow()
+
+    def get(self, config_id):
+        return self.snapshot.get(config_id)
+
+    def get_many(self, config_ids):
+        """ Returns the body and ETag of a batch lookup """
+        snapshot = self.snapshot
+
+        found = [config_id for config_id in config_ids
+                 if config_id in snapshot]
+        missing = [config_id for config_id in config_ids
+                   if config_id not in snapshot]
+
+        # The published bodies are already JSON, so they are spliced in
+        # rather than parsed and serialized again
+        parts = [json.dumps(config_id).encode("utf-8") + b": "
+                 + snapshot[config_id]["body"] for config_id in found]
+        body = b'{"distributions": {' + b", ".join(parts) \
+                + b'}, "missing": ' + json.dumps(missing).encode("utf-8") \
+                + b"}"
+
+        etags = ",".join(f"{config_id}={snapshot[config_id]['etag']}"
+                         for config_id in found)
+        etag = hashlib.sha256(
+            f"{etags};{','.join(missing)}".encode("utf-8")).hexdigest()[:16]
+
+        return body, f'"{etag}"'
+
+
+def etag_matches(if_none_match, etag):
+    if if_none_match is None:
+        return False
+
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate in ("*", etag):
+            return True
+
+    return False
+
+
+class DistributionRequestHandler(http.server.BaseHTTPRequestHandler):
+    # Keeps the connections of the edge layer alive
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        store = self.server.store
+        url = urllib.parse.urlsplit(self.path)
+        path = url.path.rstrip("/")
+
+        if path == "/healthz":
+            loaded_at = store.loaded_at
+            body = json.dumps({
+                "num_configs": len(store.snapshot),
+                "loaded_at": loaded_at.isoformat() if loaded_at else None,
+            }).encode("utf-8")
+            self._respond(200 if loaded_at else 503, body)
+        elif path == "/distributions":
+            query = urllib.parse.parse_qs(url.query)
+            config_ids = [config_id
+                          for value in query.get("config_ids", [])
+                          for config_id in value.split(",") if config_id]
+            if not config_ids:
+                self._respond(400, b'{"error": "config_ids is required"}')
+                return
+
+            body, etag = store.get_many(config_ids)
+            self._respond(200, body, etag)
+        elif path.startswith("/distributions/"):
+            config_id = urllib.parse.unquote(path[len("/distributions/"):])
+            entry = store.get(config_id)
+            if entry is None:
+                self._respond(404, b'{"error": "unknown config_id"}')
+            else:
+                self._respond(200, entry["body"], entry["etag"])
+        else:
+            self._respond(404, b'{"error": "not found"}')
+
+    def _respond(self, status, body, etag=None):
+        if etag and etag_matches(self.headers.get("If-None-Match"), etag):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if etag:
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Lookups are too frequent to log
+        pass
+
+
+def touch_trigger_file(path):
+    """ Asks the server whose trigger_file is `path` to refresh """
+    with open(path, "a"):
+        pass
+
+
+class DistributionServer:
+    def __init__(self, gcs_bucket, storage_client=None, refresh_seconds=60,
+                 trigger_file=None, poll_seconds=1):
+        if storage_client is None:
+            storage_client = get_default_session().storage
+
+        self.gcs_bucket = gcs_bucket
+        self.storage_client = storage_client
+        self.refresh_seconds = refresh_seconds
+        self.trigger_file = trigger_file
+        self.poll_seconds = poll_seconds
+        self.store = DistributionStore()
+
+        self.httpd = None
+        self._stopped = threading.Event()
+        self._triggered = threading.Event()
+        self._refresh_thread = None
+
+    def trigger(self, *args):
+        """ Requests a refresh as soon as possible (also the SIGUSR1
+        handler) """
+        self._triggered.set()
+
+    def _consume_trigger_file(self):
+        if self.trigger_file and os.path.exists(self.trigger_file):
+            os.remove(self.trigger_file)
+            return True
+
+        return False
+
+    def reload(self):
+        """ Loads the distributions and swaps them in. Returns the number
+        of configs whose distributions changed. """
+        previous = self.store.snapshot
+        snapshot = load_distributions(self.gcs_bucket, self.storage_client,
+                                      previous)
+        self.store.swap(snapshot)
+
+        return sum(1 for config_id, entry in snapshot.items()
+                   if previous.get(config_id) is not entry)
+
+    def _wait_for_refresh(self):
+        """ Blocks until a trigger or the next periodic refresh. Returns
+        False if the server was stopped while waiting. """
+        next_refresh = time.monotonic() + self.refresh_seconds
+        while not self._stopped.is_set():
+            if self._triggered.is_set() or self._consume_trigger_file():
+                self._triggered.clear()
+                return True
+
+            remaining = next_refresh - time.monotonic()
+            if remaining <= 0:
+                return True
+
+            self._triggered.wait(min(self.poll_seconds, remaining))
+
+        return False
+
+    def _refresh_loop(self):
+        while self._wait_for_refresh():
+            try:
+                num_changed = self.reload()
+            except Exception as e:
+                # Keep serving the last snapshot
+                print(f"Could not refresh the distributions: {e}")
+                continue
+
+            if num_changed:
+                print(f"Refreshed the distributions of {num_changed} "
+                      f"configs")
+
+    def start(self, host="0.0.0.0", port=8080):
+        """ Loads the distributions, then serves them and refreshes them
+        in background threads. Returns the bound (host, port). """
+        self.reload()
+        print(f"Loaded the distributions of {len(self.store.snapshot)} "
+              f"configs from gs://{self.gcs_bucket}")
+
+        self.httpd = http.server.ThreadingHTTPServer(
+            (host, port), DistributionRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.store = self.store
+
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self._refresh_thread = threading.Thread(target=self._refresh_loop,
+                                                daemon=True)
+        self._refresh_thread.start()
+
+        return self.httpd.server_address
+
+    def stop(self):
+        self._stopped.set()
+        # Wakes the refresh loop up
+        self._triggered.set()
+        if self.httpd:
+            self.httpd.shutdown()
+            self.httpd.server_close()
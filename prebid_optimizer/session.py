@@ -0,0 +1,169 @@
+"""
+Owns the GCP clients of a process, so that every config of a run (and every
+run of the daemon) reuses the same credentials and connections instead of
+authenticating and connecting again.
+
+The BigQuery and Storage clients share one authorized HTTP session, with a
+connection pool sized for the threads that use it (pipeline stages,
+time-sharded reads), and the BigQuery Storage read client (gRPC) shares the
+credentials. Clients are created on first use.
+
+Connections cannot be shared with a forked child, so a Session used in a
+child process drops the parent's clients and creates its own. Clients
+passed to the Session (e.g. local stand-ins) are always kept. The locks are
+recreated in the child as well: a fork from another thread while a client
+is being created would otherwise leave them locked forever.
+"""
+
+import os
+import threading
+import weakref
+
+
+SCOPES = ["https://www.googleapis.com/auth/cloud-platform"]
+
+# Connections kept open per host, enough for the threads of a run
+DEFAULT_POOL_SIZE = 32
+
+CLIENT_NAMES = ["bigquery", "bigquery_storage", "storage"]
+
+# Every live Session, reset in forked children
+_sessions = weakref.WeakSet()
+
+
+class Session:
+    def __init__(self, gcp_project=None, pool_size=DEFAULT_POOL_SIZE,
+                 clients=None):
+        unknown = set(clients or {}) - set(CLIENT_NAMES)
+        if unknown:
+            raise ValueError(f"Unknown clients {sorted(unknown)}, expected "
+                             f"some of {CLIENT_NAMES}")
+
+        self.gcp_project = gcp_project
+        self.pool_size = pool_size
+        self._injected = dict(clients or {})
+
+        self._lock = threading.Lock()
+        self._reset()
+        _sessions.add(self)
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._clients = {}
+        self._credentials = None
+        self._http = None
+
+    def _check_pid(self):
+        if os.getpid() != self._pid:
+            # Forked: the parent's connections must not be used (or closed)
+            self._reset()
+
+    def _get_http(self):
+        if self._http is None:
+            import google.auth
+            from google.auth.transport.requests import AuthorizedSession
+            from requests.adapters import HTTPAdapter
+
+            self._credentials, project = google.auth.default(scopes=SCOPES)
+            self.gcp_project = self.gcp_project or project
+
+            self._http = AuthorizedSession(self._credentials)
+            adapter = HTTPAdapter(pool_connections=self.pool_size,
+                                  pool_maxsize=self.pool_size)
+            self._http.mount("https://", adapter)
+
+        return self._http
+
+    def _create(self, name):
+        http = self._get_http()
+
+        if name == "bigquery":
+            from google.cloud import bigquery
+            return bigquery.Client(project=self.gcp_project,
+                                   credentials=self._credentials, _http=http)
+        if name == "bigquery_storage":
+            from google.cloud import bigquery_storage
+            return bigquery_storage.BigQueryReadClient(
+                credentials=self._credentials)
+        if name == "storage":
+            from google.cloud import storage
+            return storage.Client(project=self.gcp_project,
+                                  credentials=self._credentials, _http=http)
+
+    def get(self, name):
+        if name not in CLIENT_NAMES:
+            raise ValueError(f"Unknown client {name}, expected one of "
+                             f"{CLIENT_NAMES}")
+        if name in self._injected:
+            return self._injected[name]
+
+        with self._lock:
+            self._check_pid()
+            if name not in self._clients:
+                self._clients[name] = self._create(name)
+
+            return self._clients[name]
+
+    @property
+    def bigquery(self):
+        return self.get("bigquery")
+
+    @property
+    def bigquery_storage(self):
+        return self.get("bigquery_storage")
+
+    @property
+    def storage(self):
+        return self.get("storage")
+
+    def close(self):
+        """ Closes the connections created by this process """
+        with self._lock:
+            self._check_pid()
+            for client in self._clients.values():
+                close = getattr(client, "close", None)
+                if close:
+                    close()
+            if self._http is not None:
+                self._http.close()
+
+            self._reset()
+
+
+_default_session = None
+_default_session_lock = threading.Lock()
+
+
+def get_default_session():
+    """ The session used by everything that is not given a client or a
+    session explicitly """
+    global _default_session
+    with _default_session_lock:
+        if _default_session is None:
+            _default_session = Session()
+
+        return _default_session
+
+
+def set_default_session(session):
+    """ Replaces the default session, e.g. with one holding local
+    stand-ins. Returns the previous one. """
+    global _default_session
+    with _default_session_lock:
+        previous, _default_session = _default_session, session
+
+    return previous
+
+
+def _after_fork_in_child():
+    """ Only the forking thread survives a fork, a lock held by any other
+    thread would never be released """
+    global _default_session_lock
+    _default_session_lock = threading.Lock()
+    for session in list(_sessions):
+        session._lock = threading.Lock()
+        session._reset()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
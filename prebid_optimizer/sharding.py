@@ -0,0 +1,162 @@
+"""
+Splits the configs of a run across several processes (e.g. containers of
+the same image), each started with its own --shard_index and the same
+--num_shards.
+
+Configs are assigned to shards either by a stable hash of the config id or,
+if the expected cost of every config is known (see costs.CostHistory), by a
+greedy longest-first split that balances the total cost of the shards. Both
+only depend on their inputs, so every shard computes the same assignment
+without coordinating.
+
+Sharded runs do not append to the BQ output table directly: every config's
+row is staged in GCS under the run's prefix and every shard writes a marker
+when it is done. `mergeShardedRun` then loads all staged rows with a single
+BQ load job once all shards are done. It marks each of its steps done under
+the run's prefix, so rerunning it (e.g. after it failed half way) never
+loads the rows or updates the cost history twice.
+"""
+
+import hashlib
+import json
+
+from prebid_optimizer import round_to_hour
+from prebid_optimizer.session import get_default_session
+
+
+STAGING_PREFIX = "_staging"
+
+
+def get_shard(config_id, num_shards):
+    """ Stable (across processes and Python versions) shard of a config """
+    digest = hashlib.md5(config_id.encode("utf-8")).hexdigest()
+    return int(digest, 16) % num_shards
+
+
+def assign_shards(config_ids, num_shards, costs=None):
+    """ Returns {config_id: shard_index}. Without costs configs are assigned
+    by hash, otherwise the most expensive configs are assigned first, each
+    to the shard with the lowest total cost so far. costs must have every
+    config, costs.CostHistory.get_costs decides the cost of the configs
+    without history. """
+    if not costs:
+        return {config_id: get_shard(config_id, num_shards)
+                for config_id in config_ids}
+
+    shard_costs = [0] * num_shards
+    assignment = {}
+    # Sorting by config_id as well keeps ties deterministic
+    for config_id in sorted(config_ids, key=lambda c: (-costs[c], c)):
+        shard_index = min(range(num_shards), key=lambda i: shard_costs[i])
+        assignment[config_id] = shard_index
+        shard_costs[shard_index] += costs[config_id]
+
+    return assignment
+
+
+def select_shard(config_ids, shard_index, num_shards, costs=None):
+    """ Returns the configs (in their original order) of one shard """
+    if not 0 <= shard_index < num_shards:
+        raise ValueError(f"shard_index must be in [0, {num_shards}), "
+                         f"got {shard_index}")
+
+    assignment = assign_shards(config_ids, num_shards, costs)
+    return [config_id for config_id in config_ids
+            if assignment[config_id] == shard_index]
+
+
+def get_run_prefix(run_timestamp):
+    """ GCS prefix of the staged results of a run. All shards of a run use
+    the same prefix as long as they start within the same hour. """
+    run_hour = round_to_hour(run_timestamp).strftime("%Y%m%d%H")
+    return f"{STAGING_PREFIX}/run-{run_hour}"
+
+
+def get_rows_path(run_prefix):
+    return f"{run_prefix}/rows"
+
+
+def get_marker_path(run_prefix, shard_index, num_shards):
+    return f"{run_prefix}/_SUCCESS-shard-{shard_index}-of-{num_shards}"
+
+
+def get_loaded_marker_path(run_prefix):
+    return f"{run_prefix}/_LOADED"
+
+
+def get_merged_marker_path(run_prefix):
+    return f"{run_prefix}/_MERGED"
+
+
+def markShardDone(gcs_bucket, run_prefix, shard_index, num_shards,
+                  storage_client=None):
+    if storage_client is None:
+        storage_client = get_default_session().storage
+
+    marker_path = get_marker_path(run_prefix, shard_index, num_shards)
+    blob = storage_client.bucket(gcs_bucket).blob(marker_path)
+    blob.upload_from_string("")
+    print(f"Shard {shard_index} of {num_shards} done: "
+          f"gs://{gcs_bucket}/{marker_path}")
+
+
+def mergeShardedRun(gcs_bucket, run_prefix, num_shards, bq_table_id,
+                    client=None, storage_client=None, cost_history=None):
+    """ Loads the rows staged by all shards of a run into the BQ output table.
+    Raises if a shard has not finished yet. Returns the number of rows
+    loaded (0 if a previous merge of the run already loaded them).
+
+    If a costs.CostHistory is given, it is updated with the runtimes of the
+    staged rows. Updating it here rather than in the shards means every
+    shard of a run splits the configs based on the same history. """
+    from prebid_optimizer.exporter import get_load_job_config
+
+    if storage_client is None:
+        storage_client = get_default_session().storage
+    if client is None:
+        client = get_default_session().bigquery
+
+    bucket = storage_client.bucket(gcs_bucket)
+    if bucket.get_blob(get_merged_marker_path(run_prefix)) is not None:
+        print(f"gs://{gcs_bucket}/{run_prefix} was already merged")
+        return 0
+
+    missing = [shard_index for shard_index in range(num_shards)
+               if bucket.get_blob(get_marker_path(run_prefix, shard_index,
+                                                  num_shards)) is None]
+    if missing:
+        raise RuntimeError(f"Shards {missing} of {num_shards} have not "
+                           f"finished gs://{gcs_bucket}/{run_prefix}")
+
+    rows_path = get_rows_path(run_prefix)
+    row_blobs = list(storage_client.list_blobs(gcs_bucket,
+                                               prefix=f"{rows_path}/"))
+    if not row_blobs:
+        print(f"No rows staged under gs://{gcs_bucket}/{run_prefix}")
+        return 0
+
+    num_loaded = 0
+    loaded_marker_path = get_loaded_marker_path(run_prefix)
+    if bucket.get_blob(loaded_marker_path) is None:
+        source_uri = f"gs://{gcs_bucket}/{rows_path}/*"
+        load_job = client.load_table_from_uri(
+            source_uri, bq_table_id, job_config=get_load_job_config())
+        load_job.result()
+        bucket.blob(loaded_marker_path).upload_from_string("")
+        num_loaded = len(row_blobs)
+
+        print(f"Loaded {num_loaded} rows from {source_uri} into "
+              f"{bq_table_id}")
+    else:
+        # A previous merge failed after the load
+        print(f"Rows of gs://{gcs_bucket}/{run_prefix} already loaded")
+
+    if cost_history is not None:
+        for blob in row_blobs:
+            row = json.loads(blob.download_as_text())
+            if row.get("runtime_seconds") is not None:
+                cost_history.update_from_results(row["bundleID"], row)
+        cost_history.save()
+
+    bucket.blob(get_merged_marker_path(run_prefix)).upload_from_string("")
+    return num_loaded
@@ -0,0 +1,220 @@
+"""
+Zero-copy sharing of a config's raw rows (TSReader.get_data) with worker
+processes. Pickling the dataframe into every worker would copy it once per
+worker, so the rows are instead published once as columnar arrays in a
+shared memory block:
+- auction_hour (int32), action (int16, index in the optimizer's
+  config_combos, -1 for configs that are not optimized), win (bool) and
+  pubrev (float64)
+- rows are sorted by auction_hour, so the rows of a range of hours are a
+  slice of every column
+- workers attach to the block by name (SharedDataset.descriptor is small
+  and picklable) and read the columns as numpy arrays on the shared buffer
+
+The process that publishes a dataset owns the block: it is unlinked when
+the owner closes it (or leaves the `with` block), when the owner is garbage
+collected or at exit. If the process is killed, the multiprocessing
+resource tracker unlinks it.
+"""
+
+import multiprocessing
+from multiprocessing import shared_memory
+import weakref
+
+import numpy as np
+
+from prebid_optimizer.stats import STAT_FIELDS
+
+
+COLUMNS = [
+    ("auction_hour", "int32"),
+    ("action", "int16"),
+    ("win", "bool"),
+    ("pubrev", "float64"),
+]
+
+# Columns start on cache line boundaries
+ALIGNMENT = 64
+
+
+def get_action_codes(df, config_combos):
+    """ Index of every row's config in config_combos, -1 if absent """
+    import pandas as pd
+
+    config_fields = sorted(config_combos[0])
+    actions = pd.DataFrame(config_combos)
+    actions["action"] = np.arange(len(config_combos))
+
+    codes = df[config_fields].merge(actions, how="left",
+                                    on=config_fields)["action"]
+    return codes.fillna(-1).to_numpy().astype("int16")
+
+
+def _get_layout(num_rows):
+    layout = []
+    offset = 0
+    for name, dtype in COLUMNS:
+        layout.append((name, dtype, offset))
+        size = num_rows * np.dtype(dtype).itemsize
+        offset += -(-size // ALIGNMENT) * ALIGNMENT
+
+    return layout, offset
+
+
+def _release(shm, owner):
+    try:
+        shm.close()
+    except BufferError:
+        # Arrays on the buffer are still alive, the memory is unmapped when
+        # they are freed
+        pass
+    if owner:
+        try:
+            shm.unlink()
+        except FileNotFoundError:
+            pass
+
+
+class SharedDataset:
+    def __init__(self, shm, descriptor, owner):
+        self._shm = shm
+        self.descriptor = descriptor
+        self.owner = owner
+        self.columns = {
+            name: np.ndarray((descriptor["num_rows"],), dtype=dtype,
+                             buffer=shm.buf, offset=offset)
+            for name, dtype, offset in descriptor["columns"]
+        }
+        self._finalizer = weakref.finalize(self, _release, shm, owner)
+
+    @classmethod
+    def publish(cls, df, config_combos):
+        """ Copies the rows of a raw dataframe (auction_hour, config fields,
+        pubrev) into a new shared memory block """
+        df = df.sort_values("auction_hour", kind="stable")
+        num_rows = len(df)
+        layout, size = _get_layout(num_rows)
+
+        # A block can not be empty
+        shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        descriptor = {
+            "name": shm.name,
+            "num_rows": num_rows,
+            "num_actions": len(config_combos),
+            "columns": layout,
+        }
+        dataset = cls(shm, descriptor, owner=True)
+
+        dataset["auction_hour"][:] = df["auction_hour"].to_numpy()
+        dataset["action"][:] = get_action_codes(df, config_combos)
+        dataset["pubrev"][:] = df["pubrev"].to_numpy()
+        dataset["win"][:] = dataset["pubrev"] > 0
+
+        return dataset
+
+    @classmethod
+    def attach(cls, descriptor):
+        """ Maps the block of a published dataset, without copying """
+        shm = shared_memory.SharedMemory(name=descriptor["name"])
+        return cls(shm, descriptor, owner=False)
+
+    @property
+    def name(self):
+        return self.descriptor["name"]
+
+    @property
+    def num_rows(self):
+        return self.descriptor["num_rows"]
+
+    def __getitem__(self, column):
+        return self.columns[column]
+
+    def get_hour_slice(self, first_hour, last_hour):
+        """ Rows of the hours in [first_hour, last_hour) """
+        hours = self["auction_hour"]
+        return slice(np.searchsorted(hours, first_hour, side="left"),
+                     np.searchsorted(hours, last_hour, side="left"))
+
+    def close(self):
+        """ Unmaps the block, and unlinks it if this process published it """
+        self.columns = {}
+        self._finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def aggregate_hours(dataset, first_hour, last_hour):
+    """ Statistics (see stats.py) of every (hour, action) in [first_hour,
+    last_hour), as arrays of shape (hours, actions) """
+    rows = dataset.get_hour_slice(first_hour, last_hour)
+    num_actions = dataset.descriptor["num_actions"]
+    num_hours = last_hour - first_hour
+
+    action = dataset["action"][rows]
+    known = action >= 0
+    flat_idx = (dataset["auction_hour"][rows][known] - first_hour) \
+                * num_actions + action[known]
+    pubrev = dataset["pubrev"][rows][known]
+    log_pubrev = np.log(pubrev + 1)
+
+    weights = {
+        "num_trials": None,
+        "num_wins": dataset["win"][rows][known],
+        "sum_pubrev": pubrev,
+        "sum_log_pubrev": log_pubrev,
+        "sum_sq_log_pubrev": log_pubrev ** 2,
+    }
+    return {
+        field: np.bincount(flat_idx, weights=weights[field],
+                           minlength=num_hours * num_actions)
+                 .reshape(num_hours, num_actions)
+        for field in STAT_FIELDS
+    }
+
+
+def _aggregate_shared_hours(descriptor, first_hour, last_hour):
+    with SharedDataset.attach(descriptor) as dataset:
+        return aggregate_hours(dataset, first_hour, last_hour)
+
+
+def get_hourly_stats(dataset, config_combos, num_workers=None):
+    """ Same statistics as TSReader.get_hourly_stats, aggregated by
+    num_workers processes that each attach to the dataset and aggregate a
+    range of hours """
+    import pandas as pd
+
+    hours = dataset["auction_hour"]
+    num_hours = int(hours[-1]) + 1 if len(hours) else 0
+    num_workers = max(1, min(num_workers or multiprocessing.cpu_count(),
+                             num_hours))
+    bounds = [num_hours * i // num_workers for i in range(num_workers + 1)]
+    ranges = list(zip(bounds[:-1], bounds[1:]))
+
+    if num_workers == 1:
+        results = [aggregate_hours(dataset, *hour_range)
+                   for hour_range in ranges]
+    else:
+        with multiprocessing.Pool(num_workers) as pool:
+            results = pool.starmap(
+                _aggregate_shared_hours,
+                [(dataset.descriptor, *hour_range) for hour_range in ranges])
+
+    arrays = {field: np.concatenate([result[field] for result in results])
+              if results else np.zeros((0, len(config_combos)))
+              for field in STAT_FIELDS}
+
+    hour_idx, action_idx = np.nonzero(arrays["num_trials"])
+    stats = pd.DataFrame({"auction_hour": hour_idx})
+    configs = pd.DataFrame([config_combos[i] for i in action_idx],
+                           columns=sorted(config_combos[0]))
+    stats = pd.concat([stats, configs], axis=1)
+    for field in STAT_FIELDS:
+        stats[field] = arrays[field][hour_idx, action_idx]
+    for field in ["num_trials", "num_wins"]:
+        stats[field] = stats[field].astype("int64")
+
+    return stats
@@ -0,0 +1,293 @@
+"""
+Offline evaluation of the optimizer on simulated traffic, to compare models
+and settings (min_probability, bucket_size, hour_window, ...) without
+spending real traffic.
+
+Every hour of a simulation, the optimizer is fitted on the statistics of
+the hours in its window (hour_window hours, data_delay_hour hours ago),
+the hour's auctions are split between the actions by its prob_to_win, and
+wins and pubrev are drawn from the scenario's (non-stationary) win rates
+and pubrev distributions. The regret of an hour is the expected pubrev per
+auction of the best action minus that of the allocation.
+
+Replications are simulated together: the Beta-LogNormal model is fitted on
+all replications at once with the vectorized code of segmented mode (each
+replication is a segment), other models are fitted per replication with
+the per-config code. Blocks of replications run in parallel processes.
+"""
+
+import contextlib
+import io
+import multiprocessing
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from prebid_optimizer import MIN_PROBABILITY
+from prebid_optimizer.optimizer import TSOptimizer
+from prebid_optimizer.segments import SegmentedOptimizer
+from prebid_optimizer.stats import STAT_FIELDS
+
+
+CONFIG_FIELD = "bidderTimeout"
+
+VECTORIZED_MODEL_TYPES = ["default", "beta_lognormal"]
+
+
+def make_scenario(num_hours=48, num_actions=3, win_rate=0.11, delta=0.01,
+                  amplitude=0.02, period_hours=24, log_pubrev_mean=13.3,
+                  log_pubrev_std=0.1, auctions_per_hour=10000):
+    """ Returns a scenario whose win rates are spread by delta between the
+    actions and oscillate with the given period, with a different phase per
+    action, so the best action changes during the day (as in
+    dev/simulated_thompson_sampling.ipynb) """
+    hours = np.arange(num_hours)[:, None]
+    actions = np.arange(num_actions)[None, :]
+    phases = actions * period_hours / num_actions
+    win_rates = win_rate + (actions - (num_actions - 1) / 2) * delta \
+                + amplitude * np.sin(2 * np.pi * (hours + phases)
+                                     / period_hours)
+
+    return {
+        "win_rates": np.clip(win_rates, 0, 1),
+        "log_pubrev_means": np.full((num_hours, num_actions),
+                                    float(log_pubrev_mean)),
+        "log_pubrev_std": log_pubrev_std,
+        "auctions_per_hour": auctions_per_hour,
+    }
+
+
+def get_expected_rewards(scenario):
+    """ Expected pubrev per auction of every (hour, action) """
+    std = scenario["log_pubrev_std"]
+    return scenario["win_rates"] \
+            * np.exp(scenario["log_pubrev_means"] + std ** 2 / 2)
+
+
+def simulate_hour(rng, scenario, hour, probs_to_win):
+    """ Draws the statistics of one hour of every replication, given the
+    allocation of each replication (an array of shape (replications,
+    actions)) """
+    counts = rng.multinomial(scenario["auctions_per_hour"], probs_to_win)
+    wins = rng.binomial(counts, scenario["win_rates"][hour])
+
+    mu = scenario["log_pubrev_means"][hour]
+    std = scenario["log_pubrev_std"]
+    # log(pubrev) of a win is normal, so the sum and the sum of squares of
+    # the wins' log(pubrev) can be drawn without drawing every win
+    sum_log_pubrev = wins * mu + std * np.sqrt(wins) \
+                        * rng.standard_normal(wins.shape)
+    sum_sq_deviations = np.where(
+        wins > 1, std ** 2 * rng.chisquare(np.maximum(wins - 1, 1)), 0)
+    sum_sq_log_pubrev = sum_sq_deviations + np.divide(
+        sum_log_pubrev ** 2, wins, out=np.zeros(wins.shape), where=wins > 0)
+
+    # Sum of the lognormal pubrevs, by the central limit theorem
+    mean = np.exp(mu + std ** 2 / 2)
+    var = (np.exp(std ** 2) - 1) * np.exp(2 * mu + std ** 2)
+    sum_pubrev = np.maximum(
+        wins * mean + np.sqrt(wins * var) * rng.standard_normal(wins.shape),
+        0)
+
+    return {
+        "num_trials": counts,
+        "num_wins": wins,
+        "sum_pubrev": sum_pubrev,
+        "sum_log_pubrev": sum_log_pubrev,
+        "sum_sq_log_pubrev": sum_sq_log_pubrev,
+    }
+
+
+def create_optimizer(num_actions, model_type, min_probability, bucket_size):
+    configs_to_optimize = {CONFIG_FIELD: [1000 + 500 * i
+                                          for i in range(num_actions)]}
+    cls = SegmentedOptimizer if model_type in VECTORIZED_MODEL_TYPES \
+            else TSOptimizer
+
+    return cls("simulation", bucket_size, "simulation", configs_to_optimize,
+               min_probability, model_type, use_weighted_training=False)
+
+
+def _fit_vectorized(optimizer, window):
+    num_replications, num_actions, _ = window["num_trials"].shape
+    hour_totals = {field: window[field].sum(axis=1)
+                   for field in ["num_trials", "sum_pubrev"]}
+
+    probs_to_win = np.empty((num_replications, num_actions))
+    chunk_size = optimizer.get_chunk_size()
+    for start in range(0, num_replications, chunk_size):
+        end = start + chunk_size
+        probs_to_win[start:end], _ = optimizer.get_probs_to_win(
+            {field: values[start:end] for field, values in window.items()},
+            {field: values[start:end]
+             for field, values in hour_totals.items()})
+
+    return probs_to_win
+
+
+def _get_stats_df(optimizer, arrays, replication, first_hour, last_hour):
+    """ The statistics of one replication, as returned by the reader """
+    _, num_actions, _ = arrays["num_trials"].shape
+    hours, actions = np.meshgrid(np.arange(first_hour, last_hour),
+                                 np.arange(num_actions), indexing="ij")
+    config_values = np.array([combo[CONFIG_FIELD]
+                              for combo in optimizer.config_combos])
+
+    stats = pd.DataFrame({
+        "auction_hour": hours.ravel(),
+        CONFIG_FIELD: config_values[actions.ravel()],
+    })
+    for field in STAT_FIELDS:
+        stats[field] = arrays[field][replication, actions.ravel(),
+                                     hours.ravel()]
+
+    return stats[stats["num_trials"] > 0]
+
+
+def _fit_per_replication(optimizer, arrays, first_hour, last_hour,
+                         hourly_rewards):
+    """ Fits every replication with the per-config code. The reward
+    distribution of an hour is kept in hourly_rewards (one dict per
+    replication) while the hour is in the window, like TSReplayer does. """
+    num_replications, num_actions, _ = arrays["num_trials"].shape
+    probs_to_win = np.empty((num_replications, num_actions))
+
+    for replication in range(num_replications):
+        stats = _get_stats_df(optimizer, arrays, replication, first_hour,
+                              last_hour)
+        rewards = hourly_rewards[replication]
+        for hour in [hr for hr in rewards if hr < first_hour]:
+            del rewards[hour]
+
+        if not optimizer._check_enough_data(stats):
+            probs_to_win[replication] = 1 / num_actions
+            continue
+
+        hours = sorted(stats["auction_hour"].unique())
+        for hour in hours:
+            if hour not in rewards:
+                rewards[hour] = optimizer._get_hourly_rewards(stats, hour)
+
+        results = optimizer._get_distributions(stats, hours, rewards)
+        probs_to_win[replication] = [action["prob_to_win"]
+                                     for action in results["actions"]]
+
+    return probs_to_win
+
+
+def simulate_block(scenario, policy, num_replications, seed):
+    """ Simulates num_replications replications of the scenario under the
+    policy (the settings of the optimizer). Returns the regrets, of shape
+    (replications, hours), and the seconds spent fitting. """
+    # The models draw from numpy's global random state
+    np.random.seed(seed)
+    rng = np.random.default_rng(seed)
+
+    num_hours, num_actions = scenario["win_rates"].shape
+    expected_rewards = get_expected_rewards(scenario)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        optimizer = create_optimizer(num_actions, policy["model_type"],
+                                     policy["min_probability"],
+                                     policy["bucket_size"])
+    vectorized = isinstance(optimizer, SegmentedOptimizer)
+
+    arrays = {field: np.zeros((num_replications, num_actions, num_hours))
+              for field in STAT_FIELDS}
+    hourly_rewards = [{} for _ in range(num_replications)]
+    regrets = np.zeros((num_replications, num_hours))
+    fit_seconds = 0
+
+    for hour in range(num_hours):
+        last_hour = hour - policy["data_delay_hour"]
+        first_hour = max(last_hour - policy["hour_window"], 0)
+
+        if last_hour <= first_hour:
+            probs_to_win = np.full((num_replications, num_actions),
+                                   1 / num_actions)
+        else:
+            start_time = time.perf_counter()
+            if vectorized:
+                probs_to_win = _fit_vectorized(
+                    optimizer, {field: values[:, :, first_hour:last_hour]
+                                for field, values in arrays.items()})
+            else:
+                # The per-config code logs every fit
+                with contextlib.redirect_stdout(io.StringIO()):
+                    probs_to_win = _fit_per_replication(
+                        optimizer, arrays, first_hour, last_hour,
+                        hourly_rewards)
+            fit_seconds += time.perf_counter() - start_time
+
+            # prob_to_win is rounded to 4 decimals
+            probs_to_win /= probs_to_win.sum(axis=1, keepdims=True)
+
+        regrets[:, hour] = expected_rewards[hour].max() \
+                            - probs_to_win @ expected_rewards[hour]
+
+        hour_stats = simulate_hour(rng, scenario, hour, probs_to_win)
+        for field in STAT_FIELDS:
+            arrays[field][:, :, hour] = hour_stats[field]
+
+    return regrets, fit_seconds
+
+
+def _simulate_block_star(args):
+    return simulate_block(*args)
+
+
+def simulate(scenario, model_type="default", min_probability=MIN_PROBABILITY,
+             bucket_size=10000, hour_window=6, data_delay_hour=2,
+             num_replications=1000, num_workers=None, block_size=None,
+             seed=0):
+    """ Simulates num_replications replications of the scenario, split in
+    blocks of block_size replications that run on num_workers processes
+    (defaults to one block per CPU). Returns a summary of the regret and
+    the runtime. """
+    policy = {
+        "model_type": model_type,
+        "min_probability": min_probability,
+        "bucket_size": bucket_size,
+        "hour_window": hour_window,
+        "data_delay_hour": data_delay_hour,
+    }
+    num_workers = num_workers or os.cpu_count() or 1
+    block_size = block_size or -(-num_replications // num_workers)
+
+    block_sizes = [min(block_size, num_replications - start)
+                   for start in range(0, num_replications, block_size)]
+    seeds = [int(seed_seq.generate_state(1)[0]) for seed_seq
+             in np.random.SeedSequence(seed).spawn(len(block_sizes))]
+    blocks = [(scenario, policy, size, block_seed)
+              for size, block_seed in zip(block_sizes, seeds)]
+
+    start_time = time.perf_counter()
+    if num_workers == 1:
+        block_results = [simulate_block(*block) for block in blocks]
+    else:
+        with multiprocessing.Pool(num_workers) as pool:
+            block_results = pool.map(_simulate_block_star, blocks)
+    runtime_seconds = time.perf_counter() - start_time
+
+    regrets = np.concatenate([block_regrets
+                              for block_regrets, _ in block_results])
+    cumulative_regrets = regrets.sum(axis=1)
+    optimal_reward = get_expected_rewards(scenario).max(axis=1).sum()
+
+    return {
+        **policy,
+        "num_replications": num_replications,
+        "num_hours": regrets.shape[1],
+        "mean_regret_per_hour": regrets.mean(axis=0).tolist(),
+        "mean_cumulative_regret": float(cumulative_regrets.mean()),
+        "cumulative_regret_std_error": float(
+            cumulative_regrets.std(ddof=1) / np.sqrt(num_replications))
+            if num_replications > 1 else None,
+        # Fraction of the optimal pubrev lost
+        "relative_regret": float(cumulative_regrets.mean() / optimal_reward),
+        "runtime_seconds": runtime_seconds,
+        "fit_seconds": sum(seconds for _, seconds in block_results),
+        "replications_per_second": num_replications / runtime_seconds,
+    }
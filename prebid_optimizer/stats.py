@@ -0,0 +1,84 @@
+"""
+Sufficient statistics of the reward data. Both models only depend on a few
+sums over the requests of an action, so the raw rows can be aggregated per
+(auction_hour, config fields) once and every fit is done from those sums:
+- num_trials: number of requests
+- num_wins: number of requests with pubrev > 0
+- sum_pubrev: sum of pubrev
+- sum_log_pubrev: sum of log(pubrev + 1) (zero for requests without a win)
+- sum_sq_log_pubrev: sum of log(pubrev + 1) ** 2
+"""
+
+import numpy as np
+
+
+STAT_FIELDS = [
+    "num_trials",
+    "num_wins",
+    "sum_pubrev",
+    "sum_log_pubrev",
+    "sum_sq_log_pubrev",
+]
+
+
+def get_sufficient_stats(df):
+    """ Sums the statistics of all rows of a raw dataframe (with a pubrev
+    column) into a dict """
+    pubrev = df["pubrev"]
+    log_pubrev = np.log(pubrev + 1)
+
+    return {
+        "num_trials": len(df),
+        "num_wins": int((pubrev > 0).sum()),
+        "sum_pubrev": float(pubrev.sum()),
+        "sum_log_pubrev": float(log_pubrev.sum()),
+        "sum_sq_log_pubrev": float((log_pubrev ** 2).sum()),
+    }
+
+
+def aggregate_stats(df, group_fields):
+    """ Aggregates a raw dataframe into one row of statistics per group """
+    log_pubrev = np.log(df["pubrev"] + 1)
+    df = df[group_fields].assign(
+        num_wins=(df["pubrev"] > 0).astype("int64"),
+        pubrev=df["pubrev"],
+        log_pubrev=log_pubrev,
+        sq_log_pubrev=log_pubrev ** 2,
+    )
+
+    stats = (
+        df.groupby(group_fields, dropna=False)
+        .agg(num_trials=("pubrev", "size"),
+             num_wins=("num_wins", "sum"),
+             sum_pubrev=("pubrev", "sum"),
+             sum_log_pubrev=("log_pubrev", "sum"),
+             sum_sq_log_pubrev=("sq_log_pubrev", "sum"))
+        .reset_index()
+    )
+    return stats
+
+
+def sum_stats(stats_df):
+    """ Sums the statistics of a dataframe of aggregated rows into a dict """
+    totals = stats_df[STAT_FIELDS].sum()
+    stats = {field: float(totals[field]) for field in STAT_FIELDS}
+    stats["num_trials"] = int(stats["num_trials"])
+    stats["num_wins"] = int(stats["num_wins"])
+
+    return stats
+
+
+def get_log_pubrev_moments(stats):
+    """ Returns the mean and the (sample) standard deviation of log(pubrev + 1)
+    of the winning requests """
+    num_wins = stats["num_wins"]
+    if num_wins == 0:
+        return np.nan, np.nan
+
+    mean = stats["sum_log_pubrev"] / num_wins
+    if num_wins == 1:
+        return mean, np.nan
+
+    variance = (stats["sum_sq_log_pubrev"] - num_wins * mean ** 2) \
+                / (num_wins - 1)
+    return mean, np.sqrt(max(variance, 0))
@@ -1,14 +1,18 @@
 import os
-from google.cloud import storage
 
+from prebid_optimizer.session import get_default_session
 
-def upload_blob(bucket_name, source_file_name, destination_blob_name):
+
+def upload_blob(bucket_name, source_file_name, destination_blob_name,
+                storage_client=None):
     """Uploads a file to the bucket."""
     # bucket_name = "your-bucket-name"
     # source_file_name = "local/path/to/file"
     # destination_blob_name = "storage-object-name"
 
-    storage_client = storage.Client()
+    if storage_client is None:
+        storage_client = get_default_session().storage
+
     bucket = storage_client.bucket(bucket_name)
     blob = bucket.blob(destination_blob_name)
 
@@ -19,3 +23,45 @@ def upload_blob(bucket_name, source_file_name, destination_blob_name):
             source_file_name, bucket_name, destination_blob_name
         )
     )
+
+
+def split_gcs_path(path):
+    """ Splits gs://bucket/blob/path into (bucket, blob/path) """
+    bucket_name, _, blob_path = path[len("gs://"):].partition("/")
+    return bucket_name, blob_path
+
+
+def read_text(path, storage_client=None):
+    """ Reads a local or gs:// file, returns None if it does not exist """
+    if path.startswith("gs://"):
+        if storage_client is None:
+            storage_client = get_default_session().storage
+
+        bucket_name, blob_path = split_gcs_path(path)
+        blob = storage_client.bucket(bucket_name).get_blob(blob_path)
+        return blob.download_as_text() if blob else None
+
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return f.read()
+
+
+def write_text(path, data, storage_client=None):
+    """ Writes a local or gs:// (JSON) file """
+    if path.startswith("gs://"):
+        if storage_client is None:
+            storage_client = get_default_session().storage
+
+        bucket_name, blob_path = split_gcs_path(path)
+        blob = storage_client.bucket(bucket_name).blob(blob_path)
+        blob.upload_from_string(data, content_type="application/json")
+        return
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    # Write to a temporary file first so a crash never leaves a truncated
+    # file behind
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
@@ -0,0 +1,186 @@
+"""
+Watermarks of the source table: for every config, the end of the latest
+hour whose data has fully landed. Runs started from the watermark read up
+to that hour instead of assuming that every hour older than
+`data_delay_hour` is complete, so they neither wait longer than needed nor
+read a partially loaded hour.
+
+An hour is considered complete for a config once rows of the config
+received at least `lateness_minutes` after the end of the hour have landed
+(rows land roughly in receipt order, the lateness covers the stragglers).
+Rows still in the table's streaming buffer are already visible to queries,
+so the buffer does not hold the watermark back. Configs without any recent
+row are complete up to the watermark of the other configs.
+
+The sources are the table itself (BigQueryWatermarkSource) or a local JSON
+file standing in for it (LocalWatermarkSource). The table's metadata only
+tells when the table changed, not up to when each config's rows landed, so
+BigQueryWatermarkSource queries the latest rows of the configs. The query
+only scans the recent partitions, only keeps the configs being run, and is
+held to the same byte budget (max_bytes_scanned) as the reader's queries.
+"""
+
+from datetime import datetime, timedelta, timezone
+import json
+
+from prebid_optimizer import round_to_hour
+from prebid_optimizer.reader import DATETIME_FORMAT
+from prebid_optimizer.reader import MIN_BYTES_BILLED
+from prebid_optimizer.reader import QueryTooExpensiveError
+from prebid_optimizer.session import get_default_session
+
+
+LATENESS_MINUTES = 10
+
+# How far back the source table is searched for the latest rows
+LOOKBACK_HOURS = 6
+
+LATEST_RECEIPT_TIME_TEMPLATE = """
+SELECT
+    configID,
+    MAX(receiptTimeMillis) as latest_receipt_time
+FROM `{source_table}`
+WHERE
+    receiptTimeMillis >= @since
+    AND configID IN UNNEST(@config_ids)
+    AND testCode = "ds_optimizer"
+GROUP BY configID
+"""
+
+
+def _to_naive_utc(timestamp):
+    """ BigQuery returns aware timestamps, the run timestamps are naive UTC """
+    if timestamp is not None and timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+
+class BigQueryWatermarkSource:
+    def __init__(self, source_table, session=None,
+                 lookback_hours=LOOKBACK_HOURS, max_bytes_scanned=None):
+        self.source_table = source_table
+        self.session = session or get_default_session()
+        self.lookback_hours = lookback_hours
+        # If set, the query is dry run first and not run if it would scan
+        # more than this many bytes (like TSReader)
+        self.max_bytes_scanned = max_bytes_scanned
+
+    def get_latest_receipt_times(self, config_ids, now):
+        """ Returns {config_id: receipt time of its latest landed row} """
+        from google.cloud import bigquery
+
+        since = round_to_hour(now) - timedelta(hours=self.lookback_hours)
+        query_parameters = [
+            bigquery.ScalarQueryParameter("since", "TIMESTAMP", since),
+            bigquery.ArrayQueryParameter("config_ids", "STRING",
+                                         list(config_ids)),
+        ]
+        sql = LATEST_RECEIPT_TIME_TEMPLATE.format(
+            source_table=self.source_table)
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=query_parameters)
+
+        if self.max_bytes_scanned is not None:
+            dry_run_config = bigquery.QueryJobConfig(
+                dry_run=True,
+                use_query_cache=False,
+                query_parameters=query_parameters,
+            )
+            estimated_bytes = self.session.bigquery.query(
+                sql, job_config=dry_run_config).total_bytes_processed
+            if estimated_bytes > self.max_bytes_scanned:
+                raise QueryTooExpensiveError(estimated_bytes,
+                                             self.max_bytes_scanned)
+            # Enforced by BigQuery in case the estimate was off
+            job_config.maximum_bytes_billed = max(self.max_bytes_scanned,
+                                                  MIN_BYTES_BILLED)
+
+        rows = self.session.bigquery.query(sql, job_config=job_config) \
+                   .result()
+
+        return {row["configID"]: _to_naive_utc(row["latest_receipt_time"])
+                for row in rows}
+
+
+class LocalWatermarkSource:
+    """ Reads the watermark metadata from a JSON file:
+    {"latest_receipt_times": {config_id: "2021-09-16 08:12:00", ...}} """
+    def __init__(self, path):
+        self.path = path
+
+    def _load(self):
+        with open(self.path) as f:
+            return json.load(f)
+
+    def get_latest_receipt_times(self, config_ids, now):
+        return {config_id: datetime.strptime(value, DATETIME_FORMAT)
+                for config_id, value
+                in self._load().get("latest_receipt_times", {}).items()
+                if config_id in config_ids}
+
+
+def get_complete_until(latest_receipt_time,
+                       lateness_minutes=LATENESS_MINUTES):
+    """ End of the latest complete hour """
+    return round_to_hour(latest_receipt_time
+                         - timedelta(minutes=lateness_minutes))
+
+
+def get_watermarks(source, config_ids, now,
+                   lateness_minutes=LATENESS_MINUTES):
+    """ Returns {config_id: end of its latest complete hour}, None if
+    nothing landed recently """
+    latest_receipt_times = source.get_latest_receipt_times(config_ids, now)
+    if not latest_receipt_times:
+        return {config_id: None for config_id in config_ids}
+
+    latest_receipt_time = max(latest_receipt_times.values())
+    return {
+        config_id: get_complete_until(
+            latest_receipt_times.get(config_id, latest_receipt_time),
+            lateness_minutes)
+        for config_id in config_ids
+    }
+
+
+class WatermarkTrigger:
+    """ Tracks the configs whose watermark moved past the last hour they
+    were run on """
+    def __init__(self, source, config_ids, lateness_minutes=LATENESS_MINUTES):
+        self.source = source
+        self.config_ids = config_ids
+        self.lateness_minutes = lateness_minutes
+
+        # {config_id: end of the window of its last run}
+        self.last_run_ends = {}
+        self.watermarks = {}
+
+    def poll(self, now):
+        """ Refreshes the watermarks, returns True if any config is ready """
+        self.watermarks = get_watermarks(self.source, self.config_ids, now,
+                                         self.lateness_minutes)
+        return bool(self.get_ready())
+
+    def get_ready(self, until=None):
+        """ Returns {end timestamp: [config_id, ...]} of the configs that
+        have a new complete hour. Ends are capped at `until` if given. """
+        ready = {}
+        for config_id, end_timestamp in self.watermarks.items():
+            if until is not None and end_timestamp is not None:
+                end_timestamp = min(end_timestamp, until)
+            last_run_end = self.last_run_ends.get(config_id)
+            if end_timestamp is not None and (last_run_end is None
+                                              or end_timestamp > last_run_end):
+                ready.setdefault(end_timestamp, []).append(config_id)
+
+        return ready
+
+    def get_min_watermark(self):
+        """ End of the latest hour that is complete for every config """
+        watermarks = [end_timestamp for end_timestamp
+                      in self.watermarks.values() if end_timestamp]
+        return min(watermarks) if watermarks else None
+
+    def mark_run(self, config_ids, end_timestamp):
+        for config_id in config_ids:
+            self.last_run_ends[config_id] = end_timestamp
@@ -0,0 +1,32 @@
+""" Synthetic data shared by the tests that do not need BigQuery """
+import numpy as np
+import pandas as pd
+
+from prebid_optimizer import stats
+
+
+TIMEOUTS = [1000, 1500, 2000]
+WIN_RATES = [0.05, 0.10, 0.20]
+
+
+class InMemoryReader:
+    """ Serves synthetic hourly statistics and records the queries """
+    def __init__(self, num_hours, rows_per_hour=600, seed=0):
+        rng = np.random.default_rng(seed)
+        num_rows = num_hours * rows_per_hour
+        action = rng.integers(0, len(TIMEOUTS), num_rows)
+        win = rng.random(num_rows) < np.array(WIN_RATES)[action]
+
+        self.df = pd.DataFrame({
+            "auction_hour": np.repeat(np.arange(num_hours), rows_per_hour),
+            "bidderTimeout": np.array(TIMEOUTS)[action],
+            "pubrev": np.where(win, rng.lognormal(11, 1, num_rows), 0),
+        })
+        self.queries = []
+        self.query_metrics = []
+
+    def get_hourly_stats(self, start_timestamp, end_timestamp, 
+                         use_weighted_training):
+        self.queries.append((start_timestamp, end_timestamp))
+        return stats.aggregate_stats(self.df, 
+                                     ["auction_hour", "bidderTimeout"])
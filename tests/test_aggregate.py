@@ -0,0 +1,29 @@
+from datetime import datetime
+
+from prebid_optimizer import aggregate
+
+
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+END_TIMESTAMP = datetime.strptime("2021-09-16 08:00:00", DATETIME_FORMAT)
+
+
+def test_get_append_window():
+    last_hour = datetime.strptime("2021-09-16 05:00:00", DATETIME_FORMAT)
+    window = aggregate.get_append_window(last_hour, END_TIMESTAMP, 24)
+
+    assert window == (datetime.strptime("2021-09-16 06:00:00", 
+                                        DATETIME_FORMAT), END_TIMESTAMP), \
+        f"Only the new hours should be appended: {window}"
+
+
+def test_get_append_window_up_to_date():
+    last_hour = datetime.strptime("2021-09-16 07:00:00", DATETIME_FORMAT)
+
+    assert aggregate.get_append_window(last_hour, END_TIMESTAMP, 24) is None
+
+
+def test_get_append_window_empty_table():
+    window = aggregate.get_append_window(None, END_TIMESTAMP, 24)
+
+    assert window == (datetime.strptime("2021-09-15 08:00:00", 
+                                        DATETIME_FORMAT), END_TIMESTAMP)
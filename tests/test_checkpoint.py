@@ -0,0 +1,33 @@
+from datetime import datetime
+
+from prebid_optimizer import checkpoint
+
+
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+RUN_TIMESTAMP = datetime.strptime("2021-09-16 08:12:32", DATETIME_FORMAT)
+
+
+def test_rerun_skips_completed_configs(tmp_path):
+    config_ids = ["a", "b", "c"]
+    _checkpoint = checkpoint.RunCheckpoint(str(tmp_path), RUN_TIMESTAMP)
+    _checkpoint.mark_complete("a", "ok", "hash-a")
+    _checkpoint.mark_complete("b", "not_enough_data", "hash-b")
+
+    # A retry later in the same hour resumes the run
+    retry_timestamp = datetime.strptime("2021-09-16 08:40:00", 
+                                        DATETIME_FORMAT)
+    _checkpoint = checkpoint.RunCheckpoint(str(tmp_path), retry_timestamp)
+
+    assert _checkpoint.get_remaining(config_ids) == ["c"]
+    assert _checkpoint.configs["a"]["distributions_hash"] == "hash-a"
+
+
+def test_next_run_starts_over(tmp_path):
+    _checkpoint = checkpoint.RunCheckpoint(str(tmp_path), RUN_TIMESTAMP)
+    _checkpoint.mark_complete("a", "ok", "hash-a")
+
+    next_timestamp = datetime.strptime("2021-09-16 09:00:00", 
+                                       DATETIME_FORMAT)
+    _checkpoint = checkpoint.RunCheckpoint(str(tmp_path), next_timestamp)
+
+    assert _checkpoint.get_remaining(["a", "b"]) == ["a", "b"]
@@ -0,0 +1,56 @@
+from prebid_optimizer.costs import CostHistory
+from prebid_optimizer.costs import get_num_rows
+
+
+def test_history_is_smoothed_and_persisted(tmp_path):
+    path = str(tmp_path / "costs" / "cost_history.json")
+    history = CostHistory(path, smoothing=0.5)
+    history.update("abc", 10, 1000)
+    history.update("abc", 20, 3000)
+    history.save()
+
+    history = CostHistory(path)
+    assert history.entries["abc"] == {"seconds": 15, "num_rows": 2000,
+                                      "num_runs": 2}
+
+
+def test_longest_first(tmp_path):
+    history = CostHistory(str(tmp_path / "cost_history.json"))
+    history.update("small", 1, 10)
+    history.update("large", 60, 100000)
+    history.update("medium", 5, 1000)
+
+    assert history.order_longest_first(["small", "medium", "large"]) \
+        == ["large", "medium", "small"]
+    # Configs without history are started with the most expensive ones
+    assert history.order_longest_first(["small", "new", "large"]) \
+        == ["new", "large", "small"]
+
+
+def test_few_runs_are_predicted_from_rows(tmp_path):
+    history = CostHistory(str(tmp_path / "cost_history.json"))
+    for _ in range(3):
+        history.update("known", 10, 1000)
+    # A single, unusually fast run of a config with twice the rows
+    history.update("new", 1, 2000)
+
+    costs = history.get_costs(["known", "new"])
+    assert costs["known"] == 10
+    assert costs["new"] == 20
+    assert history.order_longest_first(["known", "new"]) == ["new", "known"]
+
+
+def test_num_rows_is_the_rows_read():
+    from prebid_optimizer import optimizer
+    from synthetic import InMemoryReader
+    from synthetic import TIMEOUTS
+
+    _optimizer = optimizer.TSOptimizer(
+        config_id="dummy", bucket_size=1000, source_table="dummy",
+        configs_to_optimize={"bidderTimeout": TIMEOUTS},
+        min_probability=0.01, model_type="default",
+        use_weighted_training=False)
+    _optimizer.reader = InMemoryReader(num_hours=4, rows_per_hour=600)
+    results = _optimizer.generate_distributions(None, None)
+
+    assert get_num_rows(results) == 4 * 600
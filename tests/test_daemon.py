@@ -0,0 +1,53 @@
+from datetime import datetime
+
+from prebid_optimizer import daemon
+
+
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def test_get_next_run_time():
+    now = datetime.strptime("2021-09-16 08:12:32", DATETIME_FORMAT)
+
+    next_run = daemon.get_next_run_time(now)
+    assert next_run == datetime.strptime("2021-09-16 09:00:00",
+                                         DATETIME_FORMAT), next_run
+
+    next_run = daemon.get_next_run_time(now, offset_minutes=15)
+    assert next_run == datetime.strptime("2021-09-16 08:15:00",
+                                         DATETIME_FORMAT), next_run
+
+    # Exactly on a boundary runs on the following one
+    now = datetime.strptime("2021-09-16 23:00:00", DATETIME_FORMAT)
+    next_run = daemon.get_next_run_time(now)
+    assert next_run == datetime.strptime("2021-09-17 00:00:00",
+                                         DATETIME_FORMAT), next_run
+
+
+def test_trigger_file(tmp_path):
+    trigger_file = tmp_path / "trigger"
+    trigger_file.touch()
+    run_timestamps = []
+
+    _daemon = daemon.OptimizerDaemon(run_timestamps.append,
+                                     trigger_file=str(trigger_file),
+                                     poll_seconds=0.01, max_runs=1)
+    _daemon.run()
+
+    assert len(run_timestamps) == 1
+    assert not trigger_file.exists(), "Trigger file was not consumed"
+
+
+def test_failed_run_keeps_daemon_alive():
+    _daemon = daemon.OptimizerDaemon(None, poll_seconds=0.01, max_runs=2)
+
+    def failing_run(run_timestamp):
+        # Request the next run right away, then fail this one
+        _daemon.trigger()
+        raise RuntimeError("query failed")
+
+    _daemon.run_func = failing_run
+    _daemon.trigger()
+    _daemon.run()
+
+    assert _daemon.num_runs == 2
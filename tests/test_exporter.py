@@ -0,0 +1,135 @@
+from google.api_core.exceptions import PreconditionFailed
+
+from prebid_optimizer import exporter
+
+
+RESULTS = {
+    "actions": [
+        {"config": {"bidderTimeout": 1000}, "prob_to_win": 0.25,
+         "num_trials": 100},
+        {"config": {"bidderTimeout": 2000}, "prob_to_win": 0.75,
+         "num_trials": 120},
+    ]
+}
+
+
+class FakeBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.metadata = None
+        self.generation = None
+
+    def upload_from_string(self, data, content_type=None, 
+                           if_generation_match=None):
+        published = self.bucket.blobs.get(self.name)
+        current_generation = published.generation if published else 0
+        if if_generation_match is not None \
+                and if_generation_match != current_generation:
+            raise PreconditionFailed("generation mismatch")
+
+        self.bucket.num_uploads += 1
+        self.generation = current_generation + 1
+        self.data = data
+        self.bucket.blobs[self.name] = self
+
+
+class FakeBucket:
+    def __init__(self):
+        self.blobs = {}
+        self.num_uploads = 0
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+    def get_blob(self, name):
+        return self.blobs.get(name)
+
+
+class FakeStorageClient:
+    def __init__(self):
+        self._bucket = FakeBucket()
+
+    def bucket(self, name):
+        return self._bucket
+
+
+def test_hash_distributions():
+    distributions = exporter.get_distributions(RESULTS)
+    reordered = {**distributions,
+                 "actions": [{"prob_to_win": a["prob_to_win"],
+                              "config": a["config"]}
+                             for a in distributions["actions"]]}
+
+    assert exporter.hash_distributions(distributions) \
+        == exporter.hash_distributions(reordered)
+
+
+def test_unchanged_distributions_are_skipped(tmp_path):
+    client = FakeStorageClient()
+    manifest = exporter.ExportManifest(str(tmp_path / "manifest.json"))
+
+    assert exporter.exportJSON(RESULTS, "bucket", "abc", client, manifest)
+    assert not exporter.exportJSON(RESULTS, "bucket", "abc", client, 
+                                   manifest)
+    assert client._bucket.num_uploads == 1
+    assert manifest.num_skipped_writes == 1
+
+    # The manifest survives a restart
+    manifest.save()
+    manifest = exporter.ExportManifest(str(tmp_path / "manifest.json"))
+    assert not manifest.has_changed("abc", exporter.get_distributions(RESULTS))
+
+
+def test_concurrent_write():
+    client = FakeStorageClient()
+    manifest = exporter.ExportManifest()
+    other_manifest = exporter.ExportManifest()
+    changed_results = {"actions": [dict(a, prob_to_win=0.5) 
+                                   for a in RESULTS["actions"]]}
+
+    exporter.exportJSON(RESULTS, "bucket", "abc", client, manifest)
+    # Another run publishes new distributions in the meantime
+    exporter.exportJSON(changed_results, "bucket", "abc", client, 
+                        other_manifest)
+
+    # Our generation is stale: the precondition fails, the blob is re-read
+    # and already holds the same distributions
+    assert not exporter.exportJSON(changed_results, "bucket", "abc", client,
+                                   manifest)
+    assert client._bucket.num_uploads == 2
+    assert manifest.get("abc")["generation"] == 2
+
+    # Different distributions are uploaded on top of the latest generation
+    assert exporter.exportJSON(RESULTS, "bucket", "abc", client, 
+                               other_manifest)
+    assert client._bucket.get_blob("abc/distributions.json").generation == 3
+
+
+def test_unchanged_config_is_counted_once():
+    from datetime import datetime
+
+    from prebid_optimizer import exportResults
+    from prebid_optimizer.session import Session
+
+    class FakeBQClient:
+        num_loads = 0
+
+        def load_table_from_file(self, f, table_id, job_config=None):
+            self.num_loads += 1
+            return type("FakeLoadJob", (), {"result": lambda self: None})()
+
+    bq_client = FakeBQClient()
+    session = Session(clients={"bigquery": bq_client,
+                               "storage": FakeStorageClient()})
+    manifest = exporter.ExportManifest()
+    timestamp = datetime(2021, 9, 16, 8)
+
+    for _ in range(2):
+        results = {**RESULTS, "status": "ok"}
+        exportResults(results, "devint", "abc", timestamp, timestamp,
+                      timestamp, session=session, manifest=manifest)
+
+    assert bq_client.num_loads == 1
+    assert manifest.num_skipped_writes == 1
+    assert manifest.num_skipped_bq_rows == 1
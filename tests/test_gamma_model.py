@@ -1,7 +1,10 @@
 import numpy as np
 import pandas as pd
+import pytest
 
 from prebid_optimizer import models
+from prebid_optimizer.deadline import Deadline
+from prebid_optimizer.deadline import DeadlineExceeded
 
 
 SAMPLE_DF = pd.DataFrame({
@@ -42,3 +45,17 @@ def test_get_reward_distribution():
         f"means.mean() = {means.mean()}"
     assert abs_diff(stds.mean(), 0.00130) < 0.00010, \
         f"std.mean() = {stds.mean()}"
+
+
+def test_fit_is_bounded():
+    model = models.GammaModel(alpha0=ALPHA0, max_iter=5)
+    # alpha oscillates and never converges
+    alphas = iter([0.05, 0.1] * 100)
+    model.get_optimal_alpha = lambda stats, beta: next(alphas)
+    model.get_posterior_hyperparams(SAMPLE_DF)
+    assert next(alphas) == 0.1, "Should stop after max_iter iterations"
+
+    model = models.GammaModel(alpha0=ALPHA0)
+    model.deadline = Deadline(0)
+    with pytest.raises(DeadlineExceeded):
+        model.get_posterior_hyperparams(SAMPLE_DF)
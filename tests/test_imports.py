@@ -0,0 +1,37 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = [
+    "pandas",
+    "scipy",
+    "google.cloud.bigquery",
+    "google.cloud.bigquery_storage",
+    "google.cloud.storage",
+]
+
+
+def get_loaded_modules(module):
+    code = f"import sys; import {module}; print(' '.join(sys.modules))"
+    output = subprocess.run([sys.executable, "-c", code], capture_output=True,
+                            text=True, check=True, cwd=REPO_DIR).stdout
+    return set(output.split())
+
+
+@pytest.mark.parametrize("module", [
+    "prebid_optimizer",
+    "prebid_optimizer.optimizer",
+    "prebid_optimizer.exporter",
+    "cli",
+])
+def test_no_heavy_imports(module):
+    """ Importing the package or the CLI should not load heavy dependencies """
+    loaded = get_loaded_modules(module)
+    heavy = [m for m in HEAVY_MODULES if m in loaded]
+
+    assert not heavy, f"{module} imports {heavy} at import time"
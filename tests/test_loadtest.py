@@ -0,0 +1,104 @@
+import concurrent.futures
+from datetime import datetime, timedelta
+import json
+
+from google.cloud import bigquery
+import numpy as np
+import pytest
+
+import cli
+from prebid_optimizer.local_bigquery import LocalBigQueryClient
+from prebid_optimizer.local_bigquery import write_auctions
+from prebid_optimizer.loadtest import generate_auctions
+from prebid_optimizer.loadtest import get_percentiles
+from prebid_optimizer.reader import SQL_TEMPLATE
+from prebid_optimizer.reader import TSReader
+from prebid_optimizer.reader import get_query_parameters
+from prebid_optimizer.session import Session
+
+from synthetic import TIMEOUTS
+
+
+SOURCE_TABLE = "project.dataset.auctions"
+START_TIMESTAMP = datetime(2021, 9, 16, 0, 0)
+
+
+def _create_reader(tmp_path, read_shards=1):
+    rng = np.random.default_rng(0)
+    configs_to_optimize = {"bidderTimeout": TIMEOUTS}
+    config_combos = [{"bidderTimeout": timeout} for timeout in TIMEOUTS]
+    df = generate_auctions(rng, config_combos, START_TIMESTAMP, 6, 200)
+    write_auctions(str(tmp_path), SOURCE_TABLE, "abc", df)
+
+    session = Session(clients={
+        "bigquery": LocalBigQueryClient(str(tmp_path)),
+        "bigquery_storage": None,
+    })
+    reader = TSReader("abc", SOURCE_TABLE, configs_to_optimize,
+                      read_shards=read_shards, session=session)
+    return reader, df
+
+
+def test_local_bigquery_reads_the_window(tmp_path):
+    reader, df = _create_reader(tmp_path, read_shards=2)
+    start_timestamp = START_TIMESTAMP + timedelta(hours=1)
+    end_timestamp = START_TIMESTAMP + timedelta(hours=5)
+
+    rows = reader.get_data(start_timestamp, end_timestamp, False)
+    expected = df[(df["receipt_time"] >= start_timestamp)
+                  & (df["receipt_time"] < end_timestamp)]
+    assert len(rows) == len(expected)
+    assert sorted(rows["auction_hour"].unique()) == [0, 1, 2, 3]
+    assert rows["pubrev"].sum() == pytest.approx(expected["pubrev"].sum())
+    assert (rows["win"] == (rows["pubrev"] > 0)).all()
+
+    segments = reader.get_segment_stats(start_timestamp, end_timestamp)
+    assert segments["num_trials"].sum() == len(expected)
+    assert set(segments["segment"]) == set(expected["adunit_code"])
+
+
+def test_local_bigquery_latency(tmp_path):
+    client = LocalBigQueryClient(str(tmp_path), latency_seconds=1)
+    sql = SQL_TEMPLATE.format(parse_optimizerConfig="",
+                              config_fields="bidderTimeout",
+                              source_table=SOURCE_TABLE)
+    job_config = bigquery.QueryJobConfig(query_parameters=get_query_parameters(
+        "abc", START_TIMESTAMP, START_TIMESTAMP + timedelta(hours=1)))
+    job = client.query(sql, job_config=job_config)
+    with pytest.raises(concurrent.futures.TimeoutError):
+        job.result(timeout=0.01)
+
+    with pytest.raises(ValueError):
+        client.query("SELECT 1")
+
+
+def test_get_percentiles():
+    assert get_percentiles([]) == {"count": 0}
+
+    summary = get_percentiles(range(101))
+    assert summary["count"] == 101
+    assert summary["p50"] == 50
+    assert summary["p99"] == 99
+    assert summary["max"] == 100
+
+
+def test_loadtest(tmp_path):
+    output_path = str(tmp_path / "report.json")
+    cli.run_loadtest(num_configs=3, hour_window=4, rows_per_hour=300,
+                     volume_sigma=0, pipeline=True,
+                     query_latency_seconds=0.01, gcs_latency_seconds=0,
+                     root=str(tmp_path / "root"), output_path=output_path)
+
+    with open(output_path) as f:
+        report = json.load(f)
+    assert report["num_configs"] == 3
+    assert report["statuses"] == {"ok": 3}
+    for stage in ["read", "optimize", "export", "bq_query", "bq_load",
+                  "gcs_upload"]:
+        assert report["stages"][stage]["count"] == 3, stage
+    assert report["configs_per_minute"] > 0
+    assert report["peak_memory_mb"] > 0
+
+    published = tmp_path / "root" / "gcs" \
+                / "ox-loadtest-prebid-optimizer-data"
+    assert len(list(published.glob("*/distributions.json"))) == 3
@@ -1,8 +1,10 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 from pprint import pprint
 import numpy as np
 
 from prebid_optimizer import optimizer
+from prebid_optimizer.deadline import Deadline
+from synthetic import InMemoryReader
 
 
 DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
@@ -74,3 +76,79 @@ def test_generate_distributions():
             and (abs_diff(probs_to_win[2], 0.31) < 0.02) \
             and (abs_diff(probs_to_win[3], 0.42) < 0.02), \
             f"probs_to_win: {probs_to_win}"
+
+
+def test_generate_multi_horizon_distributions():
+    _optimizer = optimizer.TSOptimizer(
+            config_id="dummy", 
+            bucket_size=1000, 
+            source_table="dummy",
+            configs_to_optimize={"bidderTimeout": [1000, 1500, 2000]},
+            min_probability=0.01,
+            model_type="default",
+            use_weighted_training=False
+        )
+    reader = InMemoryReader(num_hours=12)
+    _optimizer.reader = reader
+
+    end_timestamp = datetime.strptime("2021-09-16 12:00:00", 
+                                      DATETIME_FORMAT)
+    results = _optimizer.generate_multi_horizon_distributions(
+        end_timestamp, [3, 6, 12])
+
+    assert len(reader.queries) == 1, "Largest window should be read once"
+    assert sorted(results) == [3, 6, 12]
+    for hour_window, window_results in results.items():
+        probs_to_win = [x["prob_to_win"] for x in window_results["actions"]]
+        assert np.argmax(probs_to_win) == 2, \
+            f"hour_window={hour_window}, probs_to_win: {probs_to_win}"
+        assert window_results["status"] == optimizer.STATUS_OK
+        assert window_results["num_rows"] == 600 * hour_window
+
+
+def test_multi_horizon_timeout_falls_back_for_every_window():
+    _optimizer = optimizer.TSOptimizer(
+            config_id="dummy", 
+            bucket_size=1000, 
+            source_table="dummy",
+            configs_to_optimize={"bidderTimeout": [1000, 1500, 2000]},
+            min_probability=0.01,
+            model_type="default",
+            use_weighted_training=False
+        )
+    _optimizer.reader = InMemoryReader(num_hours=12)
+    _optimizer.set_deadline(Deadline(0))
+
+    end_timestamp = datetime.strptime("2021-09-16 12:00:00", 
+                                      DATETIME_FORMAT)
+    results = _optimizer.generate_multi_horizon_distributions(
+        end_timestamp, [3, 6, 12])
+
+    assert sorted(results) == [3, 6, 12]
+    for window_results in results.values():
+        assert window_results["status"] == optimizer.STATUS_TIMEOUT
+        assert window_results["actions"] \
+            == _optimizer._get_default_distributions()["actions"]
+
+
+def test_timeout_falls_back_to_default_distribution():
+    _optimizer = optimizer.TSOptimizer(
+            config_id="dummy", 
+            bucket_size=1000, 
+            source_table="dummy",
+            configs_to_optimize={"bidderTimeout": [1000, 1500, 2000]},
+            min_probability=0.01,
+            model_type="default",
+            use_weighted_training=False
+        )
+    _optimizer.reader = InMemoryReader(num_hours=12)
+    _optimizer.set_deadline(Deadline(0))
+
+    end_timestamp = datetime.strptime("2021-09-16 12:00:00", 
+                                      DATETIME_FORMAT)
+    results = _optimizer.generate_distributions(
+        end_timestamp - timedelta(hours=12), end_timestamp)
+
+    assert results["status"] == optimizer.STATUS_TIMEOUT
+    assert results["actions"] \
+        == _optimizer._get_default_distributions()["actions"]
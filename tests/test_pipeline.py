@@ -0,0 +1,49 @@
+import time
+
+from prebid_optimizer import pipeline
+
+
+STAGE_SECONDS = 0.05
+
+
+def sleep_stage(task):
+    time.sleep(STAGE_SECONDS)
+
+
+def test_stages_overlap():
+    num_tasks = 6
+    tasks = [pipeline.ConfigTask(f"config-{i}", {}) for i in range(num_tasks)]
+    stages = [("read", sleep_stage), ("optimize", sleep_stage), 
+              ("export", sleep_stage)]
+
+    start_time = time.perf_counter()
+    finished = pipeline.run_pipeline(tasks, stages)
+    elapsed = time.perf_counter() - start_time
+
+    assert [task.config_id for task in finished] \
+        == [task.config_id for task in tasks]
+    # Sequentially this takes num_tasks * 3 stages
+    assert elapsed < 0.75 * num_tasks * 3 * STAGE_SECONDS, elapsed
+    assert all(set(task.timings) == {"read", "optimize", "export"} 
+               for task in finished)
+
+
+def test_failed_config_skips_remaining_stages():
+    exported = []
+
+    def read(task):
+        if task.config_id == "broken":
+            raise RuntimeError("query failed")
+
+    def export(task):
+        exported.append(task.config_id)
+
+    tasks = [pipeline.ConfigTask(config_id, {}) 
+             for config_id in ["a", "broken", "b"]]
+    finished = pipeline.run_pipeline(tasks, [("read", read), 
+                                             ("export", export)])
+
+    assert exported == ["a", "b"]
+    broken = [task for task in finished if task.config_id == "broken"][0]
+    assert broken.failed_stage == "read"
+    assert "export" not in broken.timings
@@ -0,0 +1,323 @@
+import concurrent.futures
+from datetime import datetime
+import threading
+import time
+
+import pandas as pd
+import pytest
+
+from prebid_optimizer import optimizer
+from prebid_optimizer import reader
+from prebid_optimizer.deadline import Deadline
+from prebid_optimizer.deadline import DeadlineExceeded
+
+
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+START_TIMESTAMP = datetime.strptime("2021-09-16 00:00:00", DATETIME_FORMAT)
+END_TIMESTAMP = datetime.strptime("2021-09-16 04:00:00", DATETIME_FORMAT)
+
+
+class FakeJob:
+    def __init__(self, total_bytes_processed, cache_hit=False):
+        self.total_bytes_processed = total_bytes_processed
+        self.total_bytes_billed = 0 if cache_hit else total_bytes_processed
+        self.cache_hit = cache_hit
+        self.slot_millis = 0 if cache_hit else 1234
+
+    def result(self):
+        return self
+
+    def to_dataframe(self, bqstorage_client=None):
+        return pd.DataFrame({"auction_hour": [], "bidderTimeout": [], 
+                             "win": [], "pubrev": []})
+
+
+class SlowJob(FakeJob):
+    """ Never finishes within the timeout """
+    cancelled = False
+
+    def result(self, timeout=None):
+        raise concurrent.futures.TimeoutError()
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class FakeClient:
+    """ Records the queries and returns jobs scanning `bytes_per_query` """
+    def __init__(self, bytes_per_query):
+        self.bytes_per_query = bytes_per_query
+        self.queries = []
+
+    def query(self, sql, job_config=None):
+        self.queries.append((sql, job_config))
+        # Identical queries are served from the cache
+        cache_hit = [q[0] for q in self.queries if not q[1].dry_run] \
+                        .count(sql) > 1
+        return FakeJob(self.bytes_per_query, cache_hit=cache_hit)
+
+
+def get_reader(client, max_bytes_scanned=None):
+    return reader.TSReader(
+        config_id="dummy",
+        source_table="dummy.prebid.auctions",
+        configs_to_optimize={"bidderTimeout": [1000, 1500]},
+        client=client,
+        storage_client=object(),
+        max_bytes_scanned=max_bytes_scanned,
+    )
+
+
+def test_query_is_parameterized():
+    client = FakeClient(bytes_per_query=100)
+    _reader = get_reader(client)
+    _reader.get_data(START_TIMESTAMP, END_TIMESTAMP, False)
+    _reader.get_data(START_TIMESTAMP, END_TIMESTAMP, False)
+
+    sql, job_config = client.queries[0]
+    assert '"dummy"' not in sql, "config_id should be a query parameter"
+    assert "@start_time" in sql and "@config_id" in sql
+    parameters = {p.name: p.value for p in job_config.query_parameters}
+    assert parameters["config_id"] == "dummy"
+    assert parameters["start_time"].replace(tzinfo=None) == START_TIMESTAMP
+
+    metrics = _reader.query_metrics
+    assert [m["cache_hit"] for m in metrics] == [False, True]
+    assert metrics[0]["total_bytes_processed"] == 100
+    assert metrics[0]["slot_millis"] == 1234
+
+
+def test_byte_budget():
+    client = FakeClient(bytes_per_query=10 ** 12)
+    _optimizer = optimizer.TSOptimizer(
+        config_id="dummy",
+        bucket_size=1000,
+        source_table="dummy.prebid.auctions",
+        configs_to_optimize={"bidderTimeout": [1000, 1500]},
+        min_probability=0.01,
+        model_type="default",
+        use_weighted_training=False,
+    )
+    _optimizer.reader = get_reader(client, max_bytes_scanned=10 ** 9)
+
+    results = _optimizer.generate_distributions(START_TIMESTAMP, 
+                                                END_TIMESTAMP)
+
+    assert len(client.queries) == 1 and client.queries[0][1].dry_run, \
+        "Only the dry run should be executed"
+    assert results["status"] == optimizer.STATUS_QUERY_OVER_BUDGET
+    assert results["query_metrics"][0]["dry_run_bytes"] == 10 ** 12
+    assert [x["prob_to_win"] for x in results["actions"]] == [0.5, 0.5]
+
+
+class OverBilledJob(FakeJob):
+    """ Stopped by BigQuery at maximum_bytes_billed """
+    def result(self, timeout=None):
+        # The exception google-cloud-bigquery raises for the failed job
+        from google.cloud.bigquery.job.base import _error_result_to_exception
+        raise _error_result_to_exception({
+            "reason": "bytesBilledLimitExceeded",
+            "message": "Query exceeded limit for bytes billed: 10485760. "
+                       "20971520 or higher required.",
+        })
+
+
+def test_bytes_billed_limit_falls_back():
+    client = FakeClient(bytes_per_query=100)
+    job_configs = []
+
+    def query(sql, job_config=None):
+        job_configs.append(job_config)
+        return FakeJob(100) if job_config.dry_run else OverBilledJob(100)
+
+    client.query = query
+    _optimizer = optimizer.TSOptimizer(
+        config_id="dummy",
+        bucket_size=1000,
+        source_table="dummy.prebid.auctions",
+        configs_to_optimize={"bidderTimeout": [1000, 1500]},
+        min_probability=0.01,
+        model_type="default",
+        use_weighted_training=False,
+    )
+    _optimizer.reader = get_reader(client, max_bytes_scanned=1000)
+
+    results = _optimizer.generate_distributions(START_TIMESTAMP,
+                                                END_TIMESTAMP)
+
+    assert results["status"] == optimizer.STATUS_QUERY_OVER_BUDGET
+    assert job_configs[-1].maximum_bytes_billed == reader.MIN_BYTES_BILLED
+
+
+def test_slow_query_is_cancelled_at_the_deadline():
+    client = FakeClient(bytes_per_query=100)
+    job = SlowJob(100)
+    client.query = lambda sql, job_config=None: job
+    _reader = get_reader(client)
+    _reader.deadline = Deadline(60)
+
+    with pytest.raises(DeadlineExceeded):
+        _reader.get_data(START_TIMESTAMP, END_TIMESTAMP, False)
+    assert job.cancelled
+
+
+class TimedOutJob(FakeJob):
+    """ Stopped by BigQuery at job_timeout_ms """
+    def result(self, timeout=None):
+        from google.cloud.bigquery.job.base import _error_result_to_exception
+        raise _error_result_to_exception({
+            "reason": "timeout",
+            "message": "Job timed out after 60 sec",
+        })
+
+
+def test_query_stopped_by_job_timeout_falls_back():
+    client = FakeClient(bytes_per_query=100)
+    client.query = lambda sql, job_config=None: TimedOutJob(100)
+    _optimizer = optimizer.TSOptimizer(
+        config_id="dummy",
+        bucket_size=1000,
+        source_table="dummy.prebid.auctions",
+        configs_to_optimize={"bidderTimeout": [1000, 1500]},
+        min_probability=0.01,
+        model_type="default",
+        use_weighted_training=False,
+    )
+    _optimizer.reader = get_reader(client)
+    _optimizer.set_deadline(Deadline(60))
+
+    results = _optimizer.generate_distributions(START_TIMESTAMP,
+                                                END_TIMESTAMP)
+
+    assert results["status"] == optimizer.STATUS_TIMEOUT
+
+
+class SlowDownloadJob(FakeJob):
+    """ Finishes, but its rows take long to download """
+    def result(self, timeout=None):
+        return self
+
+    def to_dataframe(self, bqstorage_client=None):
+        time.sleep(1)
+        return super().to_dataframe(bqstorage_client)
+
+
+def test_slow_download_is_bounded_by_the_deadline():
+    client = FakeClient(bytes_per_query=100)
+    client.query = lambda sql, job_config=None: SlowDownloadJob(100)
+    _reader = get_reader(client)
+    _reader.deadline = Deadline(0.1)
+
+    start_time = time.perf_counter()
+    with pytest.raises(DeadlineExceeded):
+        _reader.get_data(START_TIMESTAMP, END_TIMESTAMP, False)
+    assert time.perf_counter() - start_time < 0.9
+
+
+class HourlyClient(FakeClient):
+    """ Returns one row per hour of the queried range, whose pubrev is the
+    hour measured from START_TIMESTAMP """
+    def query(self, sql, job_config=None):
+        self.queries.append((sql, job_config))
+        parameters = {p.name: p.value.replace(tzinfo=None)
+                      for p in job_config.query_parameters
+                      if p.name != "config_id"}
+        start = reader.get_hour_window(START_TIMESTAMP,
+                                       parameters["start_time"])
+        num_hours = reader.get_hour_window(parameters["start_time"],
+                                           parameters["end_time"])
+
+        job = FakeJob(self.bytes_per_query)
+        job.to_dataframe = lambda bqstorage_client=None: pd.DataFrame({
+            "auction_hour": range(num_hours),
+            "bidderTimeout": 1000,
+            "win": 1,
+            "pubrev": range(start, start + num_hours),
+        })
+        return job
+
+
+def test_split_time_window():
+    ranges = reader.split_time_window(START_TIMESTAMP, END_TIMESTAMP, 3)
+    assert [reader.get_hour_window(start, end) for start, end in ranges] \
+        == [1, 1, 2]
+    assert ranges[0][0] == START_TIMESTAMP and ranges[-1][1] == END_TIMESTAMP
+
+    # Never more ranges than hours
+    assert len(reader.split_time_window(START_TIMESTAMP, END_TIMESTAMP,
+                                        10)) == 4
+
+
+def test_time_sharded_read():
+    client = HourlyClient(bytes_per_query=100)
+    _reader = get_reader(client)
+    _reader.read_shards = 3
+
+    df = _reader.get_data(START_TIMESTAMP, END_TIMESTAMP, False)
+
+    assert len(client.queries) == 3
+    assert len(_reader.query_metrics) == 3
+    assert sorted(df["auction_hour"]) == [0, 1, 2, 3]
+    assert (df["auction_hour"] == df["pubrev"]).all()
+
+
+def test_time_sharded_read_budget():
+    # Every range is within the budget, the window is not
+    client = HourlyClient(bytes_per_query=400)
+    _reader = get_reader(client, max_bytes_scanned=1000)
+    _reader.read_shards = 3
+
+    with pytest.raises(reader.QueryTooExpensiveError):
+        _reader.get_data(START_TIMESTAMP, END_TIMESTAMP, False)
+    assert all(job_config.dry_run for _, job_config in client.queries), \
+        "No query should run before all the ranges are dry run"
+
+
+@pytest.mark.parametrize("failing_range", [0, 1])
+def test_failed_range_cancels_the_others(failing_range):
+    class BlockingJob(FakeJob):
+        """ Runs until cancelled """
+        def __init__(self, total_bytes_processed):
+            super().__init__(total_bytes_processed)
+            self.cancelled = threading.Event()
+
+        def result(self, timeout=None):
+            if not self.cancelled.wait(5):
+                raise AssertionError("The job was not cancelled")
+            raise concurrent.futures.CancelledError()
+
+        def cancel(self):
+            self.cancelled.set()
+
+    class FailingJob(OverBilledJob):
+        """ Fails once the other range's query is running """
+        def result(self, timeout=None):
+            other_submitted.wait(5)
+            return super().result(timeout)
+
+    client = FakeClient(bytes_per_query=100)
+    jobs = {}
+    other_submitted = threading.Event()
+    ranges = reader.split_time_window(START_TIMESTAMP, END_TIMESTAMP, 2)
+
+    def query(sql, job_config=None):
+        start_time = {p.name: p.value for p
+                      in job_config.query_parameters}["start_time"]
+        i = [start for start, _ in ranges].index(start_time.replace(
+            tzinfo=None))
+        if i == failing_range:
+            jobs[i] = FailingJob(100)
+        else:
+            jobs[i] = BlockingJob(100)
+            other_submitted.set()
+        return jobs[i]
+
+    client.query = query
+    _reader = get_reader(client)
+    _reader.read_shards = 2
+
+    start_time = time.perf_counter()
+    with pytest.raises(Exception, match="bytes billed"):
+        _reader.get_data(START_TIMESTAMP, END_TIMESTAMP, False)
+    assert time.perf_counter() - start_time < 4
+    assert len(jobs) == 2 and jobs[1 - failing_range].cancelled.wait(1)
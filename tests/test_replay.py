@@ -0,0 +1,57 @@
+from datetime import datetime
+
+import numpy as np
+
+from prebid_optimizer import MIN_PROBABILITY
+from prebid_optimizer import optimizer
+from prebid_optimizer import replay
+from synthetic import InMemoryReader
+from synthetic import TIMEOUTS
+
+
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def get_optimizer():
+    _optimizer = optimizer.TSOptimizer(
+        config_id="dummy",
+        bucket_size=1000,
+        source_table="dummy",
+        configs_to_optimize={"bidderTimeout": TIMEOUTS},
+        min_probability=MIN_PROBABILITY,
+        model_type="default",
+        use_weighted_training=False
+    )
+    return _optimizer
+
+
+def test_get_run_timestamps():
+    run_timestamps = replay.get_run_timestamps(
+        datetime.strptime("2021-09-16 00:30:00", DATETIME_FORMAT),
+        datetime.strptime("2021-09-16 05:30:00", DATETIME_FORMAT))
+
+    assert len(run_timestamps) == 6
+
+
+def test_replay():
+    hour_window, data_delay_hour = 3, 2
+    run_timestamps = replay.get_run_timestamps(
+        datetime.strptime("2021-09-16 05:00:00", DATETIME_FORMAT),
+        datetime.strptime("2021-09-16 09:00:00", DATETIME_FORMAT))
+    # union of the windows: 00:00 - 07:00
+    reader = InMemoryReader(num_hours=7)
+
+    _optimizer = get_optimizer()
+    _optimizer.reader = reader
+    replayer = replay.TSReplayer(_optimizer, hour_window, data_delay_hour)
+    rows = replayer.replay(run_timestamps)
+
+    assert len(reader.queries) == 1, "Union of windows should be read once"
+    assert replayer.num_fitted_hours == 7, \
+        f"Each hour should be fitted once: {replayer.num_fitted_hours}"
+    assert len(rows) == len(run_timestamps) * len(TIMEOUTS)
+
+    for run_timestamp in run_timestamps:
+        probs_to_win = [row["prob_to_win"] for row in rows
+                        if row["run_timestamp"] == run_timestamp]
+        assert np.argmax(probs_to_win) == 2, probs_to_win
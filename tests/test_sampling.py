@@ -0,0 +1,49 @@
+import numpy as np
+
+from prebid_optimizer import exporter
+from prebid_optimizer import sampling
+
+
+PROBABILITIES = [0.0123, 0.4, 0.2877, 0.0, 0.3]
+
+
+def test_quantize():
+    weights = sampling.quantize(PROBABILITIES)
+
+    assert sum(weights) == sampling.SCALE
+    assert weights[3] == 0
+    assert np.allclose(np.array(weights) / sampling.SCALE, PROBABILITIES,
+                       atol=1 / sampling.SCALE)
+
+
+def test_structures_match_quantized_distribution():
+    """ Every value of the random number is enumerated, so each structure
+    must pick every action exactly weight times """
+    weights = sampling.quantize(PROBABILITIES)
+    table = sampling.get_sampling(PROBABILITIES)
+    n = len(PROBABILITIES)
+
+    cumulative = np.array(table["cumulative"])
+    picks = np.searchsorted(cumulative, np.arange(sampling.SCALE),
+                            side="right")
+    assert np.bincount(picks, minlength=n).tolist() == weights
+
+    thresholds = np.array(table["alias"]["thresholds"])
+    aliases = np.array(table["alias"]["aliases"])
+    x = np.arange(n * sampling.SCALE)
+    column = x // sampling.SCALE
+    picks = np.where(x % sampling.SCALE < thresholds[column], column,
+                     aliases[column])
+    assert (np.bincount(picks, minlength=n) == np.array(weights) * n).all()
+
+
+def test_version():
+    results = {"actions": [{"config": {"bidderTimeout": 1000 + 500 * i},
+                            "prob_to_win": p}
+                           for i, p in enumerate(PROBABILITIES)]}
+    distributions = exporter.get_distributions(results)
+    assert len(distributions["version"]) == sampling.VERSION_LENGTH
+
+    results["actions"][0]["prob_to_win"] = 0.0124
+    assert exporter.get_distributions(results)["version"] \
+        != distributions["version"]
@@ -0,0 +1,148 @@
+from datetime import datetime, timedelta
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from prebid_optimizer import optimizer
+from prebid_optimizer import stats
+from prebid_optimizer.reader import QueryTooExpensiveError
+from prebid_optimizer.segments import SegmentedOptimizer
+from synthetic import TIMEOUTS
+from synthetic import WIN_RATES
+
+
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+END_TIMESTAMP = datetime.strptime("2021-09-16 12:00:00", DATETIME_FORMAT)
+START_TIMESTAMP = END_TIMESTAMP - timedelta(hours=12)
+
+# Win rates of the timeouts in each segment, the best timeout differs
+SEGMENT_WIN_RATES = {
+    "div-top": WIN_RATES,
+    "div-side": WIN_RATES[::-1],
+    "div-footer": [0.0, 0.0, 0.0],
+}
+
+
+def get_segment_df(num_hours=12, rows_per_hour=600, seed=0):
+    rng = np.random.default_rng(seed)
+    dfs = []
+    for segment, win_rates in SEGMENT_WIN_RATES.items():
+        num_rows = num_hours * rows_per_hour
+        action = rng.integers(0, len(TIMEOUTS), num_rows)
+        win = rng.random(num_rows) < np.array(win_rates)[action]
+        dfs.append(pd.DataFrame({
+            "auction_hour": np.repeat(np.arange(num_hours), rows_per_hour),
+            "segment": segment,
+            "bidderTimeout": np.array(TIMEOUTS)[action],
+            "pubrev": np.where(win, rng.lognormal(11, 1, num_rows), 0),
+        }))
+
+    return pd.concat(dfs, ignore_index=True)
+
+
+class InMemorySegmentReader:
+    def __init__(self, df):
+        self.df = df
+        self.query_metrics = []
+
+    def get_segment_stats(self, start_timestamp, end_timestamp):
+        return stats.aggregate_stats(
+            self.df, ["auction_hour", "segment", "bidderTimeout"])
+
+    def get_hourly_stats(self, start_timestamp, end_timestamp,
+                         use_weighted_training):
+        return stats.aggregate_stats(self.df,
+                                     ["auction_hour", "bidderTimeout"])
+
+
+def get_optimizer(cls, df, **kwargs):
+    _optimizer = cls(
+            config_id="dummy",
+            bucket_size=2000,
+            source_table="dummy",
+            configs_to_optimize={"bidderTimeout": TIMEOUTS},
+            min_probability=0.01,
+            model_type="default",
+            use_weighted_training=False,
+            **kwargs
+        )
+    _optimizer.reader = InMemorySegmentReader(df)
+    return _optimizer
+
+
+def read_shards(output_dir):
+    rows = []
+    for file_name in sorted(os.listdir(output_dir)):
+        with open(os.path.join(output_dir, file_name)) as f:
+            rows.extend(json.loads(line) for line in f)
+
+    return {row["segment"]: row for row in rows}
+
+
+def test_segment_distributions(tmp_path):
+    # One segment per chunk, so every segment is written to its own shard
+    _optimizer = get_optimizer(SegmentedOptimizer, get_segment_df(),
+                               max_draws=2000 * len(TIMEOUTS))
+    summary = _optimizer.generate_segment_distributions(
+        START_TIMESTAMP, END_TIMESTAMP, str(tmp_path))
+
+    assert summary["status"] == optimizer.STATUS_OK
+    assert summary["num_shards"] == 3
+    assert sorted(os.listdir(tmp_path))[0] == "segments-00000-of-00003.jsonl"
+
+    rows = read_shards(tmp_path)
+    assert sorted(rows) == sorted(SEGMENT_WIN_RATES)
+    assert rows["div-footer"]["status"] == optimizer.STATUS_NOT_ENOUGH_DATA
+
+    for segment in ["div-top", "div-side"]:
+        assert rows[segment]["status"] == optimizer.STATUS_OK
+        probs_to_win = [a["prob_to_win"] for a in rows[segment]["actions"]]
+        assert np.argmax(probs_to_win) \
+            == np.argmax(SEGMENT_WIN_RATES[segment]), \
+            f"{segment}: {probs_to_win}"
+
+
+def test_single_segment_matches_optimizer(tmp_path):
+    """ The vectorized computation agrees with TSOptimizer on a config with
+    a single segment """
+    df = get_segment_df()
+    df = df[df["segment"] == "div-top"]
+
+    np.random.seed(0)
+    _optimizer = get_optimizer(optimizer.TSOptimizer, df)
+    expected = _optimizer.generate_distributions(START_TIMESTAMP,
+                                                 END_TIMESTAMP)
+
+    _optimizer = get_optimizer(SegmentedOptimizer, df)
+    _optimizer.generate_segment_distributions(START_TIMESTAMP, END_TIMESTAMP,
+                                              str(tmp_path))
+    row = read_shards(tmp_path)["div-top"]
+
+    for expected_action, action in zip(expected["actions"], row["actions"]):
+        assert action["config"] == expected_action["config"]
+        assert abs(action["prob_to_win"]
+                   - expected_action["prob_to_win"]) < 0.1
+        # Statistics of the latest hour
+        assert action["num_trials"] == expected_action["num_trials"]
+        assert action["num_wins"] == expected_action["num_wins"]
+        assert np.isclose(action["log_pubrev_mean"],
+                          expected_action["log_pubrev_mean"])
+        assert np.isclose(action["log_pubrev_std"],
+                          expected_action["log_pubrev_std"])
+
+
+def test_over_budget_segments_are_skipped(tmp_path):
+    class OverBudgetReader(InMemorySegmentReader):
+        def get_segment_stats(self, start_timestamp, end_timestamp):
+            raise QueryTooExpensiveError(10 ** 12, 10 ** 9)
+
+    _optimizer = get_optimizer(SegmentedOptimizer, get_segment_df())
+    _optimizer.reader = OverBudgetReader(get_segment_df())
+    summary = _optimizer.generate_segment_distributions(
+        START_TIMESTAMP, END_TIMESTAMP, str(tmp_path))
+
+    assert summary["status"] == optimizer.STATUS_QUERY_OVER_BUDGET
+    assert summary["num_segments"] == 0
+    assert os.listdir(tmp_path) == []
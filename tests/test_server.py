@@ -0,0 +1,123 @@
+import json
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+
+from prebid_optimizer import exporter
+from prebid_optimizer.local_storage import LocalStorageClient
+from prebid_optimizer.server import DistributionServer
+from prebid_optimizer.server import touch_trigger_file
+
+
+BUCKET = "ox-test-prebid-optimizer-data"
+
+
+def get_results(prob_to_win):
+    return {"actions": [
+        {"config": {"bidderTimeout": 1000}, "prob_to_win": prob_to_win},
+        {"config": {"bidderTimeout": 2000}, "prob_to_win": 1 - prob_to_win},
+    ]}
+
+
+def get(url, etag=None):
+    request = urllib.request.Request(url)
+    if etag:
+        request.add_header("If-None-Match", etag)
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, response.headers.get("ETag"), \
+                json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, e.headers.get("ETag"), None
+
+
+def test_server(tmp_path):
+    client = LocalStorageClient(str(tmp_path))
+    exporter.exportJSON(get_results(0.25), BUCKET, "abc", client)
+    exporter.exportJSON(get_results(0.5), BUCKET, "def", client)
+    # Staged rows of sharded runs are not served
+    client.bucket(BUCKET).blob("_staging/distributions.json") \
+        .upload_from_string("{}")
+
+    server = DistributionServer(BUCKET, client, refresh_seconds=3600)
+    host, port = server.start("127.0.0.1", 0)
+    url = f"http://{host}:{port}"
+    try:
+        status, etag, distributions = get(f"{url}/distributions/abc")
+        assert status == 200
+        assert etag == f'"{distributions["version"]}"'
+        assert distributions["actions"][0]["prob_to_win"] == 0.25
+
+        assert get(f"{url}/distributions/abc", etag)[0] == 304
+        assert get(f"{url}/distributions/xyz")[0] == 404
+
+        status, batch_etag, batch = get(
+            f"{url}/distributions?config_ids=abc,def,xyz")
+        assert status == 200
+        assert sorted(batch["distributions"]) == ["abc", "def"]
+        assert batch["missing"] == ["xyz"]
+        assert get(f"{url}/distributions?config_ids=abc,def,xyz",
+                   batch_etag)[0] == 304
+
+        # A new run publishes, the next refresh swaps it in
+        exporter.exportJSON(get_results(0.75), BUCKET, "abc", client)
+        assert server.reload() == 1
+        status, new_etag, distributions = get(f"{url}/distributions/abc",
+                                              etag)
+        assert status == 200
+        assert new_etag != etag
+        assert distributions["actions"][0]["prob_to_win"] == 0.75
+
+        status, _, health = get(f"{url}/healthz")
+        assert health["num_configs"] == 2
+    finally:
+        server.stop()
+
+
+def test_local_generations(tmp_path):
+    from google.api_core.exceptions import PreconditionFailed
+
+    client = LocalStorageClient(str(tmp_path))
+    blob = client.bucket(BUCKET).blob("abc/distributions.json")
+    assert blob.generation is None
+
+    # Back to back writes, within any timestamp granularity
+    for generation in range(1, 4):
+        blob.upload_from_string("{}", if_generation_match=generation - 1)
+        assert blob.generation == generation
+
+    with pytest.raises(PreconditionFailed):
+        blob.upload_from_string("{}", if_generation_match=2)
+
+    # Seen by another client, e.g. in the server's process
+    other_client = LocalStorageClient(str(tmp_path))
+    assert [(b.name, b.generation) for b in other_client.list_blobs(BUCKET)] \
+        == [("abc/distributions.json", 3)]
+
+
+def test_trigger_file_refreshes_immediately(tmp_path):
+    client = LocalStorageClient(str(tmp_path / "gcs"))
+    exporter.exportJSON(get_results(0.25), BUCKET, "abc", client)
+    trigger_file = str(tmp_path / "reload")
+
+    server = DistributionServer(BUCKET, client, refresh_seconds=3600,
+                                trigger_file=trigger_file,
+                                poll_seconds=0.01)
+    host, port = server.start("127.0.0.1", 0)
+    url = f"http://{host}:{port}"
+    try:
+        exporter.exportJSON(get_results(0.75), BUCKET, "abc", client)
+        touch_trigger_file(trigger_file)
+
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            distributions = get(f"{url}/distributions/abc")[2]
+            if distributions["actions"][0]["prob_to_win"] == 0.75:
+                break
+            time.sleep(0.01)
+        assert distributions["actions"][0]["prob_to_win"] == 0.75
+        assert not (tmp_path / "reload").exists()
+    finally:
+        server.stop()
@@ -0,0 +1,77 @@
+import multiprocessing
+import os
+
+import pytest
+
+from prebid_optimizer import reader
+from prebid_optimizer import session
+
+
+class CountingSession(session.Session):
+    """ Creates placeholder clients instead of GCP ones """
+    num_created = 0
+
+    def _create(self, name):
+        self.num_created += 1
+        return {"name": name, "pid": os.getpid()}
+
+
+# Inherited by the forked pool worker, a Session is not picklable
+FORKED_SESSION = None
+
+
+def get_forked_client():
+    return FORKED_SESSION.bigquery
+
+
+def test_clients_are_reused():
+    _session = CountingSession()
+
+    assert _session.bigquery is _session.bigquery
+    assert _session.storage is not _session.bigquery
+    assert _session.num_created == 2
+
+    with pytest.raises(ValueError):
+        _session.get("pubsub")
+
+
+def test_forked_child_creates_its_own_clients():
+    global FORKED_SESSION
+    FORKED_SESSION = CountingSession()
+    parent_client = FORKED_SESSION.bigquery
+
+    with multiprocessing.get_context("fork").Pool(1) as pool:
+        child_client = pool.apply(get_forked_client)
+
+    assert child_client["pid"] != os.getpid()
+    # The parent keeps its clients
+    assert FORKED_SESSION.bigquery is parent_client
+
+
+def test_fork_while_a_client_is_created():
+    global FORKED_SESSION
+    FORKED_SESSION = CountingSession()
+    # Another thread is creating a client when the process forks
+    FORKED_SESSION._lock.acquire()
+    try:
+        with multiprocessing.get_context("fork").Pool(1) as pool:
+            child_client = pool.apply_async(get_forked_client).get(timeout=10)
+    finally:
+        FORKED_SESSION._lock.release()
+
+    assert child_client["pid"] != os.getpid()
+
+
+def test_injected_clients():
+    fake_client = object()
+    _session = session.Session(clients={"bigquery": fake_client})
+    previous = session.set_default_session(_session)
+    try:
+        _reader = reader.TSReader("dummy", "dummy.prebid.auctions",
+                                  {"bidderTimeout": [1000, 1500]})
+        assert _reader.client is fake_client
+    finally:
+        session.set_default_session(previous)
+
+    with pytest.raises(ValueError):
+        session.Session(clients={"pubsub": fake_client})
@@ -0,0 +1,141 @@
+from datetime import datetime
+import json
+
+import pytest
+
+from prebid_optimizer import sharding
+from prebid_optimizer.costs import CostHistory
+
+
+CONFIG_IDS = [f"config-{i}" for i in range(50)]
+RUN_PREFIX = sharding.get_run_prefix(datetime(2021, 3, 1, 5, 42))
+
+
+class FakeBlob:
+    def __init__(self, blobs, name):
+        self.blobs = blobs
+        self.name = name
+
+    def upload_from_string(self, data, content_type=None):
+        self.data = data
+        self.blobs[self.name] = self
+
+    def download_as_text(self):
+        return self.data
+
+
+class FakeStorageClient:
+    def __init__(self):
+        self.blobs = {}
+
+    def bucket(self, name):
+        return self
+
+    def blob(self, name):
+        return FakeBlob(self.blobs, name)
+
+    def get_blob(self, name):
+        return self.blobs.get(name)
+
+    def list_blobs(self, bucket_name, prefix):
+        return [blob for name, blob in sorted(self.blobs.items())
+                if name.startswith(prefix)]
+
+
+class FakeJob:
+    def result(self):
+        pass
+
+
+class FakeBQClient:
+    def __init__(self):
+        self.loads = []
+
+    def load_table_from_uri(self, source_uri, table_id, job_config=None):
+        self.loads.append((source_uri, table_id))
+        return FakeJob()
+
+
+def test_shards_partition_configs():
+    shards = [sharding.select_shard(CONFIG_IDS, i, 4) for i in range(4)]
+
+    assert sorted(sum(shards, [])) == sorted(CONFIG_IDS)
+    assert all(shards)
+    # Independent of the order of the configs
+    assert sharding.select_shard(CONFIG_IDS[::-1], 1, 4) == shards[1][::-1]
+
+    with pytest.raises(ValueError):
+        sharding.select_shard(CONFIG_IDS, 4, 4)
+
+
+def test_cost_aware_shards_are_balanced():
+    costs = {config_id: 100 if i < 2 else 1
+             for i, config_id in enumerate(CONFIG_IDS)}
+    assignment = sharding.assign_shards(CONFIG_IDS, 3, costs)
+
+    shard_costs = [0] * 3
+    for config_id, shard_index in assignment.items():
+        shard_costs[shard_index] += costs[config_id]
+    # The two expensive configs get a shard each, the third gets the rest
+    assert sorted(shard_costs) == [48, 100, 100]
+    assert assignment == sharding.assign_shards(CONFIG_IDS, 3, costs)
+
+
+def test_merge_waits_for_all_shards(tmp_path):
+    storage_client = FakeStorageClient()
+    bq_client = FakeBQClient()
+    cost_history = CostHistory(str(tmp_path / "cost_history.json"))
+    rows_path = sharding.get_rows_path(RUN_PREFIX)
+    for config_id in CONFIG_IDS[:3]:
+        row = {"bundleID": config_id, "runtime_seconds": 2.5,
+               "num_rows": 100}
+        storage_client.blob(f"{rows_path}/{config_id}.json") \
+            .upload_from_string(json.dumps(row))
+
+    sharding.markShardDone("bucket", RUN_PREFIX, 0, 2, storage_client)
+    with pytest.raises(RuntimeError):
+        sharding.mergeShardedRun("bucket", RUN_PREFIX, 2, "table",
+                                 bq_client, storage_client, cost_history)
+    assert not bq_client.loads
+    assert not cost_history.entries
+
+    sharding.markShardDone("bucket", RUN_PREFIX, 1, 2, storage_client)
+    num_rows = sharding.mergeShardedRun("bucket", RUN_PREFIX, 2, "table",
+                                        bq_client, storage_client,
+                                        cost_history)
+
+    assert num_rows == 3
+    assert bq_client.loads == [(f"gs://bucket/{rows_path}/*", "table")]
+    assert CostHistory(cost_history.path).entries["config-0"] \
+        == {"seconds": 2.5, "num_rows": 100, "num_runs": 1}
+
+
+def test_merge_is_idempotent(tmp_path):
+    storage_client = FakeStorageClient()
+    bq_client = FakeBQClient()
+    cost_history_path = str(tmp_path / "cost_history.json")
+    rows_path = sharding.get_rows_path(RUN_PREFIX)
+    row = {"bundleID": "config-0", "runtime_seconds": 2.5,
+           "actions": [{"num_trials": 100}]}
+    storage_client.blob(f"{rows_path}/config-0.json") \
+        .upload_from_string(json.dumps(row))
+    sharding.markShardDone("bucket", RUN_PREFIX, 0, 1, storage_client)
+
+    class FailingCostHistory(CostHistory):
+        def save(self):
+            raise IOError("could not write the cost history")
+
+    with pytest.raises(IOError):
+        sharding.mergeShardedRun("bucket", RUN_PREFIX, 1, "table", bq_client,
+                                 storage_client,
+                                 FailingCostHistory(cost_history_path))
+
+    # The retry does not load the rows again, but updates the history
+    for _ in range(2):
+        sharding.mergeShardedRun("bucket", RUN_PREFIX, 1, "table", bq_client,
+                                 storage_client,
+                                 CostHistory(cost_history_path))
+
+    assert len(bq_client.loads) == 1
+    assert CostHistory(cost_history_path).entries["config-0"]["num_runs"] \
+        == 1
@@ -0,0 +1,74 @@
+from multiprocessing import shared_memory
+
+import numpy as np
+import pytest
+
+from prebid_optimizer import optimizer
+from prebid_optimizer import shared
+from prebid_optimizer import stats
+from prebid_optimizer.optimizer import get_config_combos
+from synthetic import InMemoryReader
+from synthetic import TIMEOUTS
+
+
+CONFIG_COMBOS = get_config_combos({"bidderTimeout": TIMEOUTS})
+
+
+def get_df():
+    df = InMemoryReader(num_hours=6, rows_per_hour=500).df
+    # Shuffled, the dataset sorts the rows by hour
+    return df.sample(frac=1, random_state=0).reset_index(drop=True)
+
+
+def test_workers_attach_to_the_dataset():
+    df = get_df()
+    expected = stats.aggregate_stats(df, ["auction_hour", "bidderTimeout"])
+
+    with shared.SharedDataset.publish(df, CONFIG_COMBOS) as dataset:
+        assert dataset.num_rows == len(df)
+        assert (np.diff(dataset["auction_hour"]) >= 0).all()
+
+        hourly_stats = shared.get_hourly_stats(dataset, CONFIG_COMBOS,
+                                               num_workers=3)
+
+    hourly_stats = hourly_stats.sort_values(["auction_hour", "bidderTimeout"])
+    expected = expected.sort_values(["auction_hour", "bidderTimeout"])
+    for field in ["auction_hour", "bidderTimeout"] + stats.STAT_FIELDS:
+        assert np.allclose(hourly_stats[field], expected[field]), field
+
+
+def test_block_is_unlinked_on_close():
+    dataset = shared.SharedDataset.publish(get_df(), CONFIG_COMBOS)
+    name = dataset.name
+
+    attached = shared.SharedDataset.attach(dataset.descriptor)
+    # Zero copy: both map the same memory
+    attached["pubrev"][0] = -1.0
+    assert dataset["pubrev"][0] == -1.0
+    attached.close()
+
+    dataset.close()
+    with pytest.raises(FileNotFoundError):
+        shared_memory.SharedMemory(name=name)
+
+
+def test_optimizer_aggregates_with_workers():
+    df = get_df()
+    _optimizer = optimizer.TSOptimizer(
+        config_id="dummy",
+        bucket_size=1000,
+        source_table="dummy",
+        configs_to_optimize={"bidderTimeout": TIMEOUTS},
+        min_probability=0.01,
+        model_type="default",
+        use_weighted_training=False,
+        stats_workers=2,
+    )
+    _optimizer.reader.get_data = lambda *args: df
+
+    results = _optimizer.generate_distributions(None, None)
+
+    assert results["status"] == optimizer.STATUS_OK
+    assert results["num_rows"] == len(df)
+    probs_to_win = [x["prob_to_win"] for x in results["actions"]]
+    assert np.argmax(probs_to_win) == 2, probs_to_win
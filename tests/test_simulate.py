@@ -0,0 +1,44 @@
+import numpy as np
+
+from prebid_optimizer import simulate
+
+
+# The last action is clearly the best one
+SCENARIO = simulate.make_scenario(num_hours=12, delta=0.05, amplitude=0)
+
+
+def test_regret_decreases():
+    summary = simulate.simulate(SCENARIO, bucket_size=1000, hour_window=3,
+                                data_delay_hour=1, num_replications=50,
+                                num_workers=1)
+
+    regrets = np.array(summary["mean_regret_per_hour"])
+    expected_rewards = simulate.get_expected_rewards(SCENARIO)
+    uniform_regret = expected_rewards[0].max() - expected_rewards[0].mean()
+
+    # Uniform until the first hour of data arrives
+    assert np.isclose(regrets[0], uniform_regret)
+    assert regrets[-3:].mean() < 0.5 * uniform_regret
+    assert 0 < summary["relative_regret"] < 1
+
+
+def test_parallel_matches_sequential():
+    kwargs = dict(bucket_size=500, hour_window=3, data_delay_hour=1,
+                  num_replications=8, block_size=4, seed=1)
+
+    sequential = simulate.simulate(SCENARIO, num_workers=1, **kwargs)
+    parallel = simulate.simulate(SCENARIO, num_workers=2, **kwargs)
+
+    assert sequential["mean_regret_per_hour"] \
+        == parallel["mean_regret_per_hour"]
+
+
+def test_gamma_model():
+    scenario = simulate.make_scenario(num_hours=5, delta=0.05, amplitude=0,
+                                      auctions_per_hour=300)
+    summary = simulate.simulate(scenario, model_type="gamma", bucket_size=500,
+                                hour_window=2, data_delay_hour=1,
+                                num_replications=2, num_workers=1)
+
+    assert len(summary["mean_regret_per_hour"]) == 5
+    assert summary["fit_seconds"] > 0
@@ -0,0 +1,54 @@
+import numpy as np
+import pandas as pd
+
+from prebid_optimizer import models
+from prebid_optimizer import stats
+
+
+RNG = np.random.default_rng(0)
+NUM_ROWS = 2000
+SAMPLE_DF = pd.DataFrame({
+    "auction_hour": RNG.integers(0, 4, NUM_ROWS),
+    "bidderTimeout": RNG.choice([1000, 1500], NUM_ROWS),
+    "pubrev": np.where(RNG.random(NUM_ROWS) < 0.2, 
+                       RNG.lognormal(11, 1, NUM_ROWS), 0),
+})
+
+
+def abs_diff(a, b, precision=4):
+    return np.round(np.abs(a - b), precision)
+
+
+def test_aggregate_stats():
+    hourly_stats = stats.aggregate_stats(SAMPLE_DF, 
+                                         ["auction_hour", "bidderTimeout"])
+
+    assert len(hourly_stats) == 8
+    totals = stats.sum_stats(hourly_stats)
+    expected = stats.get_sufficient_stats(SAMPLE_DF)
+    for field in stats.STAT_FIELDS:
+        assert abs_diff(totals[field], expected[field]) < 1e-3, field
+
+
+def test_get_log_pubrev_moments():
+    wins = SAMPLE_DF[SAMPLE_DF["pubrev"] > 0]
+    log_pubrev = np.log(wins["pubrev"] + 1)
+
+    mean, std = stats.get_log_pubrev_moments(
+        stats.get_sufficient_stats(SAMPLE_DF))
+
+    assert abs_diff(mean, log_pubrev.mean()) < 1e-6
+    assert abs_diff(std, log_pubrev.std()) < 1e-6
+
+
+def test_hyperparams_from_stats():
+    """ Fitting from aggregated statistics matches fitting from raw rows """
+    hourly_stats = stats.aggregate_stats(SAMPLE_DF, ["auction_hour"])
+    totals = stats.sum_stats(hourly_stats)
+
+    for model in [models.BetaLogNormalModel(), models.GammaModel(alpha0=0.08)]:
+        from_df = model.get_posterior_hyperparams(SAMPLE_DF)
+        from_stats = model.get_posterior_hyperparams_from_stats(totals)
+
+        for key, val in from_df.items():
+            assert abs_diff(val, from_stats[key]) < 1e-4, key
@@ -0,0 +1,150 @@
+from datetime import datetime
+import json
+
+import pytest
+
+from prebid_optimizer import daemon
+from prebid_optimizer import watermark
+from prebid_optimizer.reader import MIN_BYTES_BILLED
+from prebid_optimizer.reader import QueryTooExpensiveError
+from prebid_optimizer.session import Session
+
+
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def _dt(value):
+    return datetime.strptime(value, DATETIME_FORMAT)
+
+
+def _write_source(path, latest_receipt_times):
+    with open(path, "w") as f:
+        json.dump({"latest_receipt_times": latest_receipt_times}, f)
+
+
+def test_get_complete_until():
+    # Stragglers of 07:00-08:00 may still land until 08:10
+    assert watermark.get_complete_until(_dt("2021-09-16 08:09:00")) \
+        == _dt("2021-09-16 07:00:00")
+    assert watermark.get_complete_until(_dt("2021-09-16 08:10:00")) \
+        == _dt("2021-09-16 08:00:00")
+    assert watermark.get_complete_until(_dt("2021-09-16 08:40:00"),
+                                        lateness_minutes=45) \
+        == _dt("2021-09-16 07:00:00")
+
+
+def test_get_watermarks(tmp_path):
+    path = str(tmp_path / "watermarks.json")
+    now = _dt("2021-09-16 09:05:00")
+
+    source = watermark.LocalWatermarkSource(path)
+    _write_source(path, {})
+    assert watermark.get_watermarks(source, ["a", "b"], now) \
+        == {"a": None, "b": None}
+
+    _write_source(path, {"a": "2021-09-16 09:02:00",
+                         "b": "2021-09-16 08:30:00"})
+    watermarks = watermark.get_watermarks(source, ["a", "b", "c"], now)
+    assert watermarks == {
+        "a": _dt("2021-09-16 08:00:00"),
+        "b": _dt("2021-09-16 08:00:00"),
+        # No recent rows: complete up to the other configs' watermark
+        "c": _dt("2021-09-16 08:00:00"),
+    }, watermarks
+
+    _write_source(path, {"a": "2021-09-16 09:12:00",
+                         "b": "2021-09-16 08:30:00"})
+    watermarks = watermark.get_watermarks(source, ["a", "b"], now)
+    assert watermarks == {"a": _dt("2021-09-16 09:00:00"),
+                          "b": _dt("2021-09-16 08:00:00")}, watermarks
+
+
+class FakeJob:
+    def __init__(self, total_bytes_processed, rows):
+        self.total_bytes_processed = total_bytes_processed
+        self.rows = rows
+
+    def result(self):
+        return self.rows
+
+
+class FakeClient:
+    """ Records the queries, every query scans `bytes_per_query` """
+    def __init__(self, bytes_per_query, rows):
+        self.bytes_per_query = bytes_per_query
+        self.rows = rows
+        self.job_configs = []
+
+    def query(self, sql, job_config=None):
+        self.job_configs.append(job_config)
+        return FakeJob(self.bytes_per_query, self.rows)
+
+
+def test_bigquery_source_is_filtered_and_budgeted():
+    client = FakeClient(100, [{"configID": "a", "latest_receipt_time":
+                               _dt("2021-09-16 09:12:00")}])
+    source = watermark.BigQueryWatermarkSource(
+        "dummy.prebid.auctions", session=Session(clients={"bigquery": client}),
+        max_bytes_scanned=1000)
+
+    assert source.get_latest_receipt_times(["a", "b"],
+                                           _dt("2021-09-16 09:15:00")) \
+        == {"a": _dt("2021-09-16 09:12:00")}
+    dry_run_config, job_config = client.job_configs
+    assert dry_run_config.dry_run
+    parameters = {p.name: p for p in job_config.query_parameters}
+    assert parameters["config_ids"].values == ["a", "b"]
+    assert job_config.maximum_bytes_billed \
+        == MIN_BYTES_BILLED
+
+    client.bytes_per_query = 10 ** 6
+    client.job_configs = []
+    with pytest.raises(QueryTooExpensiveError):
+        source.get_latest_receipt_times(["a", "b"],
+                                        _dt("2021-09-16 09:15:00"))
+    assert all(job_config.dry_run for job_config in client.job_configs)
+
+
+def test_watermark_trigger(tmp_path):
+    path = str(tmp_path / "watermarks.json")
+    now = _dt("2021-09-16 09:15:00")
+    trigger = watermark.WatermarkTrigger(
+        watermark.LocalWatermarkSource(path), ["a", "b"])
+
+    _write_source(path, {"a": "2021-09-16 09:12:00",
+                         "b": "2021-09-16 08:30:00"})
+    assert trigger.poll(now)
+    assert trigger.get_ready() == {_dt("2021-09-16 09:00:00"): ["a"],
+                                   _dt("2021-09-16 08:00:00"): ["b"]}
+    assert trigger.get_min_watermark() == _dt("2021-09-16 08:00:00")
+    assert trigger.get_ready(until=_dt("2021-09-16 08:00:00")) \
+        == {_dt("2021-09-16 08:00:00"): ["a", "b"]}
+
+    trigger.mark_run(["a"], _dt("2021-09-16 09:00:00"))
+    trigger.mark_run(["b"], _dt("2021-09-16 08:00:00"))
+    assert not trigger.poll(now), "Nothing new landed"
+
+    _write_source(path, {"a": "2021-09-16 09:14:00",
+                         "b": "2021-09-16 09:11:00"})
+    assert trigger.poll(now)
+    assert trigger.get_ready() == {_dt("2021-09-16 09:00:00"): ["b"]}
+
+
+def test_daemon_runs_on_watermark(tmp_path):
+    path = str(tmp_path / "watermarks.json")
+    _write_source(path, {"a": "2021-09-16 09:12:00"})
+    trigger = watermark.WatermarkTrigger(
+        watermark.LocalWatermarkSource(path), ["a"])
+    ready = []
+
+    def run(run_timestamp):
+        for end_timestamp, config_ids in trigger.get_ready().items():
+            ready.append((end_timestamp, config_ids))
+            trigger.mark_run(config_ids, end_timestamp)
+
+    _daemon = daemon.OptimizerDaemon(run, poll_seconds=0.01, max_runs=1,
+                                     watermark_trigger=trigger,
+                                     watermark_poll_seconds=0.01)
+    _daemon.run()
+
+    assert ready == [(_dt("2021-09-16 09:00:00"), ["a"])], ready